@@ -0,0 +1,107 @@
+"""Benchmarks of the model engines, using numpy arrays as input"""
+import niche_vlaanderen as nv
+
+from .common import sizes, niche_inputs, flooding_depth
+
+
+class _Engine(object):
+    params = [sizes]
+    param_names = ["cells"]
+    timeout = 3600
+
+    def setup(self, cells):
+        self.inputs = niche_inputs(cells)
+
+    def teardown(self, cells):
+        del self.inputs
+
+
+class NutrientLevel(_Engine):
+    def setup(self, cells):
+        super(NutrientLevel, self).setup(cells)
+        self.model = nv.NutrientLevel()
+
+    def _calculate(self):
+        i = self.inputs
+        self.model.calculate(i["soil_code"], i["msw"],
+                             i["nitrogen_atmospheric"], i["nitrogen_animal"],
+                             i["nitrogen_fertilizer"], i["management"],
+                             i["inundation_nutrient"])
+
+    def time_calculate(self, cells):
+        self._calculate()
+
+    def peakmem_calculate(self, cells):
+        self._calculate()
+
+
+class Acidity(_Engine):
+    def setup(self, cells):
+        super(Acidity, self).setup(cells)
+        self.model = nv.Acidity()
+
+    def _calculate(self):
+        i = self.inputs
+        self.model.calculate(i["soil_code"], i["mlw"],
+                             i["inundation_acidity"], i["seepage"],
+                             i["minerality"], i["rainwater"])
+
+    def time_calculate(self, cells):
+        self._calculate()
+
+    def peakmem_calculate(self, cells):
+        self._calculate()
+
+
+class Vegetation(_Engine):
+    def setup(self, cells):
+        super(Vegetation, self).setup(cells)
+        i = self.inputs
+        i["nutrient_level"] = nv.NutrientLevel().calculate(
+            i["soil_code"], i["msw"], i["nitrogen_atmospheric"],
+            i["nitrogen_animal"], i["nitrogen_fertilizer"], i["management"],
+            i["inundation_nutrient"])
+        i["acidity"] = nv.Acidity().calculate(
+            i["soil_code"], i["mlw"], i["inundation_acidity"], i["seepage"],
+            i["minerality"], i["rainwater"])
+        self.model = nv.Vegetation()
+
+    def _calculate(self):
+        i = self.inputs
+        self.model.calculate(i["soil_code"], i["mhw"], i["mlw"],
+                             i["nutrient_level"], i["acidity"])
+
+    def _calculate_deviation(self):
+        i = self.inputs
+        self.model.calculate_deviation(i["soil_code"], i["mhw"], i["mlw"])
+
+    def time_calculate(self, cells):
+        self._calculate()
+
+    def peakmem_calculate(self, cells):
+        self._calculate()
+
+    def time_calculate_deviation(self, cells):
+        self._calculate_deviation()
+
+    def peakmem_calculate_deviation(self, cells):
+        self._calculate_deviation()
+
+
+class Flooding(object):
+    params = [sizes]
+    param_names = ["cells"]
+    timeout = 3600
+
+    def setup(self, cells):
+        self.depth = flooding_depth(cells)
+        self.model = nv.Flooding()
+
+    def teardown(self, cells):
+        del self.depth
+
+    def time_calculate(self, cells):
+        self.model._calculate(self.depth, "T25", 1, "winter")
+
+    def peakmem_calculate(self, cells):
+        self.model._calculate(self.depth, "T25", 1, "winter")
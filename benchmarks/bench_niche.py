@@ -0,0 +1,75 @@
+"""Benchmarks of the Niche model, using input grids written to disk"""
+import shutil
+import tempfile
+
+import niche_vlaanderen as nv
+
+from .common import sizes, write_niche_inputs, vectors
+
+
+class _Niche(object):
+    params = [sizes]
+    param_names = ["cells"]
+    timeout = 3600
+
+    def setup(self, cells):
+        self.folder = tempfile.mkdtemp()
+        self.files = write_niche_inputs(self.folder, cells)
+
+    def teardown(self, cells):
+        shutil.rmtree(self.folder)
+
+    def _niche(self, **replace):
+        niche = nv.Niche()
+        for key in self.files:
+            niche.set_input(key, replace.get(key, self.files[key]))
+        return niche
+
+
+class Run(_Niche):
+    def time_run(self, cells):
+        self._niche().run()
+
+    def peakmem_run(self, cells):
+        self._niche().run()
+
+    def time_run_deviation(self, cells):
+        self._niche().run(deviation=True)
+
+
+class Results(_Niche):
+    """Benchmarks using the result of a model run"""
+
+    def setup(self, cells):
+        super(Results, self).setup(cells)
+        self.niche = self._niche()
+        self.niche.run()
+        self.vectors = vectors(cells)
+        self.output = tempfile.mkdtemp(dir=self.folder)
+
+    def time_write(self, cells):
+        self.niche.write(self.output, overwrite_files=True)
+
+    def peakmem_write(self, cells):
+        self.niche.write(self.output, overwrite_files=True)
+
+    def time_zonal_stats(self, cells):
+        self.niche.zonal_stats(self.vectors)
+
+    def peakmem_zonal_stats(self, cells):
+        self.niche.zonal_stats(self.vectors)
+
+
+class Delta(_Niche):
+    def setup(self, cells):
+        super(Delta, self).setup(cells)
+        self.full = self._niche()
+        self.full.run()
+        self.simple = self._niche()
+        self.simple.run(full_model=False)
+
+    def time_delta(self, cells):
+        nv.NicheDelta(self.full, self.simple)
+
+    def peakmem_delta(self, cells):
+        nv.NicheDelta(self.full, self.simple)
@@ -0,0 +1,128 @@
+"""Synthetic input data for the benchmarks
+
+The input grids are generated randomly, using the codes of the code tables
+distributed with niche_vlaanderen, so every benchmark can be run at
+different grid sizes.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import rasterio
+from affine import Affine
+
+from niche_vlaanderen.codetables import system_table
+
+# number of cells of the generated grids
+sizes = [10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7, 10 ** 8]
+
+# Belgian Lambert 72
+crs = "EPSG:31370"
+cell_size = 25.0
+origin = (150000.0, 200000.0)
+
+
+def shape(cells):
+    """Shape of a (nearly) square grid with the given number of cells"""
+    rows = int(np.sqrt(cells))
+    return rows, cells // rows
+
+
+def transform():
+    return Affine(cell_size, 0, origin[0], 0, -cell_size, origin[1])
+
+
+def _codes(table, column="code", folder=""):
+    ct = pd.read_csv(system_table(folder, table + ".csv"),
+                     skipinitialspace=True)
+    return ct[column].values
+
+
+def niche_inputs(cells, seed=0):
+    """Random input grids for a full Niche model
+
+    Returns
+    -------
+    inputs: dict
+        numpy array for every input layer of a full model
+    """
+    random = np.random.RandomState(seed)
+    size = shape(cells)
+
+    inputs = dict()
+    inputs["soil_code"] = random.choice(_codes("soil_codes", "soil_code"),
+                                        size)
+    # mhw must be lower than msw, which must be lower than mlw
+    inputs["mlw"] = random.uniform(-50, 250, size).astype("float32")
+    inputs["msw"] = inputs["mlw"] - random.uniform(0, 50, size)\
+        .astype("float32")
+    inputs["mhw"] = inputs["msw"] - random.uniform(0, 50, size)\
+        .astype("float32")
+    inputs["seepage"] = random.uniform(-3, 3, size).astype("float32")
+    inputs["nitrogen_atmospheric"] = random.uniform(10, 50, size)\
+        .astype("float32")
+    inputs["nitrogen_animal"] = random.uniform(0, 300, size)\
+        .astype("float32")
+    inputs["nitrogen_fertilizer"] = random.uniform(0, 300, size)\
+        .astype("float32")
+    inputs["management"] = random.choice(_codes("management"), size)
+    inputs["inundation_acidity"] = random.randint(0, 2, size)
+    inputs["inundation_nutrient"] = random.randint(0, 2, size)
+    inputs["minerality"] = random.randint(0, 2, size)
+    inputs["rainwater"] = random.randint(0, 2, size)
+    return inputs
+
+
+def flooding_depth(cells, seed=0):
+    """Random grid with flooding depth classes"""
+    random = np.random.RandomState(seed)
+    depths = _codes("depths", folder="flooding")
+    return random.choice(depths, shape(cells))
+
+
+def write_grid(path, band):
+    """Writes an array as a GeoTIFF with the benchmark spatial context"""
+    if band.dtype.kind == 'f':
+        nodata = -99999
+    else:
+        band = band.astype("int16")
+        nodata = -99
+
+    params = dict(driver="GTiff", height=band.shape[0], width=band.shape[1],
+                  count=1, dtype=band.dtype, crs=crs, transform=transform(),
+                  nodata=nodata, compress="DEFLATE", tiled=True)
+    with rasterio.open(path, "w", **params) as dst:
+        dst.write(band, 1)
+
+
+def write_niche_inputs(folder, cells, seed=0):
+    """Writes random input grids for a full model to folder
+
+    Returns
+    -------
+    files: dict
+        path of the grid for every input layer
+    """
+    files = dict()
+    for key, band in niche_inputs(cells, seed).items():
+        files[key] = os.path.join(folder, key + ".tif")
+        write_grid(files[key], band)
+    return files
+
+
+def vectors(cells, n=10):
+    """A row of n square polygons covering the centre of the grid"""
+    rows, cols = shape(cells)
+    width = cols * cell_size / n
+    top = origin[1] - rows * cell_size / 4
+    bottom = origin[1] - rows * cell_size * 3 / 4
+    features = []
+    for i in range(n):
+        left = origin[0] + i * width
+        right = left + width * 0.9
+        ring = [(left, top), (right, top), (right, bottom), (left, bottom),
+                (left, top)]
+        features.append({"type": "Feature", "properties": {"id": i},
+                         "geometry": {"type": "Polygon",
+                                      "coordinates": [ring]}})
+    return features
@@ -4,3 +4,4 @@ from .nutrient_level import NutrientLevel # noqa
 from .vegetation import Vegetation # noqa
 from .version import __version__ # noqa
 from .flooding import Flooding # noqa
+from .writer import GridWriter # noqa
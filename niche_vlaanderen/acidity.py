@@ -1,9 +1,9 @@
-from pkg_resources import resource_filename
-
 import numpy as np
-import pandas as pd
 
-from .codetables import validate_tables_acidity, check_codes_used
+from .codetables import validate_tables_acidity, check_codes_used, \
+    code_index, load_code_tables, load_bundle, set_code_tables, \
+    system_table
+from .partition import SoilPartition
 
 
 class Acidity(object):
@@ -12,36 +12,55 @@ class Acidity(object):
 
     nodata = 255  # uint8 data type
 
+    # columns of lnk_acidity which are combined in a key
+    _lookup_columns = ["rainwater", "mineral_richness", "inundation",
+                       "seepage", "soil_mlw_class"]
+
     def __init__(self, ct_acidity=None,
                  ct_soil_mlw_class=None,
                  ct_soil_codes=None,
                  lnk_acidity=None,
-                 ct_seepage=None):
+                 ct_seepage=None,
+                 ct_bundle=None):
+
+        if ct_bundle is not None:
+            set_code_tables(self, load_bundle(
+                "acidity", ct_bundle,
+                [ct_acidity, ct_soil_mlw_class, ct_soil_codes, lnk_acidity,
+                 ct_seepage]))
+            return
 
         if ct_acidity is None:
-            ct_acidity = resource_filename(
-             "niche_vlaanderen", "system_tables/acidity.csv")
+            ct_acidity = system_table("acidity.csv")
         if ct_soil_mlw_class is None:
-            ct_soil_mlw_class = resource_filename(
-             "niche_vlaanderen", "system_tables/soil_mlw_class.csv")
+            ct_soil_mlw_class = system_table("soil_mlw_class.csv")
         if ct_soil_codes is None:
-            ct_soil_codes = resource_filename(
-             "niche_vlaanderen", "system_tables/soil_codes.csv")
+            ct_soil_codes = system_table("soil_codes.csv")
         if lnk_acidity is None:
-            lnk_acidity = resource_filename(
-             "niche_vlaanderen", "system_tables/lnk_acidity.csv")
+            lnk_acidity = system_table("lnk_acidity.csv")
         if ct_seepage is None:
-            ct_seepage = resource_filename(
-             "niche_vlaanderen", "system_tables/seepage.csv")
+            ct_seepage = system_table("seepage.csv")
+
+        inner = all(v is None for v in self.__init__.__code__.co_varnames[1:])
 
+        tables = dict(ct_acidity=ct_acidity,
+                      ct_soil_mlw_class=ct_soil_mlw_class,
+                      ct_soil_codes=ct_soil_codes, lnk_acidity=lnk_acidity,
+                      ct_seepage=ct_seepage)
+        set_code_tables(self, load_code_tables(
+            "acidity", tables,
+            lambda: self._load_code_tables(inner=inner, **tables)))
+
+    def _load_code_tables(self, ct_acidity, ct_soil_mlw_class, ct_soil_codes,
+                          lnk_acidity, ct_seepage, inner):
+        """Reads, validates and compiles the code tables"""
+        import pandas as pd
         self._ct_acidity = pd.read_csv(ct_acidity)
         self._ct_soil_mlw = pd.read_csv(ct_soil_mlw_class)
         self._ct_soil_codes = pd.read_csv(ct_soil_codes)
         self._lnk_acidity = pd.read_csv(lnk_acidity)
         self._ct_seepage = pd.read_csv(ct_seepage)
 
-        inner = all(v is None for v in self.__init__.__code__.co_varnames[1:])
-
         validate_tables_acidity(ct_acidity=self._ct_acidity,
                                 ct_soil_mlw_class=self._ct_soil_mlw,
                                 ct_soil_codes=self._ct_soil_codes,
@@ -51,30 +70,66 @@ class Acidity(object):
 
         self._ct_soil_codes = self._ct_soil_codes.set_index("soil_code")
 
-    def _calculate_soil_mlw(self, soil_code, mlw):
-        check_codes_used("soil_code", soil_code, self._ct_soil_codes.index)
+        self._compile_lookup()
+        return dict(self.__dict__)
+
+    def _compile_lookup(self):
+        """Compiles lnk_acidity in a dense lookup table
 
-        # determine soil_group for soil_code
-        orig_shape = mlw.shape
-        soil_code = soil_code.flatten()
-        mlw = mlw.flatten()
-        soil_group = self._ct_soil_codes.soil_group.reindex(soil_code)\
+        Every combination of the codes of the lookup columns corresponds to
+        a position in the table, which contains the acidity. Combinations
+        which are not in lnk_acidity (including nodata) contain nodata.
+        """
+        self._codes = [np.sort(self._lnk_acidity[col].unique())
+                       for col in self._lookup_columns]
+        self._dims = [codes.size + 1 for codes in self._codes]
+
+        # only the first acidity is used for duplicate combinations
+        table = self._lnk_acidity.drop_duplicates(self._lookup_columns)
+        key = np.ravel_multi_index(
+            [code_index(table[col].values, codes)
+             for col, codes in zip(self._lookup_columns, self._codes)],
+            self._dims)
+
+        self._lookup = np.full(np.prod(self._dims), self.nodata,
+                               dtype="uint8")
+        self._lookup[key] = table.acidity.values
+
+    def _calculate_soil_mlw(self, soil_code, mlw, partition=None):
+        """Classify mlw per soil group
+
+        The partition (SoilPartition) of soil_code is created if it is not
+        given.
+        """
+        if partition is None:
+            partition = SoilPartition(soil_code)
+        check_codes_used("soil_code", partition.codes,
+                         self._ct_soil_codes.index)
+
+        mlw = partition.take(mlw)
+
+        # determine soil_group for the soil codes
+        soil_group = self._ct_soil_codes.soil_group.reindex(partition.codes)\
             .values.astype("int8")
         # the function above gives 0 for no data
         soil_group[soil_group == 0] = -99
 
-        result = np.full(soil_code.shape, -99)
-        for sel_group, subtable in self._ct_soil_mlw.groupby(["soil_group"]):
+        subtables = dict(
+            (sel_group, subtable.copy().reset_index(drop=True))
+            for sel_group, subtable in self._ct_soil_mlw.groupby(
+                ["soil_group"]))
 
-            subtable = subtable.copy().reset_index(drop=True)
-            index = np.digitize(mlw, subtable.mlw_max, right=True)
-            selection = (soil_group == sel_group)
-            result[selection] = \
-                subtable.soil_mlw_class.reindex(index)[selection]
+        result = np.full(mlw.shape, -99)
+        for (code, pixels), group in zip(partition.slices(),
+                                         soil_group.tolist()):
+            if group not in subtables:
+                continue
+            subtable = subtables[group]
+            index = np.digitize(mlw[pixels], subtable.mlw_max, right=True)
+            result[pixels] = subtable.soil_mlw_class.reindex(index)
 
         result[mlw == -99] = -99
-        result = result.reshape(orig_shape)
-        return result
+        return partition.put(result)
 
     def _get_acidity(self, rainwater, minerality, inundation, seepage,
                      soil_mlw_class):
@@ -89,26 +144,12 @@ class Acidity(object):
         check_codes_used("seepage", seepage,
                          self._ct_seepage["seepage"])
 
-        rainwater = rainwater.flatten()
-        minerality = minerality.flatten()
-        inundation = inundation.flatten()
-        seepage = seepage.flatten()
-        soil_mlw_class = soil_mlw_class.flatten()
-
-        result = np.full(soil_mlw_class.shape, self.nodata, dtype="uint8")
-        for labels, subtable in self._lnk_acidity.groupby(
-                ["rainwater", "mineral_richness", "inundation", "seepage",
-                 "soil_mlw_class"]):
-            sel_rainwater, sel_mr, sel_inundation, \
-                sel_seepage, sel_soil_mlw_class = labels
-            subtable = subtable.copy().reset_index(drop=True)
-
-            selection = ((rainwater == sel_rainwater)
-                         & (minerality == sel_mr)
-                         & (inundation == sel_inundation)
-                         & (seepage == sel_seepage)
-                         & (soil_mlw_class == sel_soil_mlw_class))
-            result[(selection)] = subtable.acidity[0]
+        values = [rainwater, minerality, inundation, seepage, soil_mlw_class]
+        key = np.ravel_multi_index(
+            [code_index(np.asarray(v).flatten(), codes)
+             for v, codes in zip(values, self._codes)],
+            self._dims)
+        result = self._lookup[key]
         result = result.reshape(orig_shape)
         return result
 
@@ -119,7 +160,6 @@ class Acidity(object):
         seepage = seepage.flatten()
         index = np.digitize(seepage, self._ct_seepage.seepage_max, right=True)
         seepage_class = self._ct_seepage.seepage.reindex(index)
-        seepage_class[(np.isnan(seepage) | (seepage == -99))]
         return seepage_class.values.reshape(orig_shape)
 
     def calculate(self, soil_class, mlw, inundation, seepage, minerality,
@@ -1,6 +1,6 @@
 import click
 import niche_vlaanderen
-from pkg_resources import resource_filename
+from niche_vlaanderen.codetables import system_table
 
 
 @click.command()
@@ -9,20 +9,20 @@ from pkg_resources import resource_filename
               help='prints an example configuration file')
 @click.option('--version', is_flag=True,
               help='prints the version number')
+@click.option('--workers', type=click.IntRange(min=1),
+              help='number of processes used to run the model')
 @click.argument('config', required=False, type=click.Path(exists=True))
-def cli(ctx, config, example, version):
+def cli(ctx, config, example, version, workers):
     """Command line interface to the NICHE vegetation model
     """
     if example:
-        ex = resource_filename(
-                "niche_vlaanderen",
-                "system_tables/example.yaml")
+        ex = system_table("example.yaml")
         with open(ex) as f:
             print(f.read())
 
     if config is not None:
         n = niche_vlaanderen.Niche()
-        n.run_config_file(config, overwrite_ct=True)
+        n.run_config_file(config, overwrite_ct=True, workers=workers)
         click.echo(n)
     if config is None and not example:
         # we should really find a neater way to show --help here by default.
@@ -1,6 +1,21 @@
 import numpy as np
 from .exception import NicheException
 import warnings
+import hashlib
+import json
+import os
+import sys
+import threading
+
+
+# folder with the code tables (and other data files) of the package
+_system_tables = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "system_tables")
+
+
+def system_table(*path):
+    """Path of a file in the system_tables folder of the package"""
+    return os.path.join(_system_tables, *path)
 
 
 class CodeTableException(Exception):
@@ -160,6 +175,29 @@ def validate_tables_flooding(depths, duration, frequency, lnk_potential,
     # check_join(lnk_potential, potential, "potential", "code")
 
 
+def code_index(used, codes):
+    """Looks up the position of values in a sorted array of codes
+
+    Parameters
+    ==========
+    used: array containing the values to look up
+    codes: sorted array containing the (unique) codes of a code table
+
+    Returns
+    =======
+    index: array with the same shape as used, containing the position of
+        every value in codes. Values which are not present in codes (including
+        nodata values) get index len(codes), so lookup tables can reserve an
+        extra (empty) slot for them.
+    """
+    codes = np.asarray(codes)
+    used = np.asarray(used)
+    index = np.asarray(np.searchsorted(codes, used))
+    found = codes[np.minimum(index, codes.size - 1)] == used
+    index[~found] = codes.size
+    return index
+
+
 def check_codes_used(name, used, allowed):
     """
 
@@ -182,3 +220,247 @@ def check_codes_used(name, used, allowed):
         msg += "used: %s\n" % str(used_codes)
         msg += "possible: %s" % str(allowed_codes)
         raise NicheException(msg)
+
+
+# compiled code tables, shared by all models of the process
+_registry = dict()
+_registry_lock = threading.Lock()
+
+
+def _file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _freeze(value):
+    """Makes the numpy arrays in value (or contained in it) read-only"""
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _freeze(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _freeze(v)
+
+
+def _instance(value):
+    """Copy of the compiled tables for a single model: the DataFrames, dicts
+    and lists are copied, so changing them does not change the tables of
+    other models. The (read-only) numpy arrays are shared."""
+    import pandas as pd
+    if isinstance(value, pd.DataFrame):
+        return value.copy()
+    elif isinstance(value, dict):
+        return type(value)((k, _instance(v)) for k, v in value.items())
+    elif isinstance(value, list):
+        return [_instance(v) for v in value]
+    return value
+
+
+def load_code_tables(model, tables, load):
+    """Compiled code tables, which are loaded once per process
+
+    Reading, validating and compiling the code tables of a model is done
+    only once for every set of code table files: the compiled tables are
+    kept in a registry which is keyed by the model, the paths of the files
+    and a hash of their contents (so a changed file is loaded again). The
+    warnings given while loading are repeated when the tables are reused.
+
+    Parameters
+    ==========
+    model: name of the model
+    tables: dict with the paths of the code table files
+    load: function which reads, validates and compiles the code tables and
+        returns the compiled tables (a dict of attributes of the model)
+
+    Returns
+    =======
+    tables: dict with the compiled tables. The numpy arrays in it are shared
+        by all models using the same files, so they are read-only. The
+        DataFrames, dicts and lists are copied for every model.
+    """
+    try:
+        key = (model,) + tuple(sorted(
+            (name, os.path.abspath(path), _file_hash(path))
+            for name, path in tables.items()))
+    except (TypeError, AttributeError, IOError, OSError):
+        # not a (readable) file: the errors are given by load
+        return load()
+
+    with _registry_lock:
+        if key not in _registry:
+            try:
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter("always")
+                    compiled = load()
+            except Exception:
+                _warn(caught)
+                raise
+            _freeze(compiled)
+            _registry[key] = compiled, caught
+        compiled, caught = _registry[key]
+
+    _warn(caught)
+    return _instance(compiled)
+
+
+def _warn(caught):
+    for w in caught:
+        warnings.warn(w.message, w.category)
+
+
+# version of the format of the code table bundles, changed when the compiled
+# tables of a model change
+bundle_version = 2
+
+
+def write_bundle(filename, models):
+    """Writes compiled code tables to a binary bundle (npz file)
+
+    Parameters
+    ==========
+    filename: path of the bundle
+    models: dict with the compiled tables (a dict of attributes) per model.
+        The tables can be numpy arrays, DataFrames, python values, or lists
+        and dicts (with string keys) of these.
+    """
+    arrays = dict()
+    specs = dict(
+        (model, dict((attr, _encode(arrays, model + "/" + attr, value))
+                     for attr, value in tables.items()))
+        for model, tables in models.items())
+    from .version import __version__
+    arrays["__meta__"] = np.array(json.dumps(dict(
+        bundle_version=bundle_version, version=__version__, models=specs)))
+    with open(filename, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def read_bundle(filename, model):
+    """Reads the compiled code tables of a model from a bundle
+
+    Parameters
+    ==========
+    filename: path of a bundle written by write_bundle
+    model: name of the model
+
+    Returns
+    =======
+    tables: dict with the compiled tables
+    """
+    with np.load(filename) as arrays:
+        meta = json.loads(_native(arrays["__meta__"].item()),
+                          object_hook=_native_keys)
+        if meta["bundle_version"] != bundle_version:
+            raise NicheException(
+                "Code table bundle {} has version {}, expected {}; compile "
+                "it again".format(filename, meta["bundle_version"],
+                                  bundle_version))
+        if model not in meta["models"]:
+            raise NicheException(
+                "Code table bundle {} contains no tables for {}".format(
+                    filename, model))
+        return dict(
+            (attr, _decode(arrays, _native(model + "/" + attr), spec))
+            for attr, spec in meta["models"][model].items())
+
+
+def _native(value):
+    """Converts (unicode or byte) strings to the str type of the python
+    version"""
+    if sys.version_info[0] < 3 and isinstance(value, unicode):  # noqa: F821
+        return value.encode("utf-8")
+    if sys.version_info[0] >= 3 and isinstance(value, bytes):
+        return value.decode("utf-8")
+    if isinstance(value, list):
+        return [_native(v) for v in value]
+    return value
+
+
+def _native_keys(value):
+    return dict((_native(k), _native(v)) for k, v in value.items())
+
+
+def _encode(arrays, key, value):
+    """Adds value to arrays and returns the specification to decode it"""
+    import pandas as pd
+    if isinstance(value, np.ndarray):
+        arrays[key] = value
+        return "array"
+    if isinstance(value, pd.DataFrame):
+        index = value.index.name
+        frame = value.reset_index() if index is not None else value
+        null = []
+        for i, col in enumerate(frame.columns):
+            values = frame[col].values
+            if values.dtype == object:
+                isnull = pd.isnull(values)
+                if np.any(isnull):
+                    arrays["{}/{}@null".format(key, i)] = isnull
+                    null.append(i)
+                # strings are stored as a numpy string type (not pickled)
+                values = np.array(["" if n else v
+                                   for v, n in zip(values, isnull)])
+            arrays["{}/{}".format(key, i)] = values
+        return dict(frame=list(frame.columns), index=index, null=null)
+    if isinstance(value, dict):
+        return dict(dict=dict((k, _encode(arrays, key + "/" + k, v))
+                              for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return dict(list=[_encode(arrays, "{}/{}".format(key, i), v)
+                          for i, v in enumerate(value)])
+    if isinstance(value, np.generic):
+        value = value.item()
+    return dict(value=value)
+
+
+def _decode(arrays, key, spec):
+    import pandas as pd
+    if spec == "array":
+        return arrays[key]
+    if "frame" in spec:
+        columns = spec["frame"]
+        data = dict()
+        for i, col in enumerate(columns):
+            values = arrays["{}/{}".format(key, i)]
+            if values.dtype.kind in "SU":
+                values = np.array(_native(values.tolist()), dtype=object)
+                if i in spec["null"]:
+                    values[arrays["{}/{}@null".format(key, i)]] = np.nan
+            data[col] = values
+        frame = pd.DataFrame(data, columns=columns)
+        if spec["index"] is not None:
+            frame = frame.set_index(spec["index"])
+        return frame
+    if "dict" in spec:
+        return dict((k, _decode(arrays, key + "/" + k, v))
+                    for k, v in spec["dict"].items())
+    if "list" in spec:
+        return [_decode(arrays, "{}/{}".format(key, i), v)
+                for i, v in enumerate(spec["list"])]
+    return spec["value"]
+
+
+def set_code_tables(model, compiled):
+    """Sets the compiled code tables as attributes of a model object"""
+    model.__dict__.update(compiled)
+    # kept to write them to a bundle
+    model._compiled_tables = compiled
+
+
+def load_bundle(model, ct_bundle, tables):
+    """Compiled code tables of a model from a bundle, loaded once per process
+
+    Parameters
+    ==========
+    model: name of the model
+    ct_bundle: path of the bundle
+    tables: the other code tables of the model, these must all be None as
+        the bundle contains all code tables
+    """
+    if any(v is not None for v in tables):
+        raise NicheException(
+            "A code table bundle can not be combined with other code tables")
+    return load_code_tables(model, dict(ct_bundle=ct_bundle),
+                            lambda: read_bundle(ct_bundle, model))
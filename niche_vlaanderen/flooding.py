@@ -1,24 +1,81 @@
 from __future__ import division
 
 import logging
-import rasterio
 import os
-from pkg_resources import resource_filename
 import copy
+import numbers
+import threading
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
-import pandas as pd
 import numpy as np
 import numpy.ma as ma
 
 from .spatial_context import SpatialContext
-from .codetables import validate_tables_flooding, check_codes_used
+from .codetables import validate_tables_flooding, check_codes_used, \
+    code_index, load_code_tables, load_bundle, set_code_tables, system_table
+from .writer import GridWriter
+from .zonal import Zones
 
 
 class FloodingException(Exception):
     """"""
 
 
+# the potential codes of a flooding model, with their rank when a number
+# of scenarios is reduced to the worst or best potential (the lowest rank):
+# nodata first, and no information last
+_potential_codes = np.array([-99, -1, 0, 1, 2, 3, 4], dtype="int16")
+_reductions = OrderedDict([
+    (None, None),
+    ("worst", np.array([0, 1, 2, 3, 4, 5, 6], dtype="int16")),
+    ("best", np.array([0, 5, 4, 3, 2, 1, 6], dtype="int16"))
+])
+
+
+def _reduced_options(scenarios):
+    """The options of a reduction of a number of scenarios: the value of
+    the scenarios if they are all the same, otherwise the values joined by
+    a +"""
+    options = dict()
+    for key in ("frequency", "duration", "period"):
+        values = list(OrderedDict.fromkeys(s[key] for s in scenarios))
+        options[key] = values[0] if len(values) == 1 \
+            else "+".join(str(v) for v in values)
+    return options
+
+
+def _combine_band(band, absent, nodata, out, scratch):
+    """Combines the potential of a vegetation type with the prediction of
+    niche, without allocating temporary grids
+
+    Parameters
+    ==========
+    band: potential of the vegetation type
+    absent: boolean grid, the vegetation type is not present according to
+        niche
+    nodata: boolean grid, the pixels without niche prediction
+    out: the combined grid, this can be band
+    scratch: boolean grid which is used to store the nodata pixels
+    """
+    np.equal(band, -99, out=scratch)
+    np.logical_or(scratch, nodata, out=scratch)
+    if out is not band:
+        np.copyto(out, band)
+    np.copyto(out, -1, where=absent)
+    np.copyto(out, -99, where=scratch)
+
+
+def _read_niche_grid(filename, absent, nodata):
+    """Reads a vegetation grid written by niche to the boolean grids absent
+    (the vegetation type is not present) and nodata"""
+    import rasterio
+    with rasterio.open(filename) as src:
+        niche = src.read(1)
+        np.not_equal(niche, 1, out=absent)
+        np.equal(niche, src.nodatavals[0], out=nodata)
+
+
 class Flooding(object):
     """
     Predict the vegetation response to (frequent) flooding
@@ -26,43 +83,128 @@ class Flooding(object):
     A Flooding object can be used to predict the response of vegetation to
     (frequent) flooding.
 
-    The code tables used can be overwritten when initializing the object.
+    The code tables used can be overwritten when initializing the object,
+    also by a bundle of compiled code tables (ct_bundle).
     Optionally also a name can be given which is used in plots and output
     files.
 
     """
     def __init__(self, depths=None, duration=None, frequency=None,
-                 lnk_potential=None, potential=None, name=""):
-        self._ct = dict()
+                 lnk_potential=None, potential=None, name="", ct_bundle=None):
         self._veg = dict()
         self._log = logging.getLogger("niche_vlaanderen")
+        self.name = name
+        # Set to true when the model is a combined niche - flooding model
+        self._combined = False
 
+        if ct_bundle is not None:
+            set_code_tables(self, load_bundle(
+                "flooding", ct_bundle,
+                [depths, duration, frequency, lnk_potential, potential]))
+            return
+
+        tables = dict()
         for i in ["depths", "duration", "frequency", "lnk_potential",
                   "potential"]:
             if locals()[i] is None:
-                ct = resource_filename(
-                        "niche_vlaanderen",
-                        "system_tables/flooding/"+i+".csv")
+                ct = system_table("flooding", i + ".csv")
             else:
                 ct = locals()[i]
-            self._ct[i] = pd.read_csv(ct)
-        self.name = name
+            tables[i] = ct
 
         inner = all(v is None for v in self.__init__.__code__.co_varnames[1:])
 
-        validate_tables_flooding(inner=inner, **self._ct)
-
-        # Set to true when the model is a combined niche - flooding model
-        self._combined = False
+        set_code_tables(self, load_code_tables(
+            "flooding", tables,
+            lambda: self._load_code_tables(inner, tables)))
+
+    def _load_code_tables(self, inner, tables):
+        """Reads and validates the code tables"""
+        import pandas as pd
+        ct = dict((i, pd.read_csv(tables[i])) for i in tables)
+        validate_tables_flooding(inner=inner, **ct)
+        compiled = dict(_ct=ct)
+        compiled.update(self._compile_potential(ct["lnk_potential"],
+                                                ct["depths"],
+                                                ct["potential"]))
+        return compiled
+
+    @staticmethod
+    def _compile_potential(lnk_potential, depths, potential):
+        """Compiles lnk_potential to a dense lookup table
+
+        _lookup[scenario, veg, depth] is the potential of vegetation type
+        _veg_codes[veg] for the depth code _depth_codes[depth] in the
+        scenario (period, frequency, duration) _scenarios[scenario].
+
+        The last depth index is used for nodata (and contains -99) and the
+        last scenario, which is not in _scenarios, is used for scenarios
+        which are not in lnk_potential. By default the potential is 4 (no
+        information/flooding, see
+        https://github.com/inbo/niche_vlaanderen/issues/87).
+
+        The potential codes must be known (_potential_codes), as they are
+        ranked when scenarios are reduced.
+        """
+        for table in (lnk_potential["potential"], potential["code"]):
+            unknown = set(table.tolist()) - set(_potential_codes.tolist())
+            if len(unknown) > 0:
+                raise FloodingException(
+                    "Unknown potential codes {}, possible: {}".format(
+                        sorted(unknown), _potential_codes.tolist()))
+
+        veg_codes = np.unique(lnk_potential["veg_code"].values)
+        depth_codes = np.unique(depths["code"].values)
+        columns = ["period", "frequency", "duration"]
+        scenarios = lnk_potential[columns].drop_duplicates()
+        scenarios = [[period, frequency, int(duration)]
+                     for period, frequency, duration in scenarios.values]
+
+        lookup = np.full((len(scenarios) + 1, veg_codes.size,
+                          depth_codes.size + 1), 4, dtype="int16")
+        lookup[:, :, -1] = -99
+
+        index = dict((tuple(scenario), i)
+                     for i, scenario in enumerate(scenarios))
+        scenario = [index[key] for key in
+                    zip(*(lnk_potential[c].tolist() for c in columns))]
+        veg = code_index(lnk_potential["veg_code"].values, veg_codes)
+        depth = code_index(lnk_potential["depth"].values, depth_codes)
+        # depths which are not in the depth table can not be used
+        known = depth < depth_codes.size
+        # when there are duplicate rows the last one is used
+        lookup[np.array(scenario)[known], veg[known], depth[known]] = \
+            lnk_potential["potential"].values[known]
+
+        return dict(_lookup=lookup, _veg_codes=veg_codes,
+                    _depth_codes=depth_codes, _scenarios=scenarios)
+
+    def _scenario_index(self, frequency, duration, period):
+        """Position of a scenario in the lookup table"""
+        for i, scenario in enumerate(self._scenarios):
+            if tuple(scenario) == (period, frequency, duration):
+                return i
+        return len(self._scenarios)
 
     @property
     def vegetation_calculated(self):
         return len(self._veg) > 0
 
+    def _labels(self):
+        """Description of the potential codes used by the model"""
+        labels = dict(self._ct["potential"].set_index("code")["description"])
+
+        if not self._combined:
+            del labels[-1]
+
+        labels[-99] = "no data"
+        return labels
+
     @property
     def table(self):
         """Dataframe containing the potential area (ha) per vegetation type
         """
+        import pandas as pd
         if not self.vegetation_calculated:
             raise FloodingException(
                 "Error: You must run niche prior to requesting the "
@@ -70,12 +212,7 @@ class Flooding(object):
 
         td = list()
 
-        labels = dict(self._ct["potential"].set_index("code")["description"])
-
-        if not self._combined:
-            del labels[-1]
-
-        labels[-99] = "no data"
+        labels = self._labels()
 
         for i in self._veg:
             vi = pd.Series(self._veg[i].flatten())
@@ -88,17 +225,7 @@ class Flooding(object):
 
         return df
 
-    def _calculate(self, depth, frequency, duration, period):
-        """
-        Low level calculation of a flooding object.
-        Uses a numpy array for depth rather than a grid file (in calculate)
-        """
-        orig_shape = depth.shape
-        depth = depth.flatten()
-        nodata = (depth == -99)
-
-        check_codes_used("depth", depth,
-                         self._ct["depths"]["code"])
+    def _check_scenario(self, frequency, duration, period):
         check_codes_used("frequency", frequency,
                          self._ct["frequency"]["code"])
         check_codes_used("duration", duration,
@@ -106,23 +233,87 @@ class Flooding(object):
         check_codes_used("period", period,
                          ["summer", "winter"])
 
-        for veg_code, subtable_veg in \
-                self._ct["lnk_potential"].groupby(["veg_code"]):
-            subtable_veg = subtable_veg.reset_index()
-            # by default we give code 4 (no information/flooding)
-            # https://github.com/inbo/niche_vlaanderen/issues/87
-            self._veg[veg_code] = np.full(depth.shape, 4, dtype="int16")
-            self._veg[veg_code][nodata] = -99
-            groupby_cols = ["period", "frequency", "duration"]
-            for index, subtable in subtable_veg.groupby(groupby_cols):
-                if (period, frequency, duration) == index:
-                    subtable.reset_index()
-                    for row in subtable.itertuples():
-                        veg = self._veg[veg_code]
-                        veg[row.depth == depth] = row.potential
-                        self._veg[veg_code] = np.maximum(veg,
-                                                         self._veg[veg_code])
-            self._veg[veg_code] = self._veg[veg_code].reshape(orig_shape)
+    def _depth_index(self, depth):
+        """Position of the depth codes in the lookup table"""
+        check_codes_used("depth", depth,
+                         self._ct["depths"]["code"])
+        return code_index(depth, self._depth_codes)
+
+    def _scenario_bands(self, index, frequency, duration, period,
+                        rank=None):
+        """The potential of all vegetation types, as a single grid with a
+        band per vegetation type, for the depth index of a scenario
+
+        If rank is given, the rank of the potential codes (see _reductions)
+        is returned rather than the potential.
+        """
+        # nodata (and unknown depths) use the last column of the table
+        table = self._lookup[self._scenario_index(frequency, duration,
+                                                  period)]
+        if rank is not None:
+            table = rank.take(np.searchsorted(_potential_codes, table))
+        return table.take(index, axis=1)
+
+    def _set_bands(self, bands):
+        self._bands = bands
+        self._veg = dict((veg_code, bands[i]) for i, veg_code
+                         in enumerate(self._veg_codes.tolist()))
+
+    def zonal_stats(self, vectors, outside=True, attribute=None):
+        """Calculates zonal statistics using vectors
+
+        Parameters
+        ==========
+        vectors: path to a vector source or geo-like python objects
+            The shapes, see :func:`niche_vlaanderen.Niche.zonal_stats`.
+        outside: bool (default: True)
+           report values outside shapes as well. The area which is not covered
+           by any shapefile will get shape_id -1.
+        attribute: string(default None):
+            attribute of the vector source that will be exported along in the
+            table.
+
+        Returns
+        =======
+        table: pandas.DataFrame
+        """
+        if not self.vegetation_calculated:
+            raise FloodingException(
+                "Error: You must run the flooding model prior to calculating "
+                "zonal statistics")
+
+        labels = self._labels()
+        codes = sorted(labels)
+
+        zones = Zones(vectors, self._context)
+        counts = zones.counts(zones.take(self._bands), codes)
+
+        return zones.table(counts, self._veg_codes.tolist(),
+                           [labels[code] for code in codes],
+                           self._context.cell_area, attribute,
+                           self.table if outside else None)
+
+    def _calculate(self, depth, frequency, duration, period):
+        """
+        Low level calculation of a flooding object.
+        Uses a numpy array for depth rather than a grid file (in calculate)
+        """
+        index = self._depth_index(depth)
+        self._check_scenario(frequency, duration, period)
+        self._set_bands(self._scenario_bands(index, frequency, duration,
+                                             period))
+
+    @staticmethod
+    def _read_depth(depth_file):
+        """Reads a depth grid, nodata values are converted to -99"""
+        import rasterio
+        with rasterio.open(depth_file, "r") as dst:
+            depth = dst.read(1)
+            context = SpatialContext(dst)
+            if depth.dtype.kind == 'u':
+                depth = depth.astype(int)
+            depth[depth == dst.nodatavals[0]] = -99
+        return depth, context
 
     def calculate(self, depth_file, frequency, period, duration):
         """ Calculate a floodplain object
@@ -148,18 +339,160 @@ class Flooding(object):
 
 
         """
-        with rasterio.open(depth_file, "r") as dst:
-            depth = dst.read(1)
-            self._context = SpatialContext(dst)
-            if depth.dtype.kind == 'u':
-                depth = depth.astype(int)
-            depth[depth == dst.nodatavals[0]] = -99
+        depth, self._context = self._read_depth(depth_file)
         self._calculate(depth, frequency, duration, period)
 
         self.options = {'frequency': frequency,
                         "duration": duration,
                         "period": period}
 
+    def calculate_many(self, scenarios, reduce=None, workers=1, name=""):
+        """ Calculate a number of flooding scenarios
+
+        The scenarios share the code tables, and every depth file is read
+        and decoded only once, also when it is used by more than one
+        scenario. The scenarios are calculated by a pool of threads, the
+        scenarios of a depth file one after the other, so a decoded depth
+        file is released after its last scenario. At most two scenarios per
+        thread are calculated (or waiting to be reduced) at the same time.
+
+        Parameters
+        ==========
+        scenarios: list
+            The scenarios, as dicts with the depth file (``depth``),
+            ``frequency``, ``period``, ``duration`` and optionally a
+            ``name``, like the flooding scenarios of a configuration file.
+
+        reduce: None|worst|best
+            By default a Flooding object is returned for every scenario.
+            With "worst" ("best") a single Flooding object is returned, with
+            the lowest (highest) potential of all scenarios per pixel. "no
+            information" (4) is only used when no scenario has information
+            for a pixel, and a pixel is nodata when it is nodata in any
+            scenario. The scenarios are reduced while they are calculated,
+            so their results are not kept in memory.
+
+        workers: int
+            Number of scenarios which are calculated at the same time.
+
+        name: str
+            Name of the reduced Flooding object.
+
+        Returns
+        =======
+        result: list of Flooding or Flooding
+        """
+        if reduce not in _reductions:
+            raise FloodingException(
+                "Invalid reduction {}, possible: {}".format(
+                    reduce, ", ".join(str(r) for r in _reductions)))
+        if not isinstance(workers, numbers.Integral) or workers < 1:
+            raise FloodingException(
+                "Error, the number of workers must be a positive integer")
+        if len(scenarios) == 0:
+            raise FloodingException("No flooding scenarios given")
+
+        for scenario in scenarios:
+            self._check_scenario(scenario["frequency"], scenario["duration"],
+                                 scenario["period"])
+
+        # the scenarios grouped by depth file
+        files = list(OrderedDict.fromkeys(s["depth"] for s in scenarios))
+        order = sorted(range(len(scenarios)),
+                       key=lambda i: files.index(scenarios[i]["depth"]))
+        remaining = dict((f, sum(1 for s in scenarios if s["depth"] == f))
+                         for f in files)
+        decoded = dict()
+        file_locks = dict((f, threading.Lock()) for f in files)
+        lock = threading.Lock()
+
+        def depth_index(depth_file):
+            # the depth file is decoded by the first thread which uses it
+            with file_locks[depth_file]:
+                if depth_file not in decoded:
+                    depth, context = self._read_depth(depth_file)
+                    decoded[depth_file] = self._depth_index(depth), context
+                return decoded[depth_file]
+
+        rank = _reductions[reduce]
+
+        def calculate(i):
+            scenario = scenarios[i]
+            index, context = depth_index(scenario["depth"])
+            bands = self._scenario_bands(
+                index, scenario["frequency"], scenario["duration"],
+                scenario["period"], rank)
+            with lock:
+                remaining[scenario["depth"]] -= 1
+                if remaining[scenario["depth"]] == 0:
+                    del decoded[scenario["depth"]]
+            return i, bands, context
+
+        # limits the number of results which are calculated, but not yet
+        # handled
+        slots = threading.Semaphore(2 * workers)
+        stopped = threading.Event()
+
+        def bounded(items):
+            for item in items:
+                slots.acquire()
+                if stopped.is_set():
+                    return
+                yield item
+
+        pool = ThreadPool(workers) if workers > 1 else None
+        try:
+            if pool is not None:
+                results = pool.imap_unordered(calculate, bounded(order))
+            else:
+                results = (calculate(i) for i in bounded(order))
+
+            if reduce is None:
+                flooding = [None] * len(scenarios)
+                for i, bands, context in results:
+                    scenario = scenarios[i]
+                    flooding[i] = self._result(bands, context, scenario,
+                                               scenario.get("name", ""))
+                    slots.release()
+                return flooding
+
+            # the scenarios are reduced in any order
+            reduced = None
+            for i, bands, context in results:
+                if reduced is None:
+                    reduced, reduced_context = bands, context
+                elif context != reduced_context:
+                    raise FloodingException(
+                        "The depth files have a different spatial context")
+                else:
+                    np.minimum(reduced, bands, out=reduced)
+                slots.release()
+
+            # the potential code of every rank
+            reduced = _potential_codes[np.argsort(rank)].take(reduced)
+            return self._result(reduced, reduced_context,
+                                _reduced_options(scenarios), name)
+        finally:
+            # no more scenarios are started, also when the thread which
+            # starts them is waiting for a slot
+            stopped.set()
+            for _ in order:
+                slots.release()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def _result(self, bands, context, scenario, name):
+        """A Flooding object with the result of a scenario"""
+        new = copy.copy(self)
+        new.name = name
+        new._combined = False
+        new._context = context
+        new._set_bands(bands)
+        new.options = dict((key, scenario[key])
+                           for key in ("frequency", "duration", "period"))
+        return new
+
     def plot(self, key, ax=None):
         try:
             import matplotlib.pyplot as plt
@@ -205,7 +538,7 @@ class Flooding(object):
 
         return ax
 
-    def write(self, folder, overwrite_files=False):
+    def write(self, folder, overwrite_files=False, writer=None):
         """ Writes the floodplain grids to grid files.
 
          The differences are coded using the values specified in the
@@ -221,6 +554,11 @@ class Flooding(object):
             Overwrite files when saving.
             Note writing will fail if any of the files to be written already
             exists.
+
+         writer: GridWriter
+            Compression, tiling and number of threads used to write the
+            files. By default DEFLATE compressed files are written by a
+            single thread.
          """
         if len(self._veg) == 0:
             raise FloodingException(
@@ -229,17 +567,9 @@ class Flooding(object):
         if not os.path.exists(folder):
             os.makedirs(folder)
 
-        params = dict(
-            driver='GTiff',
-            height=self._context.height,
-            width=self._context.width,
-            crs=self._context.crs,
-            transform=self._context.transform,
-            count=1,
-            dtype="int16",
-            nodata=-99,
-            compress="DEFLATE"
-        )
+        if writer is None:
+            writer = GridWriter()
+        params = writer.profile(self._context, "int16", -99)
 
         self._files_written = dict()
         name = ""
@@ -268,13 +598,11 @@ class Flooding(object):
 
         self.table.to_csv(files["summary"], index=False)
 
+        writer.write((files[vi], params, self._veg[vi]) for vi in self._veg)
         for vi in self._veg:
-            path = files[vi]
-            with rasterio.open(path, 'w', **params) as dst:
-                dst.write(self._veg[vi], 1)
-                self._files_written[filename] = os.path.normpath(path)
+            self._files_written[vi] = os.path.normpath(files[vi])
 
-    def combine(self, niche_result):
+    def combine(self, niche_result, out=None, inplace=False):
         """Combines a Flooding model with a Niche model
 
         Both models must be run prior to combining them. The niche model will
@@ -284,15 +612,29 @@ class Flooding(object):
         Parameters
         ==========
         niche_result: Niche
-            Niche model that must be run prior to running combine.
+            Niche model that must be run prior to running combine. When the
+            model was run in blocks, its written vegetation grids are read
+            (one at a time).
+
+        out: numpy.array
+            int16 array with a band per vegetation type (vegetation types,
+            rows, columns), eg a numpy.memmap, to which the result is
+            written. By default a new array is used.
+
+        inplace: bool
+            The result is written to the grids of this Flooding model, which
+            is combined (and returned) rather than a new model.
 
         Returns
         =======
         combined: Flooding
         """
 
-        # check niche model has been run
-        if not niche_result.vegetation_calculated:
+        # check niche model has been run, a model run in blocks only keeps
+        # the pixel counts and the written grids
+        in_blocks = not niche_result.vegetation_calculated \
+            and len(niche_result._counts) > 0
+        if not niche_result.vegetation_calculated and not in_blocks:
             raise FloodingException(
                 "Niche model must be run prior to running this module.")
 
@@ -306,15 +648,144 @@ class Flooding(object):
                 str(self._context) + str(niche_result._context)
                 )
 
-        new = copy.copy(self)
-        new._veg = self._veg.copy()
-        for vi in new._veg:
-            nodata = ((niche_result._vegetation[vi] == 255) |
-                      (new._veg[vi] == -99))
-            new._veg[vi] = niche_result._vegetation[vi] * new._veg[vi]
-            new._veg[vi][niche_result._vegetation[vi] == 0] = -1
-            new._veg[vi][nodata] = -99
-
+        if inplace:
+            if out is not None:
+                raise FloodingException(
+                    "An output array can not be used to combine in place")
+            out = self._bands
+        elif out is None:
+            out = np.empty_like(self._bands)
+        elif out.shape != self._bands.shape or out.dtype != "int16":
+            raise FloodingException(
+                "The output array must be of type int16 with shape "
+                "{}".format(self._bands.shape))
+
+        veg_codes = self._veg_codes.tolist()
+        if in_blocks:
+            missing = [vi for vi in veg_codes
+                       if vi not in niche_result._files_written]
+            if len(missing) > 0:
+                raise FloodingException(
+                    "Vegetation types without niche grid: {}".format(
+                        missing))
+
+        vegetation = niche_result._vegetation
+        shape = self._bands.shape[1:]
+        absent = np.empty(shape, dtype="bool")
+        scratch = np.empty(shape, dtype="bool")
+        if in_blocks:
+            nodata = np.empty(shape, dtype="bool")
+        else:
+            nodata = vegetation.nodata
+        for i, vi in enumerate(veg_codes):
+            if in_blocks:
+                _read_niche_grid(niche_result._files_written[vi], absent,
+                                 nodata)
+            else:
+                vegetation.present(vi, out=absent)
+                np.logical_not(absent, out=absent)
+            band = self._bands[i]
+            _combine_band(band, absent, nodata,
+                          band if inplace else out[i], scratch)
+
+        new = self if inplace else copy.copy(self)
+        new._set_bands(out)
         new._combined = True
 
         return new
+
+    @staticmethod
+    def combine_files(niche_files, flooding_files, folder,
+                      block_size=(1024, 1024), overwrite_files=False,
+                      writer=None):
+        """Combines the grid files of a Niche and a Flooding model
+
+        Like combine, but the grid files written by a Niche and a Flooding
+        model are read, combined and written block by block, so the grids
+        are never completely in memory.
+
+        Parameters
+        ==========
+        niche_files: dict
+            The vegetation grid files of the Niche model per vegetation type
+            (as in the files_written of the Niche model).
+
+        flooding_files: dict
+            The grid files of the Flooding model per vegetation type. Every
+            vegetation type must also be in niche_files.
+
+        folder: path
+            Path to which the combined grids are written, using the file
+            names of the flooding grids.
+
+        block_size: (int, int)
+            Maximum number of rows and columns of a block.
+
+        overwrite_files: bool
+            Overwrite files when saving.
+
+        writer: GridWriter
+            Compression and tiling of the files. The files are always tiled,
+            so blocks can be written independently.
+
+        Returns
+        =======
+        files: dict
+            The combined grid files per vegetation type
+        """
+        import rasterio
+
+        missing = set(flooding_files) - set(niche_files)
+        if len(missing) > 0:
+            raise FloodingException(
+                "Vegetation types without niche grid: {}".format(
+                    sorted(missing)))
+
+        files = dict((vi, os.path.join(folder, os.path.basename(
+            flooding_files[vi]))) for vi in flooding_files)
+        for vi in files:
+            if os.path.abspath(files[vi]) == \
+                    os.path.abspath(flooding_files[vi]):
+                raise FloodingException(
+                    "File {} can not be combined in place".format(files[vi]))
+            if os.path.exists(files[vi]) and not overwrite_files:
+                raise FloodingException(
+                    "File {} already exists".format(files[vi]))
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        if writer is None:
+            writer = GridWriter()
+        tiles = dict(tiled=True, blockxsize=writer.blocksize,
+                     blockysize=writer.blocksize)
+
+        for vi in sorted(files):
+            with rasterio.open(niche_files[vi]) as niche_dst, \
+                    rasterio.open(flooding_files[vi]) as flooding_dst:
+                context = SpatialContext(flooding_dst)
+                if context != SpatialContext(niche_dst):
+                    raise FloodingException(
+                        "Niche grid {} has a different spatial context"
+                        .format(niche_files[vi]))
+                niche_nodata = niche_dst.nodatavals[0]
+
+                # buffers which are reused for every block
+                shape = (min(block_size[0], context.height),
+                         min(block_size[1], context.width))
+                buffers = [np.empty(shape, dtype="bool") for _ in range(3)]
+
+                with rasterio.open(files[vi], "w", **writer.profile(
+                        context, "int16", -99, **tiles)) as dst:
+                    for block in context.blocks(block_size):
+                        band = flooding_dst.read(1, window=block)
+                        niche = niche_dst.read(1, window=block)
+                        absent, nodata, scratch = (
+                            b[:band.shape[0], :band.shape[1]]
+                            for b in buffers)
+                        np.not_equal(niche, 1, out=absent)
+                        np.equal(niche, niche_nodata, out=nodata)
+                        _combine_band(band, absent, nodata, band, scratch)
+                        dst.write(band, 1, window=block)
+
+        return dict((vi, os.path.normpath(files[vi])) for vi in files)
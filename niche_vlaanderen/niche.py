@@ -1,29 +1,40 @@
-import rasterio
-import rasterstats
 import warnings
 import inspect
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import hashlib
+import tempfile
+import copy
+import time
+from contextlib import closing, contextmanager
 
 import numpy as np
 import numpy.ma as ma
-import pandas as pd
 
-from .vegetation import Vegetation
+from .vegetation import Vegetation, PackedVegetation
 from .acidity import Acidity
+from .partition import SoilPartition
 from .nutrient_level import NutrientLevel
 from .spatial_context import SpatialContext
 from .version import __version__
 from .flooding import Flooding
+from .writer import GridWriter
+from .zonal import Zones
+from .codetables import write_bundle
 from .exception import NicheException
 
-from pkg_resources import resource_filename
-
 import logging
 import os.path
 import numbers
-import yaml
 import datetime
 import sys
 
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # not available on Windows
+    resource = None
+
 _allowed_input = {
     "soil_code", "mlw", "msw", "mhw", "seepage",
     "inundation_acidity", "inundation_nutrient", "nitrogen_atmospheric",
@@ -50,9 +61,61 @@ def minimal_input():  # pragma: no cover
 
 _abiotic_keys = {"nutrient_level", "acidity"}
 
+# input layers which are read as float32
+_float_inputs = ("nitrogen_animal", "nitrogen_fertilizer",
+                 "nitrogen_atmospheric", "mhw", "mlw", "msw")
+
+# stages of the model, with the input layers and stages they depend on
+_stages = {
+    "soil_partition": {"soil_code"},
+    "mineralisation": {"soil_partition", "soil_code", "msw"},
+    "nutrient_level": {"mineralisation", "soil_partition", "soil_code",
+                       "nitrogen_atmospheric", "nitrogen_animal",
+                       "nitrogen_fertilizer", "management",
+                       "inundation_nutrient"},
+    "soil_mlw": {"soil_partition", "soil_code", "mlw"},
+    "seepage_class": {"seepage"},
+    "acidity": {"soil_mlw", "seepage_class", "inundation_acidity",
+                "minerality", "rainwater"},
+    "input_nodata": {"soil_code", "mhw", "mlw", "inundation_vegetation",
+                     "management_vegetation"},
+    "vegetation": {"soil_partition", "input_nodata", "soil_code", "mhw",
+                   "mlw", "nutrient_level", "acidity",
+                   "inundation_vegetation", "management_vegetation"},
+    "deviation": {"soil_code", "mhw", "mlw"}
+}
+
+
+def _peak_rss():
+    """Returns the peak memory use (resident set size) of the process in MB
+
+    Returns None if this can not be determined on the platform.
+    """
+    if resource is None:  # pragma: no cover
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, in kilobytes on other systems
+    if sys.platform == "darwin":  # pragma: no cover
+        return peak / 2.0 ** 20
+    return peak / 2.0 ** 10
+
+
+def _downstream(key):
+    """Returns the stages which (indirectly) depend on an input layer or
+    stage
+    """
+    stages = set()
+    changed = {key}
+    while changed:
+        changed = set(stage for stage in _stages
+                      if _stages[stage] & changed) - stages
+        stages |= changed
+    return stages
+
+
 _code_tables = ["ct_acidity", "ct_soil_mlw_class", "ct_soil_codes",
                 "lnk_acidity", "ct_seepage", "ct_vegetation", "ct_management",
-                "ct_nutrient_level", "ct_mineralisation"]
+                "ct_nutrient_level", "ct_mineralisation", "ct_bundle"]
 _code_tables_fp = ["duration",
                    "frequency", "lnk_potential", "potential"]
 
@@ -72,12 +135,23 @@ class Niche(object):
         ct_* lnk_*: path
           Optionally, paths to codetables can be provided. These will override
           the standard codetables used by Niche.
+        ct_bundle: path
+          Optionally, a bundle of compiled code tables (written by
+          compile_code_tables), which is used instead of the separate
+          codetables.
+        cache_dir: path
+          Optionally, a directory in which the input grids are cached after
+          reading them. Later runs (also of other Niche objects using the
+          same cache_dir) memory map the cached grids rather than reading
+          the input files again. Input files which are changed are read
+          again.
 
     """
     def __init__(self, ct_acidity=None, ct_soil_mlw_class=None,
                  ct_soil_codes=None, lnk_acidity=None, ct_seepage=None,
                  ct_vegetation=None, ct_management=None,
-                 ct_nutrient_level=None, ct_mineralisation=None):
+                 ct_nutrient_level=None, ct_mineralisation=None,
+                 cache_dir=None, ct_bundle=None):
         self._inputfiles = dict()
         self._inputvalues = dict()
         self._inputarray = dict()
@@ -88,16 +162,46 @@ class Niche(object):
         self._options = dict()
         self._options["name"] = ""
         self._options["strict_checks"] = True
+        if cache_dir is not None:
+            self._options["cache_dir"] = cache_dir
         self._files_written = dict()
+        # pixel counts per vegetation type, when the model is run in blocks
+        self._counts = dict()
+        # results of the model stages of the last run, which are still valid
+        self._stages = dict()
+        self._stage_options = None
+        # whether the soil code grid uses the old soil codes, determined for
+        # the whole model extent before a run in blocks or tiles
+        self._old_soil_codes = None
         self._log = logging.getLogger("niche_vlaanderen")
         self._context = None
         self.occurrence = None
+        # wall time, cpu time and growth of the peak memory use per stage of
+        # the last run
+        self.timings = dict()
+        # optional function called after every timed stage
+        self.timing_hook = None
 
         for k in _code_tables:
             ct = locals()[k]
             if ct is not None:
                 self._set_ct(k, ct)
 
+    def __getstate__(self):
+        # used to pass the model to worker processes: results and the logger
+        # are not passed.
+        state = self.__dict__.copy()
+        del state["_log"]
+        state["timing_hook"] = None
+        state.pop("fp", None)
+        for key in ("_inputarray", "_abiotic", "_vegetation", "_deviation"):
+            state[key] = dict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._log = logging.getLogger("niche_vlaanderen")
+
     @property
     def name(self):
         return self._options["name"]
@@ -107,6 +211,9 @@ class Niche(object):
         self._options["name"] = str(name)
 
     def __repr__(self):
+        import rasterio
+        import pandas as pd
+        import yaml
         s = "# Niche Vlaanderen version: {}\n".format(__version__)
         s += "# Run at: {}\n\n".format(datetime.datetime.now())
         # Also add some versions of the major packages we use - easy for
@@ -140,11 +247,19 @@ class Niche(object):
             if len(self._inputvalues) > 0 else ""
         s += indent(input, "  ")
 
-        if self.vegetation_calculated:
+        if self.vegetation_calculated or len(self._counts) > 0:
             s += "# Model run completed"
         else:
             s += "# No model run completed."
 
+        if len(self.timings) > 0:
+            timings = dict(
+                (stage, dict((k, round(v, 3) if isinstance(v, float) else v)
+                             for k, v in record.items()))
+                for stage, record in self.timings.items())
+            s += "\ntimings:\n"
+            s += indent(yaml.dump(timings, default_flow_style=False), "  ")
+
         if len(self._files_written) > 0:
             s += "\nfiles_written:\n"
             s += indent(
@@ -160,6 +275,7 @@ class Niche(object):
             raise NicheException("Cannot find file %s" % key)
 
         self._code_tables[key] = value
+        self._stages.clear()
 
     def set_input(self, key, value):
         """ Adds a raster or numeric value as input layer
@@ -177,15 +293,15 @@ class Niche(object):
             everywhere.
 
         """
+        import rasterio
 
         # check type is valid value from list
         if (key not in _allowed_input):
             raise NicheException("Unrecognized type %s" % key)
 
-        if self.vegetation_calculated:
-            self._log.warning("Setting new input after model run, "
-                              "clearing results")
-            self._clear_result()
+        calculated = self.vegetation_calculated
+        # only the stages depending on this input must be calculated again
+        cleared = _downstream(key)
 
         if isinstance(value, numbers.Number):
             # Remove any existing values to make sure last value is used
@@ -199,11 +315,25 @@ class Niche(object):
                 self._context = sc_new
             else:
                 if self._context != sc_new:
+                    extent = self._context.extent
                     self._context.set_overlap(sc_new)
+                    if extent != self._context.extent:
+                        # all grids must be read again
+                        self._inputarray.clear()
+                        cleared = set(_stages)
             # Remove any existing values to make sure last value is used
             self._inputvalues.pop(key, None)
             self._inputfiles[key] = value
 
+        if calculated:
+            self._log.warning(
+                "Setting new input {} after model run, the results of {} "
+                "are recalculated on the next run".format(
+                    key, ", ".join(sorted(cleared))))
+
+        self._inputarray.pop(key, None)
+        self._clear_result(cleared)
+
     def read_config_file(self, config, overwrite_ct=False):
         """ Sets the input based on an input file, without running it
 
@@ -214,6 +344,7 @@ class Niche(object):
                Allows the user to override the default codetables (after
                the class has been initialized).
         """
+        import yaml
         with open(config, 'r') as stream:
             config_loaded = yaml.safe_load(stream)
 
@@ -246,6 +377,12 @@ class Niche(object):
             if "abiotic" in config_loaded["model_options"].keys():
                 self._options["abiotic"] = \
                     config_loaded["model_options"]["abiotic"]
+            if "cache_dir" in config_loaded["model_options"].keys():
+                self._options["cache_dir"] = \
+                    config_loaded["model_options"]["cache_dir"]
+            for key in ("output_format", "abiotic_bands", "writer"):
+                if key in config_loaded["model_options"].keys():
+                    self._options[key] = config_loaded["model_options"][key]
 
         if "flooding" in config_loaded.keys():
             self._options["flooding"] = []
@@ -255,7 +392,7 @@ class Niche(object):
                                   "duration"]}
                 self._options["flooding"].append(scen)
 
-    def run_config_file(self, config, overwrite_ct=False):
+    def run_config_file(self, config, overwrite_ct=False, workers=None):
         """ Runs Niche using a configuration file
 
         This will configure the model, run and output as specified.
@@ -266,7 +403,12 @@ class Niche(object):
             overwrite_ct: boolean (False)
                overwrite codetables using the values specified in
                the configuration file.
+            workers: int
+               number of processes used to run the model, and of threads
+               used to run the flooding scenarios. Overrides the value in
+               the model options of the configuration file.
         """
+        import yaml
 
         self.read_config_file(config, overwrite_ct=overwrite_ct)
 
@@ -284,8 +426,14 @@ class Niche(object):
             options = {k: config_loaded["model_options"][k]
                        for k in inspect.getargspec(self.run).args
                        if k in config_loaded["model_options"].keys()}
+            if workers is not None:
+                options["workers"] = workers
+            if "writer" in options:
+                options["writer"] = GridWriter(**options["writer"])
             self.run(**options)
 
+        writer = GridWriter(**self._options.get("writer", dict()))
+
         overwrite = False
 
         if "overwrite_files" in self._options and \
@@ -293,16 +441,20 @@ class Niche(object):
             overwrite = True
 
         if "flooding" in self._options:
-            for scen in self._options["flooding"]:
-                ct_nl = dict()
+            ct_fp = dict()
+
+            keys = set(Flooding.__init__.__code__.co_varnames)\
+                & set(self._code_tables)
 
-                keys = set(Flooding.__init__.__code__.co_varnames)\
-                    & set(self._code_tables)
+            for k in keys:
+                ct_fp[k] = self._code_tables[k]
 
-                for k in keys:
-                    ct_nl[k] = self._code_tables[k]
+            output_dir = self._options.get("output_dir")
+            if output_dir is not None and not os.path.exists(output_dir):
+                os.makedirs(output_dir)
 
-                fp = Flooding(name=scen["name"], **ct_nl)
+            def run_scenario(scen):
+                fp = Flooding(name=scen["name"], **ct_fp)
 
                 depth_file = os.path.join(os.path.dirname(config),
                                           scen["depth"])
@@ -311,16 +463,89 @@ class Niche(object):
                              period=scen["period"],
                              frequency=scen["frequency"],
                              duration=scen["duration"])
-                self.fp = fp.combine(self)
-                if "output_dir" in self._options:
-                    self.fp.write(self._options["output_dir"], overwrite)
-                    self._files_written.update(self.fp._files_written)
-
-        if "output_dir" in self._options:
+                # the vegetation of the niche model is only read, so it is
+                # shared by all scenarios
+                combined = fp.combine(self)
+                if output_dir is not None:
+                    combined.write(output_dir, overwrite, writer)
+                return combined
+
+            # the scenarios are run by a pool of threads, the results are
+            # handled in the order of the configuration file
+            workers = options.get("workers")
+            pool = ThreadPool(workers) \
+                if workers is not None and workers > 1 else None
+            try:
+                scenarios = self._options["flooding"]
+                if pool is not None:
+                    results = pool.imap(run_scenario, scenarios)
+                else:
+                    results = (run_scenario(scen) for scen in scenarios)
+                for fp in results:
+                    self.fp = fp
+                    if output_dir is not None:
+                        # the vegetation types of the niche model keep their
+                        # own files, which are read by the next scenarios
+                        # when the model was run in blocks
+                        for vi, path in fp._files_written.items():
+                            self._files_written["{}-F{:02d}".format(
+                                fp.name, vi)] = path
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                    pool.join()
+
+        # when running in blocks, the output is written while running
+        if "output_dir" in self._options \
+                and self._options.get("block_size") is None:
             output_dir = self._options["output_dir"]
-            self.write(output_dir, overwrite)
+            self.write(output_dir, overwrite,
+                       self._options.get("output_format", "GTiff"),
+                       self._options.get("abiotic_bands", False), writer)
 
-    def _check_all_lower(self, input_array, a, b):
+    @contextmanager
+    def _timer(self, stage, pixels):
+        """Measures the wall time, cpu time and memory use of a stage
+
+        The memory use is the growth of the peak memory use of the process
+        during the stage (peak_rss_growth_mb), which is 0 if the stage did
+        not use more memory than an earlier stage.
+        """
+        wall_time = time.time()
+        cpu_time = sum(os.times()[:2])
+        peak_rss = _peak_rss()
+        yield
+        growth = None
+        if peak_rss is not None:
+            growth = _peak_rss() - peak_rss
+        record = dict(wall_time=time.time() - wall_time,
+                      cpu_time=sum(os.times()[:2]) - cpu_time,
+                      peak_rss_growth_mb=growth,
+                      pixels=int(pixels))
+        self._add_timing(stage, record)
+
+    def _add_timing(self, stage, record):
+        """Adds the measurement of a stage to the timings
+
+        A stage which is measured more than once (eg for every block) is
+        summed. The timing_hook is called for every measurement.
+        """
+        if self.timing_hook is not None:
+            self.timing_hook(stage, dict(record))
+
+        total = self.timings.setdefault(
+            stage, dict(wall_time=0.0, cpu_time=0.0, pixels=0))
+        for key in ("wall_time", "cpu_time", "pixels"):
+            total[key] += record[key]
+        if record["peak_rss_growth_mb"] is not None:
+            total["peak_rss_growth_mb"] = max(
+                total.get("peak_rss_growth_mb", 0),
+                record["peak_rss_growth_mb"])
+        if total["wall_time"] > 0:
+            total["pixels_per_second"] = total["pixels"] / total["wall_time"]
+
+    def _check_all_lower(self, input_array, a, b, block=None):
+        import pandas as pd
         # We ignore comparison problems with np.nan (nodata)
         warnings.simplefilter(action='ignore', category=RuntimeWarning)
         higher = ((input_array[a] > input_array[b])
@@ -331,6 +556,9 @@ class Niche(object):
         if np.any(higher):
             # find out which cells have invalid values
             bad_points = np.where(higher)
+            if block is not None:
+                bad_points = (bad_points[0] + block[0][0],
+                              bad_points[1] + block[1][0])
             # convert these cells into the projection system
             bad_points = bad_points * self._context.transform
 
@@ -342,57 +570,222 @@ class Niche(object):
                 raise NicheException(
                     "Error: not all {} values are lower than {}".format(a, b))
 
-    def _check_input_files(self, full_model):
-        """ basic input checks (valid files etc)
+    def _open_input_files(self, keys=None):
+        """Opens every input file
+
+        Parameters
+        ----------
+        keys: iterable
+            Only open the input files of these input layers. By default all
+            input files are opened.
+
+        Returns
+        -------
+        datasets: dict
+            Contains for every input file the opened dataset and the window
+            corresponding to the model extent.
+        """
+        import rasterio
+        if keys is None:
+            keys = self._inputfiles
+
+        datasets = dict()
+        try:
+            for f in keys:
+                dst = rasterio.open(self._inputfiles[f], "r")
+                datasets[f] = dst, \
+                    self._context.get_read_window(SpatialContext(dst))
+        except Exception:
+            for dst, _ in datasets.values():
+                dst.close()
+            raise
+        return datasets
+
+    def _read_input(self, datasets, block=None):
+        """Reads the input layers
+
+        Parameters
+        ----------
+        datasets: dict
+            Opened input files, as returned by _open_input_files
+        block: ((row_start, row_stop), (col_start, col_stop))
+            Part of the model extent that must be read. By default the full
+            model extent is read.
 
+        Returns
+        -------
+        inputarray: dict
+            numpy arrays for every input layer
         """
+        if block is None:
+            shape = (int(self._context.height), int(self._context.width))
+        else:
+            shape = (block[0][1] - block[0][0], block[1][1] - block[1][0])
+
+        # the conversion of old soil codes is decided for the whole model
+        # extent, not per block
+        old_soil_codes = None if block is None else self._old_soil_codes
 
-        # Load every input_file in the input_array
         inputarray = dict()
-        for f in self._inputfiles:
-            dst = rasterio.open(self._inputfiles[f], "r")
+        for f in datasets:
+            dst, window = datasets[f]
+
+            if block is not None:
+                window = _block_window(window, block)
 
-            nodata = dst.nodatavals[0]
+            if self._options.get("cache_dir") is not None:
+                inputarray[f] = self._read_cached_band(f, dst, window,
+                                                       old_soil_codes)
+            else:
+                inputarray[f] = self._read_band(f, dst, window,
+                                                old_soil_codes)
 
-            window = self._context.get_read_window(SpatialContext(dst))
+        # Load in all constant inputvalues, as read-only views of a single
+        # value (like the memory mapped bands of the input cache)
+        for f in self._inputvalues:
+            inputarray[f] = np.broadcast_to(np.array(self._inputvalues[f]),
+                                            shape)
+
+        return inputarray
+
+    def _read_band(self, key, dst, window, old_soil_codes=None):
+        """Reads a window of an input file, converting nodata values
+
+        Nodata values are converted to np.nan for float grids and to -99
+        for integer grids.
+
+        The band is read directly in the data type used by the model and
+        the nodata mask is determined once, and used both to convert the
+        soil codes and to set the nodata values. Old soil codes are
+        converted if old_soil_codes is True, or (if it is None) when the
+        window only contains old soil codes.
+        """
+        band, isnodata = self._read_raw_band(key, dst, window)
+
+        # convert old soil codes to new soil codes
+        if key == 'soil_code':
+            if old_soil_codes is None:
+                old_soil_codes = _old_soil_codes(band, isnodata)
+            if old_soil_codes:
+                # nodata values are converted too, but set below
+                band[...] = np.round(band / 10000)
+
+        if isnodata is not None:
+            np.copyto(band, np.nan if band.dtype == 'float32' else -99,
+                      where=isnodata)
+
+        return band
+
+    def _read_raw_band(self, key, dst, window):
+        """Reads a window of an input file in the data type used by the
+        model, with the mask of the nodata values (None if the file has no
+        nodata value)"""
+        nodata = dst.nodatavals[0]
+
+        if key in _float_inputs:
+            # GDAL converts the values while reading
+            band = dst.read(1, window=window, out_dtype="float32")
+        else:
             band = dst.read(1, window=window)
 
             # if we have unsigned integers - switch to signed otherwise
             # no data (-99) will fail.
-
             if band.dtype.kind == 'u':
                 band = band.astype(int)
 
-            if f in ("nitrogen_animal", "nitrogen_fertilizer",
-                     "nitrogen_atmospheric", "mhw", "mlw", "msw"):
-                band = band.astype('float32')
+        # create a mask for no-data values, taking into account data-types
+        if nodata is None:
+            isnodata = None
+        elif band.dtype == 'float32':
+            isnodata = np.isclose(band, nodata)
+        else:
+            isnodata = band == nodata
+
+        return band, isnodata
 
-            # convert old soil codes to new soil codes
-            if f == 'soil_code' and np.all(band[band != nodata] >= 10000):
-                band[band != nodata] = np.round(band[band != nodata] / 10000)
+    def _check_old_soil_codes(self, block_size=(1024, 1024)):
+        """Whether the soil code grid of the whole model extent only
+        contains old soil codes
 
-            # create a mask for no-data values, taking into account data-types
-            if band.dtype == 'float32' and nodata is not None:
-                band[np.isclose(band, nodata)] = np.nan
-            else:
-                band[band == nodata] = -99
+        The soil code file is read block by block, until a new soil code is
+        found. Returns None if the soil codes are not read from a file.
+        """
+        if "soil_code" not in self._inputfiles:
+            return None
 
-            inputarray[f] = band
+        datasets = self._open_input_files(["soil_code"])
+        dst, window = datasets["soil_code"]
+        try:
+            for block in self._context.blocks(block_size):
+                band, isnodata = self._read_raw_band(
+                    "soil_code", dst, _block_window(window, block))
+                if not _old_soil_codes(band, isnodata):
+                    return False
+            return True
+        finally:
+            dst.close()
+
+    def _read_cached_band(self, key, dst, window, old_soil_codes=None):
+        """Reads a window of an input file using the input cache
+
+        The converted band is stored as a .npy file in the cache directory.
+        The name of the file is based on the paths, modification times and
+        sizes of the files read by GDAL (eg all files of an ArcGIS grid
+        folder), the read window and the data type, so a changed file is
+        read again. Cached bands are memory mapped (read only).
+        """
+        window = tuple(tuple(int(round(i)) for i in w) for w in window)
+        files = []
+        for path in sorted(os.path.abspath(f) for f in dst.files or
+                           [dst.name]):
+            stat = os.stat(path)
+            files.append((path, stat.st_mtime, stat.st_size))
+        cache_key = repr((__version__, key, files, window, dst.dtypes[0],
+                          old_soil_codes))
+        folder = self._options["cache_dir"]
+        filename = os.path.join(
+            folder, hashlib.sha1(cache_key.encode("utf-8")).hexdigest()
+            + ".npy")
+
+        if os.path.exists(filename):
+            return np.load(filename, mmap_mode="r")
+
+        band = self._read_band(key, dst, window, old_soil_codes)
 
-        # Load in all constant inputvalues
-        for f in self._inputvalues:
-            shape = (int(self._context.height), int(self._context.width))
-            inputarray[f] = np.full(shape, self._inputvalues[f])
+        if not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:  # pragma: no cover
+                # created by a different process in the meantime
+                if not os.path.isdir(folder):
+                    raise
+
+        # write to a temporary file first, so other processes never read
+        # an incomplete file
+        fd, tmp = tempfile.mkstemp(suffix=".npy", dir=folder)
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, band)
+        try:
+            os.rename(tmp, filename)
+        except OSError:  # pragma: no cover
+            # Windows does not replace existing files
+            os.remove(tmp)
 
+        return band
+
+    def _check_input(self, inputarray, full_model, block=None):
+        """ Checks for invalid combinations of input values
+
+        """
         # check if valid values are used in inputarrays
         # check for valid datatypes - values will be checked in the low-level
         # api (eg soil_code present in codetable)
 
-        self._check_all_lower(inputarray, "mhw", "mlw")
+        self._check_all_lower(inputarray, "mhw", "mlw", block)
 
         if full_model:
-            self._check_all_lower(inputarray, "msw", "mlw")
-            self._check_all_lower(inputarray, "mhw", "msw")
+            self._check_all_lower(inputarray, "msw", "mlw", block)
+            self._check_all_lower(inputarray, "mhw", "msw", block)
 
             with np.errstate(invalid='ignore'):  # ignore NaN comparison errors
                 if np.any((inputarray['nitrogen_animal'] < 0)
@@ -404,11 +797,217 @@ class Niche(object):
                     raise NicheException(
                         "Error: nitrogen values must be >0 and <10000")
 
+    def _check_input_files(self, full_model):
+        """ basic input checks (valid files etc)
+
+        """
+
+        # Load every input_file in the input_array, input files which were
+        # read in a previous run are not read again
+        keys = set(self._inputfiles) - set(self._inputarray)
+        pixels = int(self._context.height) * int(self._context.width)
+        with self._timer("read", pixels):
+            datasets = self._open_input_files(keys)
+            try:
+                inputarray = self._read_input(datasets)
+            finally:
+                for dst, _ in datasets.values():
+                    dst.close()
+
+        for key in self._inputfiles:
+            if key not in inputarray:
+                inputarray[key] = self._inputarray[key]
+
+        with self._timer("check", pixels):
+            self._check_input(inputarray, full_model)
+
         # if all is successful:
         self._inputarray = inputarray
 
+    def _create_model(self, model):
+        """Creates a model class (eg Vegetation) using the code tables
+        specified for this Niche object
+        """
+        ct = dict()
+
+        keys = set(model.__init__.__code__.co_varnames) \
+            & set(self._code_tables)
+
+        for k in keys:
+            ct[k] = self._code_tables[k]
+
+        return model(**ct)
+
+    def compile_code_tables(self, filename):
+        """Compiles the code tables in a binary bundle
+
+        The code tables used by this object (the default code tables, or the
+        code tables which were given) are read, validated and compiled, and
+        the result is written to a single (npz) file. This bundle can be
+        given as ct_bundle (or in the code_tables of a configuration file)
+        to load the compiled code tables without parsing the code tables
+        again.
+
+        Parameters
+        ----------
+        filename: path
+            Path of the bundle
+        """
+        models = dict(vegetation=Vegetation, nutrient_level=NutrientLevel,
+                      acidity=Acidity, flooding=Flooding)
+        write_bundle(filename, dict(
+            (name, self._create_model(model)._compiled_tables)
+            for name, model in models.items()))
+
+    def _calculate(self, inputarray, models, block=False, stages=None):
+        """Calculates the model for (a part of) the input layers
+
+        Parameters
+        ----------
+        inputarray: dict
+            numpy arrays for every input layer
+        models: dict
+            the model classes used for the calculation
+        block: bool
+            The input arrays are only a part of the model extent. A block
+            which only contains nodata is not considered an error.
+        stages: dict
+            Results of the stages of the model (see _stages) which are still
+            valid. These are not calculated again; the results of the stages
+            which are calculated are added.
+
+        Returns
+        -------
+        abiotic, vegetation, occurrence, deviation
+        """
+        full_model = self._options["full_model"]
+        abiotic = self._options["abiotic"]
+
+        if stages is None:
+            stages = dict()
+
+        abiotic_result = dict()
+
+        pixels = inputarray["soil_code"].size
+
+        def partition():
+            # the pixels grouped by soil code, shared by the stages which
+            # calculate per soil code
+            if "soil_partition" not in stages:
+                stages["soil_partition"] = SoilPartition(
+                    inputarray["soil_code"])
+            return stages["soil_partition"]
+
+        if full_model and not abiotic:
+            nl = models["nutrient_level"]
+
+            if "nutrient_level" not in stages:
+                with self._timer("nutrient_level", pixels):
+                    if "mineralisation" not in stages:
+                        stages["mineralisation"] = \
+                            nl._calculate_mineralisation(
+                                inputarray["soil_code"], inputarray["msw"],
+                                partition())
+
+                    total_nitrogen = (stages["mineralisation"]
+                                      + inputarray["nitrogen_atmospheric"]
+                                      + inputarray["nitrogen_animal"]
+                                      + inputarray["nitrogen_fertilizer"])
+                    stages["nutrient_level"] = nl._calculate(
+                        inputarray["management"], inputarray["soil_code"],
+                        total_nitrogen, inputarray["inundation_nutrient"],
+                        partition())
+
+            acidity = models["acidity"]
+
+            if "acidity" not in stages:
+                with self._timer("acidity", pixels):
+                    if "soil_mlw" not in stages:
+                        stages["soil_mlw"] = acidity._calculate_soil_mlw(
+                            inputarray["soil_code"], inputarray["mlw"],
+                            partition())
+
+                    if "seepage_class" not in stages:
+                        stages["seepage_class"] = acidity._get_seepage(
+                            inputarray["seepage"])
+
+                    stages["acidity"] = acidity._get_acidity(
+                        inputarray["rainwater"], inputarray["minerality"],
+                        inputarray["inundation_acidity"],
+                        stages["seepage_class"], stages["soil_mlw"])
+
+            abiotic_result["nutrient_level"] = stages["nutrient_level"]
+            abiotic_result["acidity"] = stages["acidity"]
+
+        vegetation = models["vegetation"]
+        if "inundation_vegetation" not in inputarray:
+            inputarray["inundation_vegetation"] = None
+
+        if "management_vegetation" not in inputarray:
+            inputarray["management_vegetation"] = None
+
+        veg_arguments = dict(soil_code=inputarray["soil_code"],
+                             mhw=inputarray["mhw"],
+                             mlw=inputarray["mlw"])
+
+        if full_model:
+            veg_arguments.update(
+                inundation=inputarray["inundation_vegetation"],
+                management=inputarray["management_vegetation"]
+            )
+            if not abiotic:
+                veg_arguments.update(
+                    nutrient_level=abiotic_result["nutrient_level"],
+                    acidity=abiotic_result["acidity"])
+            else:
+                veg_arguments.update(
+                    nutrient_level=inputarray["nutrient_level"],
+                    acidity=inputarray["acidity"])
+
+        if "vegetation" not in stages and "input_nodata" not in stages:
+            # the pixels with nodata in the input layers, shared by the
+            # check for empty blocks and the vegetation calculation
+            stages["input_nodata"] = vegetation._input_nodata(
+                inputarray["soil_code"], inputarray["mhw"],
+                inputarray["mlw"], veg_arguments.get("management"),
+                veg_arguments.get("inundation"))
+
+        if "vegetation" in stages:
+            veg, occurrence = stages["vegetation"]
+        elif block and np.all(vegetation._nodata(
+                full_model=full_model, input_nodata=stages["input_nodata"],
+                **veg_arguments)):
+            shape = inputarray["soil_code"].shape
+            veg = PackedVegetation(vegetation._veg_codes.tolist(),
+                                   np.ones(shape, dtype="bool"))
+            occurrence = None
+        else:
+            with self._timer("vegetation", pixels):
+                veg, occurrence = vegetation.calculate(
+                    full_model=full_model, packed=True,
+                    partition=partition(),
+                    input_nodata=stages["input_nodata"], **veg_arguments)
+            stages["vegetation"] = veg, occurrence
+
+        deviation = dict()
+        if self._options["deviation"]:
+            dtype = self._options["deviation_dtype"]
+            # blocks are small, so there is no need to calculate them lazily
+            lazy = self._options["lazy_deviation"] and not block
+            if stages.get("deviation", (None, ))[0] != (dtype, lazy):
+                with self._timer("deviation", pixels):
+                    stages["deviation"] = (dtype, lazy), \
+                        vegetation.calculate_deviation(
+                            inputarray["soil_code"], inputarray["mhw"],
+                            inputarray["mlw"], dtype=dtype, lazy=lazy)
+            deviation = stages["deviation"][1]
+
+        return abiotic_result, veg, occurrence, deviation
+
     def run(self, full_model=True, deviation=False, abiotic=False,
-            strict_checks=True):
+            strict_checks=True, block_size=None, output_dir=None,
+            workers=None, deviation_dtype="float64", lazy_deviation=False,
+            writer=None):
         """Run the niche model
 
         Runs niche Vlaanderen model. Requires that the necessary input values
@@ -433,12 +1032,54 @@ class Niche(object):
                 checks models can still be run. It will still emit a warning.
                 Note that this is provided to be backwards compatibility and
                 it is recommended to fix the data rather than disabling this.
+        block_size: (int, int)
+                Run the model in blocks of (rows, columns) rather than reading
+                the full grids in memory. The result of every block is written
+                directly to output_dir, so the memory use is bounded by the
+                block size. The grids are not kept in memory after the run, but
+                the summary table (and occurrence) is available.
+        output_dir: string
+                Output folder to which the result is written while running.
+                Only used (and required) when block_size is specified,
+                otherwise the result can be saved using the write method.
+        workers: int
+                Number of processes used to run the model. The grids are
+                split in tiles (or in blocks of block_size) which are read
+                and calculated in parallel by the worker processes. The
+                result is identical to a run with a single process.
+        deviation_dtype: "float64", "float32" or "int16"
+                Data type of the deviation grids, in memory and in the output
+                files. float32 halves the size of the grids, int16 (the
+                deviation rounded to whole centimetres, with nodata -32768)
+                divides it by four.
+        lazy_deviation: bool
+                Do not keep all deviation grids in memory, but calculate
+                them when they are written or plotted, one vegetation type
+                at a time. Also used when the model is run by a number of
+                workers, the deviation is then calculated after the run.
+                Not used when the model is run in blocks, as the grids are
+                then not kept in memory anyway.
+        writer: GridWriter
+                Compression and tiling of the files written when running in
+                blocks. The files are always tiled; the threads of the writer
+                are not used, as every block is written to all files.
         """
 
+        if deviation_dtype not in Vegetation.deviation_dtypes:
+            raise NicheException(
+                "Error, invalid deviation_dtype {}, possible: {}".format(
+                    deviation_dtype, ", ".join(Vegetation.deviation_dtypes)))
+
         self._options["full_model"] = full_model
         self._options["deviation"] = deviation
+        self._options["deviation_dtype"] = deviation_dtype
+        self._options["lazy_deviation"] = lazy_deviation
+        if writer is not None:
+            self._options["writer"] = writer.options
         self._options["abiotic"] = abiotic
         self._options["strict_checks"] = strict_checks
+        self._options["block_size"] = \
+            None if block_size is None else list(block_size)
 
         if abiotic:
             missing_keys = (_abiotic_keys
@@ -466,129 +1107,349 @@ class Niche(object):
                 raise NicheException(
                     "Error, different obliged keys are missing")
 
-        self._check_input_files(full_model)
-
-        if full_model and not abiotic:
-            ct_nl = dict()
+        if block_size is not None and output_dir is None:
+            raise NicheException(
+                "Error, output_dir must be specified when running in blocks")
 
-            keys = set(NutrientLevel.__init__.__code__.co_varnames) \
-                & set(self._code_tables)
+        if workers is not None and (not isinstance(workers, numbers.Integral)
+                                    or workers < 1):
+            raise NicheException(
+                "Error, the number of workers must be a positive integer")
 
-            for k in keys:
-                ct_nl[k] = self._code_tables[k]
+        self.timings = dict()
 
-            nl = NutrientLevel(**ct_nl)
+        models = dict(vegetation=self._create_model(Vegetation))
+        if full_model and not abiotic:
+            models["nutrient_level"] = self._create_model(NutrientLevel)
+            models["acidity"] = self._create_model(Acidity)
 
-            self._abiotic["nutrient_level"] = nl.calculate(
-                soil_code=self._inputarray["soil_code"],
-                msw=self._inputarray["msw"],
-                nitrogen_atmospheric=self._inputarray["nitrogen_atmospheric"],
-                nitrogen_animal=self._inputarray["nitrogen_animal"],
-                nitrogen_fertilizer=self._inputarray["nitrogen_fertilizer"],
-                management=self._inputarray["management"],
-                inundation=self._inputarray["inundation_nutrient"])
+        if block_size is not None:
+            self._run_blocks(models, block_size, output_dir, workers)
+            return
 
-            ct_acidity = dict()
+        if workers is not None and workers > 1:
+            self._run_tiles(models, workers)
+            return
 
-            keys = set(Acidity.__init__.__code__.co_varnames) \
-                & set(self._code_tables)
+        self._counts.clear()
 
-            for k in keys:
-                ct_acidity[k] = self._code_tables[k]
+        # results of a previous run can only be reused for the same model
+        if self._stage_options != (full_model, abiotic):
+            self._clear_result()
+            self._stage_options = (full_model, abiotic)
 
-            acidity = Acidity(**ct_acidity)
-            self._abiotic["acidity"] = acidity.calculate(
-                self._inputarray["soil_code"], self._inputarray["mlw"],
-                self._inputarray["inundation_acidity"],
-                self._inputarray["seepage"],
-                self._inputarray["minerality"],
-                self._inputarray["rainwater"])
+        self._check_input_files(full_model)
 
-        ct_veg = dict()
+        abiotic_result, self._vegetation, self.occurrence, deviation_result \
+            = self._calculate(self._inputarray, models, stages=self._stages)
+        self._abiotic.update(abiotic_result)
 
-        keys = set(Vegetation.__init__.__code__.co_varnames) \
-            & set(self._code_tables)
-
-        for k in keys:
-            ct_veg[k] = self._code_tables[k]
+        if deviation:
+            self._deviation = deviation_result
 
-        vegetation = Vegetation(**ct_veg)
-        if "inundation_vegetation" not in self._inputarray:
-            self._inputarray["inundation_vegetation"] = None
+    def run_scenarios(self, scenarios, output_dir=None, overwrite_files=False,
+                      **kwargs):
+        """Runs the niche model for a number of scenarios
 
-        if "management_vegetation" not in self._inputarray:
-            self._inputarray["management_vegetation"] = None
+        Every scenario is a variant of this model, in which some input layers
+        are replaced. The input layers which are not replaced are read only
+        once, and the stages of the model which do not depend on the
+        replaced layers (eg the mineralisation when only nitrogen inputs
+        differ) are calculated only once for all scenarios.
 
-        veg_arguments = dict(soil_code=self._inputarray["soil_code"],
-                             mhw=self._inputarray["mhw"],
-                             mlw=self._inputarray["mlw"])
+        Parameters
+        ----------
+        scenarios: dict
+            For every scenario name, a dict with the input layers which
+            are replaced (as in set_input, a path or a number).
+        output_dir: string
+            If specified, the result of every scenario is written to this
+            folder. The scenario name is used as prefix for the files.
+        overwrite_files: bool
+            Overwrite files when writing the scenarios.
+        kwargs:
+            Model options, see run (eg full_model, deviation).
 
-        if full_model:
-            veg_arguments.update(
-                inundation=self._inputarray["inundation_vegetation"],
-                management=self._inputarray["management_vegetation"]
-            )
-            if not abiotic:
-                veg_arguments.update(
-                    nutrient_level=self._abiotic["nutrient_level"],
-                    acidity=self._abiotic["acidity"])
+        Returns
+        -------
+        Generator of (name, Niche) tuples, one for every scenario. Scenarios
+        are calculated while iterating, so only the results of the current
+        scenario must be kept in memory.
+        """
+        full_model = kwargs.get("full_model", True)
+        abiotic = kwargs.get("abiotic", False)
+        if self._stage_options != (full_model, abiotic):
+            self._clear_result()
+            self._stage_options = (full_model, abiotic)
+
+        for name in scenarios:
+            overrides = scenarios[name]
+            scenario = self._scenario(name, overrides)
+            if kwargs.get("block_size") is None:
+                scenario.run(**kwargs)
+                if output_dir is not None:
+                    scenario.write(output_dir, overwrite_files)
             else:
-                veg_arguments.update(
-                    nutrient_level=self._inputarray["nutrient_level"],
-                    acidity=self._inputarray["acidity"])
+                # when running in blocks the output is written while running
+                scenario._options["overwrite_files"] = overwrite_files
+                scenario.run(output_dir=output_dir, **kwargs)
+
+            # inputs and stages which do not depend on the replaced layers
+            # are shared with the next scenarios. Only the grids read from
+            # the input files of this model are shared, not the constant
+            # inputs or the placeholders of optional inputs.
+            changed = set(overrides)
+            for key in overrides:
+                changed |= _downstream(key)
+            if scenario._context == self._context:
+                for key in set(scenario._inputarray) - changed:
+                    if key in self._inputfiles \
+                            and scenario._inputarray[key] is not None:
+                        self._inputarray[key] = scenario._inputarray[key]
+                for stage in set(scenario._stages) - changed:
+                    self._stages[stage] = scenario._stages[stage]
+
+            yield name, scenario
+
+    def _scenario(self, name, overrides):
+        """Creates a copy of this model with some input layers replaced
+
+        The input grids and results of the model stages are shared with this
+        model, until they are replaced.
+        """
+        scenario = Niche.__new__(Niche)
+        scenario.__dict__.update(self.__dict__)
+        for key in ("_inputfiles", "_inputvalues", "_inputarray", "_options",
+                    "_code_tables", "_stages", "_abiotic"):
+            setattr(scenario, key, dict(getattr(self, key)))
+        for key in ("_vegetation", "_deviation", "_files_written",
+                    "_counts"):
+            setattr(scenario, key, dict())
+        scenario._context = copy.copy(self._context)
+        scenario.occurrence = None
+        scenario.name = name
+
+        for key in overrides:
+            scenario.set_input(key, overrides[key])
+
+        return scenario
+
+    def _calculate_block(self, datasets, models, block):
+        """Reads, checks and calculates a single block of the model"""
+        pixels = (block[0][1] - block[0][0]) * (block[1][1] - block[1][0])
+        with self._timer("read", pixels):
+            inputarray = self._read_input(datasets, block)
+        with self._timer("check", pixels):
+            self._check_input(inputarray, self._options["full_model"], block)
+        abiotic, vegetation, _, deviation = self._calculate(
+            inputarray, models, block=True)
+        return block, abiotic, vegetation, deviation
+
+    def _calculate_blocks(self, models, blocks, workers=None):
+        """Calculates the model for every block
+
+        If more than one worker is used, the blocks are divided over a pool
+        of processes which read their part of the input files themselves.
+        The results are yielded in the order of blocks.
+        """
+        self._old_soil_codes = self._check_old_soil_codes()
+
+        if workers is None or workers == 1:
+            datasets = self._open_input_files()
+            try:
+                for block in blocks:
+                    yield self._calculate_block(datasets, models, block)
+            finally:
+                for dst, _ in datasets.values():
+                    dst.close()
+        else:
+            pool = multiprocessing.Pool(workers, _init_worker, (self, models))
+            try:
+                for result, timings in pool.imap(_calculate_block, blocks):
+                    # stages timed by the worker process
+                    for stage, record in timings:
+                        self._add_timing(stage, record)
+                    yield result
+            finally:
+                pool.terminate()
+                pool.join()
+
+    def _set_counts(self, counts):
+        """Sets the occurrence based on the pixel counts per vegetation type
+        """
+        import pandas as pd
+        if np.all([counts[vi][[0, 1]].sum() == 0 for vi in counts]):
+            raise NicheException("only nodata values in prediction")
+
+        self.occurrence = dict()
+        for vi in counts:
+            present = counts[vi][[0, 1, 255]]
+            self._counts[vi] = pd.Series(present, index=[0, 1, 255])
+            self.occurrence[vi] = np.asscalar(
+                np.true_divide(present[1], present[0] + present[1]))
+
+    def _run_tiles(self, models, workers):
+        """Runs the model in parallel, tile by tile
+
+        The tiles are calculated by a pool of processes and are combined
+        in the result grids. Lazy deviation grids are not calculated by the
+        workers, but from the input grids of the whole model after the run.
+        """
+        self._clear_result()
+        self._inputarray = dict()
 
-        self._vegetation, self.occurrence = vegetation.calculate(
-            full_model=full_model, **veg_arguments)
+        lazy = self._options["deviation"] and self._options["lazy_deviation"]
 
-        if deviation:
-            self._deviation = vegetation.calculate_deviation(
-                self._inputarray["soil_code"], self._inputarray["mhw"],
-                self._inputarray["mlw"]
-            )
+        height = int(self._context.height)
+        width = int(self._context.width)
+        # use a few tiles per worker, so the work is spread evenly
+        rows = max(1, -(-height // (4 * workers)))
+        blocks = list(self._context.blocks((rows, width)))
 
-    def write(self, folder, overwrite_files=False):
-        """Saves the model results to a folder
+        counts = dict()
+        results = dict(abiotic=self._abiotic, deviation=self._deviation)
+        vegetation = PackedVegetation(models["vegetation"]._veg_codes.tolist(),
+                                      np.ones((height, width), dtype="bool"))
 
-        Saves the model results to a folder. Files will be written as geotiff.
-        Vegetation files have names V1 ... V28
-        Abiotic files are exported as well (nutrient_level.tif and
-        acidity.tif).
+        # the workers get a copy of the options when the pool is started
+        self._options["deviation"] = not lazy and self._options["deviation"]
+        try:
+            with closing(self._calculate_blocks(models, blocks, workers)) \
+                    as tiles:
+                for block in tiles:
+                    window = tuple(slice(*b) for b in block[0])
+                    vegetation.set_window(window, block[2])
+                    for name, result in (("abiotic", block[1]),
+                                         ("deviation", block[3])):
+                        for key in result:
+                            if key not in results[name]:
+                                results[name][key] = np.empty(
+                                    (height, width), dtype=result[key].dtype)
+                            results[name][key][window] = result[key]
+
+                    for vi, count in block[2].counts().items():
+                        if vi not in counts:
+                            counts[vi] = np.zeros(256, dtype="int64")
+                        counts[vi][[0, 1, 255]] += count.values
+        finally:
+            if lazy:
+                self._options["deviation"] = True
+
+        if lazy:
+            keys = ["soil_code", "mhw", "mlw"]
+            datasets = self._open_input_files(
+                [key for key in keys if key in self._inputfiles])
+            try:
+                inputarray = self._read_input(datasets)
+            finally:
+                for dst, _ in datasets.values():
+                    dst.close()
+            with self._timer("deviation", height * width):
+                self._deviation = models["vegetation"].calculate_deviation(
+                    *[inputarray[key] for key in keys],
+                    dtype=self._options["deviation_dtype"], lazy=True)
+
+        self._vegetation = vegetation
+        self._set_counts(counts)
+        # the result is kept in memory, so the table is based on the grids
+        self._counts.clear()
+
+    def _run_blocks(self, models, block_size, folder, workers=None):
+        """Runs the model block by block
+
+        Every block is read from the input files, calculated and written to
+        the output files in folder, before the next block is read. Only the
+        pixel counts of the vegetation types are kept.
+        """
+        import rasterio
+        self._clear_result()
+        self._inputarray = dict()
 
-        Parameters
-        ----------
+        full_model = self._options["full_model"]
+        veg_codes = models["vegetation"]._veg_codes.tolist()
+        abiotic_keys = []
+        if full_model and not self._options["abiotic"]:
+            abiotic_keys = ["nutrient_level", "acidity"]
+        deviation_keys = []
+        if self._options["deviation"]:
+            deviation_keys = ["{}_{:02d}".format(key, vi)
+                              for vi in veg_codes for key in ("mhw", "mlw")]
+
+        # checks the block size before any file is created
+        blocks = self._context.blocks(block_size)
+
+        files = self._get_output_files(folder, veg_codes, abiotic_keys,
+                                       deviation_keys)
+        self._check_output_files(
+            files, self._options.get("overwrite_files", False))
+        self._options["output_dir"] = folder
 
-        folder: string
-            Output folder to which files will be written. Parent directory must
-            already exist.
+        if not os.path.exists(folder):
+            os.makedirs(folder)
 
-        overwrite_files: bool
-            Overwrite files when saving.
-            Note writing will fail if any of the files to be written already
-            exists.
+        # tiled output, so blocks can be written independently
+        writer = GridWriter(**self._options.get("writer", dict()))
+        tiles = dict(tiled=True, blockxsize=writer.blocksize,
+                     blockysize=writer.blocksize)
+        counts = dict((vi, np.zeros(256, dtype="int64")) for vi in veg_codes)
 
-        """
+        outputs = dict()
+        try:
+            for key in veg_codes + abiotic_keys:
+                outputs[key] = rasterio.open(
+                    files[key], "w",
+                    **self._output_params("uint8", 255, writer, **tiles))
+            dtype = self._options["deviation_dtype"]
+            for key in deviation_keys:
+                outputs[key] = rasterio.open(
+                    files[key], "w",
+                    **self._output_params(dtype, _deviation_nodata(dtype),
+                                          writer, **tiles))
+
+            with closing(self._calculate_blocks(models, blocks, workers)) \
+                    as results:
+                for block, abiotic, vegetation, deviation in results:
+                    pixels = (block[0][1] - block[0][0]) \
+                        * (block[1][1] - block[1][0])
+                    with self._timer("write", pixels):
+                        for vi in vegetation:
+                            counts[vi] += np.bincount(
+                                vegetation[vi].ravel(), minlength=256)
+                            outputs[vi].write(vegetation[vi], 1,
+                                              window=block)
+                        for key in abiotic:
+                            outputs[key].write(abiotic[key], 1, window=block)
+                        for key in deviation:
+                            outputs[key].write(deviation[key], 1,
+                                               window=block)
+        finally:
+            for dst in outputs.values():
+                dst.close()
+
+        for key in outputs:
+            self._files_written[key] = os.path.normpath(files[key])
+
+        self._set_counts(counts)
 
-        if not self.vegetation_calculated:
-            raise NicheException(
-                "A valid run must be done before writing the output.")
+        self.table.to_csv(files["summary"], index=False)
 
-        self._options["output_dir"] = folder
+        with open(files['log'], "w") as f:
+            f.write(self.__repr__())
 
-        if not os.path.exists(folder):
-            os.makedirs(folder)
+    def _output_params(self, dtype, nodata, writer=None, **kwargs):
+        """Creation options for the output grids"""
+        if writer is None:
+            writer = GridWriter()
+        return writer.profile(self._context, dtype, nodata, **kwargs)
 
-        params = dict(
-            driver='GTiff',
-            height=self._context.height,
-            width=self._context.width,
-            crs=self._context.crs,
-            transform=self._context.transform,
-            count=1,
-            dtype="uint8",
-            nodata=255,
-            compress="DEFLATE"
-        )
+    def _get_output_files(self, folder, vegetation, abiotic, deviation):
+        """Filenames of the files written to folder
 
+        Parameters
+        ----------
+        vegetation, abiotic, deviation: iterable
+            keys of the grids that are written
+        """
         prefix = ""
         if self.name != "":
             prefix = self.name + "_"
@@ -596,18 +1457,22 @@ class Niche(object):
         files = {'summary': folder + '/' + prefix + "summary.csv",
                  'log': "{}/{}log.txt".format(folder, prefix)}
 
-        for vi in self._vegetation:
+        for vi in vegetation:
             path = '{}/{}V{:02d}.tif'.format(folder, prefix, vi)
             files[vi] = path
 
-        for vi in self._abiotic:
+        for vi in abiotic:
             path = '{}/{}{}.tif'.format(folder, prefix, vi)
             files[vi] = path
 
-        for i in self._deviation:
+        for i in deviation:
             path = '{}/{}{}.tif'.format(folder, prefix, i)
             files[i] = path
 
+        return files
+
+    def _check_output_files(self, files, overwrite_files):
+        """Checks whether files to be written already exist"""
         for key in files:
             if os.path.exists(files[key]):
                 if overwrite_files:
@@ -617,36 +1482,171 @@ class Niche(object):
                     raise NicheException(
                         "File {} already exists".format(files[key]))
 
-        # write a summary file containing the table of the model
-        self.table.to_csv(files["summary"], index=False)
+    def write(self, folder, overwrite_files=False, output_format="GTiff",
+              abiotic_bands=False, writer=None):
+        """Saves the model results to a folder
+
+        Saves the model results to a folder. Files will be written as geotiff.
+        Vegetation files have names V1 ... V28
+        Abiotic files are exported as well (nutrient_level.tif and
+        acidity.tif).
+
+        Parameters
+        ----------
+
+        folder: string
+            Output folder to which files will be written. Parent directory must
+            already exist.
 
-        for vi in self._vegetation:
-            with rasterio.open(files[vi], 'w', **params) as dst:
-                dst.write(self._vegetation[vi], 1)
-                self._files_written[vi] = os.path.normpath(files[vi])
-
-        # also save the abiotic grids
-        for vi in self._abiotic:
-            with rasterio.open(files[vi], 'w', **params) as dst:
-                dst.write(self._abiotic[vi], 1)
-                self._files_written[vi] = os.path.normpath(files[vi])
-
-        # deviation
-        params.update(
-            dtype="float64",
-            nodata=-99999
-        )
-
-        for i in self._deviation:
-            with rasterio.open(files[i], 'w', **params) as dst:
-                band = self._deviation[i]
-                band[band == np.nan] = -99999
-                dst.write(band, 1)
-                self._files_written[i] = os.path.normpath(files[i])
+        overwrite_files: bool
+            Overwrite files when saving.
+            Note writing will fail if any of the files to be written already
+            exists.
+
+        output_format: "GTiff" or "COG"
+            GTiff writes a file per vegetation type. COG writes all
+            vegetation types as bands of a single Cloud Optimized GeoTIFF
+            (vegetation.tif): a tiled file with internal overviews, with the
+            vegetation code and name as band description.
+
+        abiotic_bands: bool
+            When writing a COG, add the abiotic grids as extra bands to
+            vegetation.tif rather than writing them to separate files.
+
+        writer: GridWriter
+            Compression, tiling and number of threads used to write the
+            files. By default DEFLATE compressed files are written by a
+            single thread.
+
+        """
+        if output_format not in ("GTiff", "COG"):
+            raise NicheException(
+                "Invalid output format {}, possible: GTiff, COG".format(
+                    output_format))
+
+        if not self.vegetation_calculated:
+            if len(self._counts) > 0:
+                raise NicheException(
+                    "The results of a model run in blocks are written while "
+                    "running and are not kept in memory.")
+            raise NicheException(
+                "A valid run must be done before writing the output.")
+
+        self._options["output_dir"] = folder
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        if writer is None:
+            writer = GridWriter()
+        elif len(writer.options) > 0:
+            self._options["writer"] = writer.options
+        params = self._output_params("uint8", 255, writer)
+
+        vegetation = self._vegetation
+        abiotic = self._abiotic
+        bands = []
+        if output_format == "COG":
+            self._options["output_format"] = output_format
+            bands = list(vegetation)
+            vegetation = []
+            if abiotic_bands:
+                self._options["abiotic_bands"] = abiotic_bands
+                bands += sorted(abiotic)
+                abiotic = dict()
+
+        files = self._get_output_files(folder, vegetation, abiotic,
+                                       self._deviation)
+        if output_format == "COG":
+            prefix = self.name + "_" if self.name != "" else ""
+            files["vegetation"] = "{}/{}vegetation.tif".format(folder, prefix)
+        self._check_output_files(files, overwrite_files)
+
+        self.timings.pop("write", None)
+        pixels = int(self._context.height) * int(self._context.width)
+        with self._timer("write", pixels):
+            # write a summary file containing the table of the model
+            self.table.to_csv(files["summary"], index=False)
+
+            if len(bands) > 0:
+                self._write_bands(files["vegetation"], bands, writer)
+                self._files_written["vegetation"] = \
+                    os.path.normpath(files["vegetation"])
+
+            def grids():
+                # grids (eg of the packed vegetation) are created one by one,
+                # while the writer writes the previous ones
+                for vi in vegetation:
+                    yield files[vi], params, self._vegetation[vi]
+
+                # also save the abiotic grids
+                for vi in abiotic:
+                    yield files[vi], params, self._abiotic[vi]
+
+                # deviation
+                for i in self._deviation:
+                    band = self._deviation[i]
+                    yield files[i], self._output_params(
+                        band.dtype.name, _deviation_nodata(band.dtype.name),
+                        writer), band
+
+            writer.write(grids())
+            for key in (list(vegetation) + list(abiotic)
+                        + list(self._deviation)):
+                self._files_written[key] = os.path.normpath(files[key])
 
         with open(files['log'], "w") as f:
             f.write(self.__repr__())
 
+    def _write_bands(self, path, keys, writer, blocksize=512):
+        """Writes vegetation and abiotic grids as a multi-band COG
+
+        The bands and their overviews are first written to a temporary
+        file, which is then copied with the overviews in front of the data,
+        as required for a Cloud Optimized GeoTIFF. The compression of the
+        writer is used, and its block size if it writes tiled files.
+        """
+        import rasterio.shutil
+        from rasterio.enums import Resampling
+        if writer.tiled:
+            blocksize = writer.blocksize
+        params = self._output_params(
+            "uint8", 255, count=len(keys), tiled=True, blockxsize=blocksize,
+            blockysize=blocksize, zlevel=1)
+
+        # overviews are added until the smallest one fits in a single tile
+        size = max(int(self._context.height), int(self._context.width))
+        factors = []
+        factor = 1
+        while -(-size // factor) > blocksize:
+            factor *= 2
+            factors.append(factor)
+
+        fd, tmp = tempfile.mkstemp(suffix=".tif",
+                                   dir=os.path.dirname(path) or ".")
+        os.close(fd)
+        try:
+            with rasterio.open(tmp, "w", **params) as dst:
+                for i, key in enumerate(keys, 1):
+                    if key in self._vegetation:
+                        dst.write(self._vegetation[key], i)
+                        description = "V{:02d} {}".format(
+                            key, self._vegcode2name(key))
+                    else:
+                        dst.write(self._abiotic[key], i)
+                        description = key
+                    dst.set_band_description(i, description)
+                if len(factors) > 0:
+                    dst.build_overviews(factors, Resampling.nearest)
+
+            options = writer.creation_options("uint8")
+            options.update(tiled=True, blockxsize=blocksize,
+                           blockysize=blocksize)
+            rasterio.shutil.copy(tmp, path, driver="GTiff",
+                                 copy_src_overviews=True, **options)
+        finally:
+            os.remove(tmp)
+
     def plot(self, key, ax=None, fixed_scale=True):
         """ Plots the result or input of a Niche object
 
@@ -681,6 +1681,7 @@ class Niche(object):
           Can be used to update the plot (eg change the
           title).
         """
+        import rasterio
         try:
             import matplotlib.pyplot as plt
             import matplotlib.patches as mpatches
@@ -717,6 +1718,8 @@ class Niche(object):
             title = "{} ({})".format(self._vegcode2name(key), key)
         if key in self._deviation:
             v = self._deviation[key]
+            if v.dtype.kind != 'f':
+                v = ma.masked_equal(v, Vegetation.nodata_deviation)
             title = key
             if fixed_scale:
                 norm = Normalize(-50, 50)
@@ -758,7 +1761,8 @@ class Niche(object):
     def table(self):
         """Dataframe containing the potential area (ha) per vegetation type
         """
-        if not self.vegetation_calculated:
+        import pandas as pd
+        if not self.vegetation_calculated and len(self._counts) == 0:
             raise NicheException(
                 "Error: You must run niche prior to requesting the "
                 "result table")
@@ -767,9 +1771,16 @@ class Niche(object):
 
         presence = dict({0: "not present", 1: "present", 255: "no data"})
 
-        for i in self._vegetation:
-            vi = pd.Series(self._vegetation[i].flatten())
-            rec = vi.value_counts() * self._context.cell_area / 10000
+        # pixel counts of the grids in memory, or of a model run in blocks
+        if self.vegetation_calculated:
+            counts = self._vegetation.counts()
+        else:
+            counts = self._counts
+
+        for i in sorted(counts):
+            rec = counts[i]
+            rec = rec[rec > 0].sort_values(ascending=False)
+            rec = rec * self._context.cell_area / 10000
             for a in rec.index:
                 td.append((i, presence[a], rec[a]))
 
@@ -801,62 +1812,22 @@ class Niche(object):
         =======
         table: pandas.DataFrame
         """
-        td = dict()
-
-        # Ignore the warnings from rasterstats - code must be adjusted
-        # in that package - not in our code.
-        warnings.simplefilter(action='ignore', category=FutureWarning)
-
-        presence = dict({0: "not present", 1: "present", 255: "no data"})
-
-        for i in self._vegetation:
-            # Note we use -99 as nodata value to make sure the true nodata
-            # value (255) is part of the result table.
-
-            td[i] = rasterstats.zonal_stats(vectors=vectors,
-                                            raster=self._vegetation[i],
-                                            affine=self._context.transform,
-                                            categorical=True,
-                                            nodata=-99,
-                                            geojson_out=attribute is not None
-                                            )
-        warnings.simplefilter('default')
+        if not self.vegetation_calculated:
+            raise NicheException(
+                "Error: You must run niche prior to calculating zonal "
+                "statistics")
 
-        ti = []
-        attribute_list = []
-
-        for vi in td:
-            for shape_i, rec in enumerate(td[vi]):
-                if attribute is not None:
-                    rec = rec['properties']
-                for a in presence:
-                    pixels = rec.get(a) if rec.get(a) is not None else 0
-                    ti.append((vi, shape_i, presence[a],
-                               pixels * self._context.cell_area / 10000))
-                    if attribute is not None:
-                        attribute_list.append(rec[attribute])
-
-        df = pd.DataFrame(ti, columns=['vegetation', 'shape_id', 'presence',
-                                       'area_ha'])
+        # every shape is rasterized once, for all vegetation types
+        zones = Zones(vectors, self._context)
 
-        if outside:
-            # calculate area outside polygons
-            a = pd.concat([self.table.groupby(by=["vegetation", "presence"])[
-                               "area_ha"].sum(),
-                           df.groupby(by=["vegetation", "presence"])[
-                               "area_ha"].sum()], axis=1)
-            a = a.reset_index().fillna(0)
-            a.columns = ["vegetation", "presence", "all", "inshape"]
-            a["area_ha"] = a["all"] - a["inshape"]
-            a["shape_id"] = -1
-            a = a[["vegetation", "shape_id", "presence", "area_ha"]]
-            df = pd.concat([df, a])
-            attribute_list.extend(a["shape_id"])
-
-        if attribute is not None:
-            df[attribute] = attribute_list
+        # the presence of all vegetation types for the pixels of the zones
+        counts = zones.counts(self._vegetation.take(zones.pixels),
+                              [0, 1, 255])
 
-        return df
+        return zones.table(counts, list(self._vegetation),
+                           ["not present", "present", "no data"],
+                           self._context.cell_area, attribute,
+                           self.table if outside else None)
 
     def _vegcode2name(self, vegcode):
         """Converts a vegetation code to a name
@@ -864,14 +1835,8 @@ class Niche(object):
         Uses ct_vegetation columns veg_code and veg_type"""
 
         if not hasattr(self, "_vegcode2namedict"):
-            if "ct_vegetation" in self._code_tables:
-                ct_vegetation = self._code_tables["ct_vegetation"]
-            else:
-                ct_vegetation = resource_filename(
-                    "niche_vlaanderen",
-                    "system_tables/niche_vegetation.csv")
-
-            ct_vegetation = pd.read_csv(ct_vegetation)
+            # the code tables of the model are loaded only once
+            ct_vegetation = self._create_model(Vegetation)._ct_vegetation
             subtable = ct_vegetation[["veg_code", "veg_type"]]
             veg_dict = subtable.set_index("veg_code").to_dict()["veg_type"]
             self._vegcode2namedict = veg_dict
@@ -881,10 +1846,70 @@ class Niche(object):
     def vegetation_calculated(self):
         return len(self._vegetation) > 0
 
-    def _clear_result(self):
-        """Clears calculated vegetation"""
-        self._vegetation.clear()
-        self._deviation.clear()
+    def _clear_result(self, stages=None):
+        """Clears calculated vegetation
+
+        Parameters
+        ----------
+        stages: set
+            Only clear the results of these stages. By default all results
+            are cleared.
+        """
+        if stages is None:
+            stages = set(_stages)
+        for stage in stages:
+            self._stages.pop(stage, None)
+        for key in _abiotic_keys & stages:
+            self._abiotic.pop(key, None)
+        if "vegetation" in stages:
+            self._vegetation = dict()
+            self._counts.clear()
+        if "deviation" in stages:
+            self._deviation = dict()
+
+
+def _deviation_nodata(dtype):
+    """Nodata value of deviation grids of type dtype in the output files"""
+    if dtype == "int16":
+        return Vegetation.nodata_deviation
+    return -99999
+
+
+# model, code tables and opened input files of a worker process
+_worker = dict()
+
+
+def _block_window(window, block):
+    """Window of a file for a block of the model extent, where window is the
+    window of the file for the whole model extent"""
+    row_start = int(round(window[0][0]))
+    col_start = int(round(window[1][0]))
+    return ((row_start + block[0][0], row_start + block[0][1]),
+            (col_start + block[1][0], col_start + block[1][1]))
+
+
+def _old_soil_codes(band, isnodata):
+    """Whether all soil codes of a band (apart from nodata) are old soil
+    codes, which are converted to new soil codes"""
+    old_codes = band >= 10000
+    if isnodata is not None:
+        old_codes |= isnodata
+    return bool(np.all(old_codes))
+
+
+def _init_worker(niche, models):
+    _worker["niche"] = niche
+    _worker["models"] = models
+    _worker["datasets"] = niche._open_input_files()
+
+
+def _calculate_block(block):
+    niche = _worker["niche"]
+    timings = []
+    niche.timing_hook = lambda stage, record: timings.append((stage, record))
+    result = niche._calculate_block(_worker["datasets"], _worker["models"],
+                                    block)
+    return result, timings
 
 
 def indent(s, pre):
@@ -929,32 +1954,37 @@ class NicheDelta(object):
                 "to calculating a delta."
             )
 
+        veg1 = n1._vegetation
+        veg2 = n2._vegetation
+
         # the error below should not occur as we check the context, but
         # better safe than sorry
-        if n1._vegetation[1].size != \
-                n2._vegetation[1].size:  # pragma: no cover
+        if veg1.nodata.size != veg2.nodata.size:  # pragma: no cover
             raise NicheException("Arrays have different size.")
 
-        if len(n1._vegetation) != len(n2._vegetation):
+        if len(veg1) != len(veg2):
             raise NicheException(
                 "Niche vegetation objects have different length."
             )
 
-        for vi in n1._vegetation:
-            n1v = n1._vegetation[vi].flatten()
-            n2v = n2._vegetation[vi].flatten()
-            res = np.full(n1v.size, 4, dtype="uint8")
-            res[((n1v == 0) & (n2v == 0))] = 0
-            res[((n1v == 1) & (n2v == 1))] = 1
-            res[((n1v == 1) & (n2v == 0))] = 2
-            res[((n1v == 0) & (n2v == 1))] = 3
-            res[((n1v == 255) & (n2v == 255))] = 255
-            res.resize(n1._vegetation[vi].shape)
+        # the nodata masks are shared by all vegetation types
+        nodata_one = veg1.nodata | veg2.nodata
+        nodata_both = veg1.nodata & veg2.nodata
+
+        # value for (presence in model 1) * 2 + (presence in model 2)
+        values = np.array([0, 3, 2, 1], dtype="uint8")
+
+        for vi in veg1:
+            combination = veg1.present(vi).view("uint8") << 1
+            combination |= veg2.present(vi).view("uint8")
+            res = values.take(combination)
+            res[nodata_one] = 4
+            res[nodata_both] = 255
             self._delta[vi] = ma.masked_equal(res, 255)
 
         self._n1 = n1
 
-    def write(self, folder, overwrite_files=False):
+    def write(self, folder, overwrite_files=False, writer=None):
         """ Writes the difference grids to grid files.
 
         The differences are coded using these values:
@@ -972,22 +2002,19 @@ class NicheDelta(object):
             Path to which the output files will be written.
         overwrite_files: bool
             Whether files should be overwritten on save.
+        writer: GridWriter
+            Compression, tiling and number of threads used to write the
+            files. By default DEFLATE compressed files are written by a
+            single thread.
         """
+        import pandas as pd
 
         if not os.path.exists(folder):
             os.makedirs(folder)
 
-        params = dict(
-            driver='GTiff',
-            height=self._context.height,
-            width=self._context.width,
-            crs=self._context.crs,
-            transform=self._context.transform,
-            count=1,
-            dtype="uint8",
-            nodata=255,
-            compress="DEFLATE"
-        )
+        if writer is None:
+            writer = GridWriter()
+        params = writer.profile(self._context, "uint8", 255)
 
         prefix = ""
         if self.name != "":
@@ -1010,9 +2037,8 @@ class NicheDelta(object):
                     raise NicheException(
                         "File {} already exists".format(files[key]))
 
-        for vi in self._delta:
-            with rasterio.open(files[vi], 'w', **params) as dst:
-                dst.write(self._delta[vi], 1)
+        writer.write((files[vi], params, self._delta[vi])
+                     for vi in self._delta)
 
         # Also the resulting table is written
         self.table.to_csv(files["summary"], index=False)
@@ -1076,6 +2102,7 @@ class NicheDelta(object):
         =======
         df: `pandas.DataFrame`_
         """
+        import pandas as pd
         td = list()
         for i in self._delta:
             vi = pd.Series(self._delta[i].flatten())
@@ -1087,6 +2114,37 @@ class NicheDelta(object):
 
         return df
 
+    def zonal_stats(self, vectors, outside=True, attribute=None):
+        """Calculates zonal statistics of the differences using vectors
+
+        Parameters
+        ==========
+        vectors: path to a vector source or geo-like python objects
+            The shapes, see :func:`niche_vlaanderen.Niche.zonal_stats`.
+        outside: bool (default: True)
+           report values outside shapes as well. The area which is not covered
+           by any shapefile will get shape_id -1.
+        attribute: string(default None):
+            attribute of the vector source that will be exported along in the
+            table.
+
+        Returns
+        =======
+        table: pandas.DataFrame
+        """
+        zones = Zones(vectors, self._context)
+
+        veg_codes = list(self._delta)
+        # pixels which are nodata in both models (255) are not counted, like
+        # in the table
+        values = np.array([zones.take(self._delta[vi].data)
+                           for vi in veg_codes])
+        counts = zones.counts(values, self._values)
+
+        return zones.table(counts, veg_codes, self._labels,
+                           self._context.cell_area, attribute,
+                           self.table if outside else None)
+
 
 def conductivity2minerality(conductivity, minerality):
     """ Convert a grid with conductivity to a grid of minerality
@@ -1105,6 +2163,7 @@ def conductivity2minerality(conductivity, minerality):
       New grid where minerality values are stored. This will be a geotiff, so
       extension .tif is recommended.
     """
+    import rasterio
 
     # we will ignore future warnings from rasterio
     with warnings.catch_warnings():
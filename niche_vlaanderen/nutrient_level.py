@@ -1,8 +1,8 @@
-from pkg_resources import resource_filename
-
 import numpy as np
-import pandas as pd
-from .codetables import validate_tables_nutrient_level, check_codes_used
+from .codetables import validate_tables_nutrient_level, check_codes_used, \
+    code_index, load_code_tables, load_bundle, set_code_tables, \
+    system_table
+from .partition import SoilPartition
 
 
 class NutrientLevel(object):
@@ -10,33 +10,50 @@ class NutrientLevel(object):
      Class to calculate the NutrientLevel
 
      The used codetables can be overwritten by using the corresponding ct_*
-     arguments.
+     arguments, or by a bundle of compiled code tables (ct_bundle).
     '''
 
     nodata = 255  # unsigned 8 bit type is used
 
     def __init__(self, ct_lnk_soil_nutrient_level=None, ct_management=None,
                  ct_mineralisation=None, ct_soil_code=None,
-                 ct_nutrient_level=None):
+                 ct_nutrient_level=None, ct_bundle=None):
+        if ct_bundle is not None:
+            set_code_tables(self, load_bundle(
+                "nutrient_level", ct_bundle,
+                [ct_lnk_soil_nutrient_level, ct_management, ct_mineralisation,
+                 ct_soil_code, ct_nutrient_level]))
+            return
+
         if ct_lnk_soil_nutrient_level is None:
-            ct_lnk_soil_nutrient_level = resource_filename(
-                "niche_vlaanderen",
-                "system_tables/lnk_soil_nutrient_level.csv")
+            ct_lnk_soil_nutrient_level = system_table(
+                "lnk_soil_nutrient_level.csv")
         if ct_management is None:
-            ct_management = resource_filename(
-                "niche_vlaanderen", "system_tables/management.csv")
+            ct_management = system_table("management.csv")
         if ct_mineralisation is None:
-            ct_mineralisation = resource_filename(
-                "niche_vlaanderen",
-                "system_tables/nitrogen_mineralisation.csv")
+            ct_mineralisation = system_table("nitrogen_mineralisation.csv")
         if ct_soil_code is None:
-            ct_soil_code = resource_filename(
-                "niche_vlaanderen", "system_tables/soil_codes.csv")
+            ct_soil_code = system_table("soil_codes.csv")
 
         if ct_nutrient_level is None:
-            ct_nutrient_level = resource_filename(
-                "niche_vlaanderen", "system_tables/nutrient_level.csv")
+            ct_nutrient_level = system_table("nutrient_level.csv")
 
+        inner = all(v is None for v in self.__init__.__code__.co_varnames[1:])
+
+        tables = dict(ct_lnk_soil_nutrient_level=ct_lnk_soil_nutrient_level,
+                      ct_management=ct_management,
+                      ct_mineralisation=ct_mineralisation,
+                      ct_soil_code=ct_soil_code,
+                      ct_nutrient_level=ct_nutrient_level)
+        set_code_tables(self, load_code_tables(
+            "nutrient_level", tables,
+            lambda: self._load_code_tables(inner=inner, **tables)))
+
+    def _load_code_tables(self, ct_lnk_soil_nutrient_level, ct_management,
+                          ct_mineralisation, ct_soil_code, ct_nutrient_level,
+                          inner):
+        """Reads, validates and compiles the code tables"""
+        import pandas as pd
         self.ct_lnk_soil_nutrient_level = \
             pd.read_csv(ct_lnk_soil_nutrient_level)
         self._ct_management = \
@@ -50,7 +67,6 @@ class NutrientLevel(object):
             self._ct_mineralisation["nitrogen_mineralisation"]\
                 .astype("float64")
 
-        inner = all(v is None for v in self.__init__.__code__.co_varnames[1:])
         validate_tables_nutrient_level(self.ct_lnk_soil_nutrient_level,
                                        self._ct_management,
                                        self._ct_mineralisation,
@@ -68,75 +84,110 @@ class NutrientLevel(object):
                 self.ct_lnk_soil_nutrient_level["soil_name"]]\
             .reset_index().soil_code
 
-    def _calculate_mineralisation(self, soil_code_array, msw_array):
+        self._compile_lookup()
+        return dict(self.__dict__)
+
+    def _compile_lookup(self):
+        """Compiles the nutrient level table in a dense lookup table
+
+        All total_nitrogen_max borders are combined in a single sorted array,
+        so the position of a nitrogen value in this array determines its
+        class for every (soil_code, management_influence) group. The lookup
+        table contains the nutrient level for every group and position.
         """
-        Get nitrogen mineralisation for numpy arrays
+        ct = self.ct_lnk_soil_nutrient_level
+        self._management_codes = np.sort(self._ct_management.code.unique())
+        influence = self._ct_management.set_index("code").influence
+        # the last element is used for management codes not in the table
+        self._influence = np.append(
+            influence[self._management_codes].values, -99)
+
+        self._soil_codes = np.sort(ct.soil_code.unique())
+        self._influence_codes = np.sort(ct.management_influence.unique())
+        self._borders = np.unique(ct.total_nitrogen_max.astype("float64"))
+
+        # values above the highest border of a group are not classified
+        overflow = self.nodata
+
+        n_groups = (self._soil_codes.size + 1) * (self._influence_codes.size
+                                                  + 1)
+        self._lookup = np.full((n_groups, self._borders.size + 1),
+                               self.nodata, dtype="uint8")
+
+        for name, subtable in ct.groupby(["soil_code",
+                                          "management_influence"]):
+            soil_selected, influence_selected = name
+            group = np.ravel_multi_index(
+                (code_index(soil_selected, self._soil_codes),
+                 code_index(influence_selected, self._influence_codes)),
+                (self._soil_codes.size + 1, self._influence_codes.size + 1))
+
+            # for every position in the combined borders, the number of
+            # borders of this group below it gives the class (like digitize)
+            rank = np.sort(np.searchsorted(
+                self._borders, subtable.total_nitrogen_max.astype("float64")))
+            index = np.searchsorted(rank, np.arange(self._borders.size + 1))
+            levels = np.append(subtable.nutrient_level.values, overflow)
+            self._lookup[group] = levels[index]
+
+    def _calculate_mineralisation(self, soil_code_array, msw_array,
+                                  partition=None):
         """
-        orig_shape = soil_code_array.shape
-        soil_code_array = soil_code_array.flatten()
-        msw_array = msw_array.flatten()
-        result = np.empty(soil_code_array.shape)
-        result[:] = np.nan
+        Get nitrogen mineralisation for numpy arrays
 
-        for code in self._ct_mineralisation.soil_code.unique():
+        The partition (SoilPartition) of soil_code_array is created if it is
+        not given.
+        """
+        if partition is None:
+            partition = SoilPartition(soil_code_array)
+        msw_array = partition.take(msw_array)
+        result = np.full(msw_array.shape, np.nan)
+
+        table = self._ct_mineralisation
+        for code, pixels in partition.slices():
+            select = table.soil_code == code
+            if not np.any(select):
+                continue
             # We must reset the index because digitize will give indexes
             # compared to the new table.
-            select = self._ct_mineralisation.soil_code == code
-            table_sel = self._ct_mineralisation[select].copy()
-            table_sel = table_sel.reset_index(drop=True)
-            soil_sel = (soil_code_array == code)
-            ix = np.digitize(msw_array[soil_sel], table_sel.msw_max,
+            table_sel = table[select].reset_index(drop=True)
+            ix = np.digitize(msw_array[pixels], table_sel.msw_max,
                              right=True)
 
-            result[soil_sel] = table_sel["nitrogen_mineralisation"].reindex(ix)
+            result[pixels] = table_sel["nitrogen_mineralisation"].reindex(ix)
 
         result[msw_array == -99] = np.nan
-        result = result.reshape(orig_shape)
-        return result
+        return partition.put(result)
 
-    def _calculate(self, management, soil_code, nitrogen, inundation):
+    def _calculate(self, management, soil_code, nitrogen, inundation,
+                   partition=None):
         """
         Calculates the nutrient level using previously calculated nitrogen
+
+        If the partition (SoilPartition) of soil_code is given, its codes are
+        checked rather than the grid.
         """
         check_codes_used("management", management,
                          self._ct_management["code"])
-        check_codes_used("soil_code", soil_code,
+        check_codes_used("soil_code", soil_code if partition is None
+                         else partition.codes,
                          self._ct_soil_code["soil_code"])
 
-        # calculate management influence
-        influence = np.full(management.shape, -99)  # -99 used as no data value
-        for i in self._ct_management.code.unique():
-            sel_grid = (management == i)
-            sel_ct = (self._ct_management.code == i)
-            influence[sel_grid] = \
-                self._ct_management[sel_ct].influence.values[0]
-
-        # flatten all input layers (necessary for digitize)
-        orig_shape = soil_code.shape
-        soil_code = soil_code.flatten()
-        nitrogen = nitrogen.flatten()
-
-        inundation = inundation.flatten()
-        influence = influence.flatten()
-
-        # search for classification values in nutrient level codetable
-        result = np.full(influence.shape, self.nodata, dtype='uint8')
-
-        for name, subtable in self.ct_lnk_soil_nutrient_level.groupby(
-                ["soil_code", "management_influence"]):
-
-            soil_selected, influence_selected = name
-            table_sel = subtable.copy(deep=True).reset_index(drop=True)
+        # calculate management influence, -99 is used as no data value
+        influence = self._influence[code_index(management,
+                                               self._management_codes)]
 
-            index = np.digitize(nitrogen, table_sel.total_nitrogen_max,
-                                right=True)
-            selection = ((soil_code == soil_selected) &
-                         (influence == influence_selected))
+        # look up the group and the position of the nitrogen value for every
+        # pixel in the compiled table
+        group = np.ravel_multi_index(
+            (code_index(soil_code, self._soil_codes),
+             code_index(influence, self._influence_codes)),
+            (self._soil_codes.size + 1, self._influence_codes.size + 1))
+        position = np.searchsorted(self._borders, nitrogen)
 
-            result[selection] = \
-                table_sel.nutrient_level.reindex(index)[selection]
+        result = self._lookup[group, position]
 
-        # np.nan values are not ignored in np.digitize
+        # np.nan values are not ignored in np.searchsorted
         result[np.isnan(nitrogen)] = self.nodata
 
         # Note that niche_vlaanderen is different from the original (Dutch)
@@ -144,7 +195,6 @@ class NutrientLevel(object):
         # only if nutrient_level < 4 the inundation rule is applied.
         selection = ((result < 4) & (result != self.nodata))
         result[selection] = (result + (inundation > 0))[selection]
-        result = result.reshape(orig_shape)
         return result
 
     def calculate(self, soil_code, msw, nitrogen_atmospheric, nitrogen_animal,
@@ -178,10 +228,11 @@ class NutrientLevel(object):
 
         """
 
-        nitrogen_mineralisation = self._calculate_mineralisation(soil_code,
-                                                                 msw)
+        partition = SoilPartition(soil_code)
+        nitrogen_mineralisation = self._calculate_mineralisation(
+            soil_code, msw, partition)
         total_nitrogen = (nitrogen_mineralisation + nitrogen_atmospheric
                           + nitrogen_animal + nitrogen_fertilizer)
         nutrient_level = self._calculate(management, soil_code, total_nitrogen,
-                                         inundation)
+                                         inundation, partition)
         return nutrient_level
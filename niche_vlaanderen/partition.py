@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class SoilPartition(object):
+    """Groups the pixels of a grid by soil code
+
+    The pixel indices are sorted by soil code once (CSR layout: the indices
+    in order, with an offset per soil code), so calculations which are done
+    per soil code only use the pixels of that soil code, rather than
+    selecting them from the full grid for every code. Grids are taken in
+    partition order, where the pixels of a soil code are contiguous, and the
+    result is put back in grid order.
+
+    Parameters
+    ----------
+    soil_code: numpy.array
+        Grid with the soil codes. -99 (nodata) is a soil code like the others,
+        and all nan pixels (of a float grid) are a single soil code.
+
+    Attributes
+    ----------
+    codes: numpy.array
+        The sorted (unique) soil codes which are present in the grid
+    order: numpy.array
+        Indices of the pixels (in the flattened grid), sorted by soil code
+    offsets: numpy.array
+        The pixels of codes[i] are order[offsets[i]:offsets[i + 1]]
+    """
+
+    def __init__(self, soil_code):
+        soil_code = np.asarray(soil_code)
+        self.shape = soil_code.shape
+        flat = soil_code.ravel()
+        self.order = np.argsort(flat)
+        ordered = flat.take(self.order)
+        different = ordered[1:] != ordered[:-1]
+        if ordered.dtype.kind == "f":
+            # nan != nan, so the nan pixels (sorted last) are joined
+            different &= ~(np.isnan(ordered[1:]) & np.isnan(ordered[:-1]))
+        starts = np.flatnonzero(different) + 1
+        self.codes = ordered[np.append(0, starts)] if flat.size > 0 \
+            else ordered
+        self.offsets = np.concatenate(([0], starts, [flat.size]))
+
+    @property
+    def size(self):
+        return self.order.size
+
+    def slices(self):
+        """Generator of (soil code, slice) tuples, where the slice selects
+        the pixels of the soil code from a grid in partition order"""
+        for i, code in enumerate(self.codes.tolist()):
+            yield code, slice(self.offsets[i], self.offsets[i + 1])
+
+    def take(self, values):
+        """Flattened copy of the grid values in partition order"""
+        return np.asarray(values).ravel().take(self.order)
+
+    def put(self, values, dtype=None):
+        """Grid (with the shape of the soil code grid) of the values in
+        partition order"""
+        values = np.asarray(values)
+        result = np.empty(values.shape[:-1] + (self.size, ),
+                          dtype=dtype or values.dtype)
+        result[..., self.order] = values
+        return result.reshape(values.shape[:-1] + self.shape)
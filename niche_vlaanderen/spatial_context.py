@@ -225,6 +225,35 @@ class SpatialContext(object):
 
         return window
 
+    def blocks(self, block_size):
+        """Splits the grid in blocks
+
+        Parameters
+        ==========
+
+        block_size: (int, int)
+            Maximum number of rows and columns of a block. Blocks at the
+            bottom and right side of the grid can be smaller.
+
+        Returns
+        =======
+        Generator of windows ((row_start, row_stop), (col_start, col_stop)),
+        ordered row by row. The block size is checked before the generator
+        is returned.
+        """
+        rows, cols = int(block_size[0]), int(block_size[1])
+        if rows < 1 or cols < 1:
+            raise SpatialContextError("Error: block size must be positive")
+
+        return self._blocks(rows, cols)
+
+    def _blocks(self, rows, cols):
+        height, width = int(self.height), int(self.width)
+        for row in range(0, height, rows):
+            for col in range(0, width, cols):
+                yield ((row, min(row + rows, height)),
+                       (col, min(col + cols, width)))
+
     @property
     def cell_area(self):
         return abs(self.transform[0] * self.transform[4])
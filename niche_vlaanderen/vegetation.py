@@ -1,14 +1,19 @@
 from __future__ import division
-from pkg_resources import resource_filename
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover
+    # Python 2
+    from collections import Mapping
 
 import numpy as np
-import pandas as pd
-import warnings
 
 from .nutrient_level import NutrientLevel
 from .acidity import Acidity
-from .codetables import validate_tables_vegetation, check_codes_used
+from .codetables import validate_tables_vegetation, check_codes_used, \
+    code_index, load_code_tables, load_bundle, set_code_tables, \
+    system_table
 from .exception import NicheException
+from .partition import SoilPartition
 
 
 class Vegetation(object):
@@ -29,46 +34,75 @@ class Vegetation(object):
     """
 
     nodata_veg = 255  # uint8
+    nodata_deviation = -32768  # int16
+
+    # data types in which the deviation can be calculated
+    deviation_dtypes = ("float64", "float32", "int16")
+
+    # columns of the vegetation code table that are used as lookup keys
+    _lookup_columns = ["soil_code", "nutrient_level", "acidity", "management",
+                       "inundation"]
 
     def __init__(self, ct_vegetation=None, ct_soil_code=None, ct_acidity=None,
                  ct_management=None, ct_nutrient_level=None,
-                 ct_inundation=None):
+                 ct_inundation=None, ct_bundle=None):
         """ Initializes the Vegetation helper class
 
         This class initializes the Vegetation helper class. By default it uses
         the code tables supplied by the niche_vlaanderen package. It is
         possible to overwrite this by supplying the niche_vlaanderen parameter
 
+        Instead of separate code tables, a bundle of compiled code tables
+        (see Niche.compile_code_tables) can be given as ct_bundle.
         """
+        # reduced rule tables (used when not all columns are used)
+        self._rules_reduced = dict()
+
+        if ct_bundle is not None:
+            set_code_tables(self, load_bundle(
+                "vegetation", ct_bundle,
+                [ct_vegetation, ct_soil_code, ct_acidity, ct_management,
+                 ct_nutrient_level, ct_inundation]))
+            return
 
         if ct_vegetation is None:
-            ct_vegetation = resource_filename(
-                "niche_vlaanderen",
-                "system_tables/niche_vegetation.csv")
+            ct_vegetation = system_table("niche_vegetation.csv")
 
         # Note that the next code tables are only used for validation, they are
         # not part of the logic of the vegetation class
 
         if ct_soil_code is None:
-            ct_soil_code = resource_filename(
-                "niche_vlaanderen", "system_tables/soil_codes.csv")
+            ct_soil_code = system_table("soil_codes.csv")
 
         if ct_acidity is None:
-            ct_acidity = resource_filename(
-                "niche_vlaanderen", "system_tables/acidity.csv")
+            ct_acidity = system_table("acidity.csv")
 
         if ct_nutrient_level is None:
-            ct_nutrient_level = resource_filename(
-                "niche_vlaanderen", "system_tables/nutrient_level.csv")
+            ct_nutrient_level = system_table("nutrient_level.csv")
 
         if ct_management is None:
-            ct_management = resource_filename(
-                "niche_vlaanderen", "system_tables/management.csv")
+            ct_management = system_table("management.csv")
 
         if ct_inundation is None:
-            ct_inundation = resource_filename(
-                "niche_vlaanderen", "system_tables/inundation.csv")
+            ct_inundation = system_table("inundation.csv")
 
+        # we check for inner joins if codetables are not overwritten
+        # https://github.com/inbo/niche_vlaanderen/issues/106
+        inner = all(v is None for v in self.__init__.__code__.co_varnames[1:])
+
+        tables = dict(ct_vegetation=ct_vegetation, ct_soil_code=ct_soil_code,
+                      ct_acidity=ct_acidity, ct_management=ct_management,
+                      ct_nutrient_level=ct_nutrient_level,
+                      ct_inundation=ct_inundation)
+        set_code_tables(self, load_code_tables(
+            "vegetation", tables,
+            lambda: self._load_code_tables(inner=inner, **tables)))
+
+    def _load_code_tables(self, ct_vegetation, ct_soil_code, ct_acidity,
+                          ct_management, ct_nutrient_level, ct_inundation,
+                          inner):
+        """Reads, validates and compiles the code tables"""
+        import pandas as pd
         self._ct_vegetation = pd.read_csv(ct_vegetation)
         self._ct_soil_code = pd.read_csv(ct_soil_code)
         self._ct_acidity = pd.read_csv(ct_acidity)
@@ -76,10 +110,6 @@ class Vegetation(object):
         self._ct_management = pd.read_csv(ct_management)
         self._ct_inundation = pd.read_csv(ct_inundation)
 
-        # we check for inner joins if codetables are not overwritten
-        # https://github.com/inbo/niche_vlaanderen/issues/106
-        inner = all(v is None for v in self.__init__.__code__.co_varnames[1:])
-
         validate_tables_vegetation(ct_vegetation=self._ct_vegetation,
                                    ct_soil_code=self._ct_soil_code,
                                    ct_acidity=self._ct_acidity,
@@ -94,9 +124,100 @@ class Vegetation(object):
             self._ct_soil_code.soil_code[self._ct_vegetation["soil_name"]]\
                 .reset_index().soil_code
 
+        self._compile_lookup()
+        return dict((k, v) for k, v in self.__dict__.items()
+                    if k != "_rules_reduced")
+
+    def _compile_lookup(self):
+        """Compiles the vegetation code table into dense lookup arrays
+
+        Every row of the vegetation table is a rule which is valid for one
+        combination of the columns in _lookup_columns. The rules are stored in
+        a boolean array with one axis per column, containing True if a
+        vegetation type can occur for that combination. Every axis has an extra
+        slot for values which are not in the code table.
+
+        As the code tables are validated to contain only one mhw/mlw range per
+        vegetation type and soil, the mhw/mlw borders are stored in separate
+        arrays indexed by vegetation type and soil.
+        """
+        ct = self._ct_vegetation
+        self._veg_codes = np.unique(ct["veg_code"])
+        self._codes = [np.unique(ct[c]) for c in self._lookup_columns]
+
+        veg_index = code_index(ct["veg_code"], self._veg_codes)
+        index = tuple(code_index(ct[c], codes)
+                      for c, codes in zip(self._lookup_columns, self._codes))
+
+        shape = (self._veg_codes.size,) + tuple(c.size + 1
+                                                for c in self._codes)
+        self._rules = np.zeros(shape, dtype=bool)
+        self._rules[(veg_index,) + index] = True
+
+        # the extra soil slot has nan borders, so it never matches
+        soil_index = index[0]
+        self._borders = dict()
+        for col in ["mhw_min", "mhw_max", "mlw_min", "mlw_max"]:
+            border = np.full(shape[:2], np.nan)
+            border[veg_index, soil_index] = ct[col]
+            self._borders[col] = border
+
+    def _get_rules(self, used):
+        """Rule table, reduced to the lookup columns that are used
+
+        Parameters
+        ----------
+        used: tuple of bool
+            one value per column in _lookup_columns
+
+        Returns
+        -------
+        rules: numpy.array
+            boolean array with shape (number of vegetation types, number of
+            combinations of the used columns)
+        """
+        if used not in self._rules_reduced:
+            unused = tuple(i + 1 for i, u in enumerate(used) if not u)
+            rules = self._rules.any(axis=unused)
+            self._rules_reduced[used] = rules.reshape(rules.shape[0], -1)
+        return self._rules_reduced[used]
+
+    def _input_nodata(self, soil_code, mhw, mlw, management=None,
+                      inundation=None):
+        """Returns the pixels for which an input layer (other than the
+        abiotic layers) contains nodata"""
+        nodata = ((soil_code == -99) | np.isnan(mhw) | np.isnan(mlw))
+
+        if inundation is not None:
+            nodata |= (inundation == -99)
+
+        if management is not None:
+            nodata |= (management == -99)
+
+        return nodata
+
+    def _nodata(self, soil_code, mhw, mlw, nutrient_level=None, acidity=None,
+                management=None, inundation=None, full_model=True,
+                input_nodata=None):
+        """Returns the pixels for which no vegetation can be predicted
+
+        input_nodata is the result of _input_nodata, which is calculated if
+        it is not given.
+        """
+        if input_nodata is None:
+            input_nodata = self._input_nodata(soil_code, mhw, mlw,
+                                              management, inundation)
+
+        if full_model:
+            return input_nodata | (nutrient_level == NutrientLevel.nodata) \
+                | (acidity == Acidity.nodata)
+
+        return input_nodata
+
     def calculate(self, soil_code, mhw, mlw, nutrient_level=None, acidity=None,
                   management=None, inundation=None, return_all=True,
-                  full_model=True):
+                  full_model=True, packed=False, partition=None,
+                  input_nodata=None):
         """ Calculate vegetation types based on input arrays
 
         Parameters
@@ -104,6 +225,17 @@ class Vegetation(object):
         return_all: boolean
             A boolean (default=True) whether all grids should be returned or
             only grids containing data.
+        packed: boolean
+            Return the vegetation types as a PackedVegetation, which stores
+            the presence of all vegetation types in the bits of a single
+            grid, rather than as a dict of grids.
+        partition: SoilPartition
+            The pixels grouped by soil_code. If it is not given, it is
+            created from soil_code.
+        input_nodata: numpy.array
+            The pixels for which soil_code, mhw, mlw, management or
+            inundation contain nodata (see _input_nodata). If it is not
+            given, it is determined from these grids.
 
         Returns
         -------
@@ -117,17 +249,9 @@ class Vegetation(object):
 
         """
 
-        nodata = ((soil_code == -99) | np.isnan(mhw) | np.isnan(mlw))
-
-        if full_model:
-            nodata = nodata | (nutrient_level == NutrientLevel.nodata) \
-                     | (acidity == Acidity.nodata)
-
-        if inundation is not None:
-            nodata = nodata | (inundation == -99)
-
-        if management is not None:
-            nodata = nodata | (management == -99)
+        nodata = self._nodata(soil_code, mhw, mlw, nutrient_level, acidity,
+                              management, inundation, full_model,
+                              input_nodata)
 
         if np.all(nodata):
             raise NicheException("only nodata values in prediction")
@@ -145,42 +269,79 @@ class Vegetation(object):
             check_codes_used("management", management,
                              self._ct_management["code"])
 
-        veg_bands = dict()
+        if partition is None:
+            partition = SoilPartition(soil_code)
+
+        # the pixels are evaluated in partition order, so the rules of a
+        # soil code are only evaluated for the pixels of that soil code.
+
+        # look up the position of every pixel in the compiled rule table
+        values = [soil_code, nutrient_level, acidity, management, inundation]
+        used = (True, full_model, full_model, management is not None,
+                inundation is not None)
+        index = [code_index(partition.take(v), codes)
+                 for v, codes, u in zip(values, self._codes, used) if u]
+        dims = [codes.size + 1
+                for codes, u in zip(self._codes, used) if u]
+        key = np.ravel_multi_index(index, dims)
+        rules = self._get_rules(used)
+
+        valid = ~partition.take(nodata)
+        mhw = partition.take(mhw)
+        mlw = partition.take(mlw)
+
+        # borders are compared in the data type of the input
+        mhw_type = mhw.dtype if mhw.dtype.kind == 'f' else 'float64'
+        mlw_type = mlw.dtype if mlw.dtype.kind == 'f' else 'float64'
+        borders = [self._borders["mhw_min"].astype(mhw_type),
+                   self._borders["mhw_max"].astype(mhw_type),
+                   self._borders["mlw_min"].astype(mlw_type),
+                   self._borders["mlw_max"].astype(mlw_type)]
+        # soil codes without borders (no rules) can not match
+        has_borders = ~np.any(np.isnan(borders), axis=0)
+
+        # position of the soil codes of the partition in the code table
+        soils = list(zip(partition.slices(),
+                         code_index(partition.codes, self._codes[0]).tolist()))
+
+        present = []
         occurrence = dict()
-
-        for veg_code, subtable in self._ct_vegetation.groupby(["veg_code"]):
-            subtable = subtable.reset_index()
-            # vegi is the prediction for the current veg_code
-            # it is a logical or of the result of every row:
-            # if a row is true for a pixel, that vegetation can occur
-            vegi = np.zeros(soil_code.shape, dtype=bool)
-            for row in subtable.itertuples():
-                warnings.simplefilter(action='ignore', category=RuntimeWarning)
-                current_row = ((row.soil_code == soil_code)
-                               & (row.mhw_min >= mhw) & (row.mhw_max <= mhw)
-                               & (row.mlw_min >= mlw) & (row.mlw_max <= mlw))
-                warnings.simplefilter("default")
-                if full_model:
-                    current_row = (current_row
-                                   & (nutrient_level == row.nutrient_level)
-                                   & (row.acidity == acidity))
-
-                if inundation is not None:
-                    current_row = current_row & (row.inundation == inundation)
-                if management is not None:
-                    current_row = current_row & (row.management == management)
-                vegi = vegi | current_row
-            vegi = vegi.astype("uint8")
-            vegi[nodata] = self.nodata_veg
-
-            if return_all or np.any(vegi):
-                veg_bands[veg_code] = vegi
+        for i, veg_code in enumerate(self._veg_codes.tolist()):
+            # vegi is the prediction for the current veg_code: the pixel must
+            # match a rule of the code table and be within the mhw/mlw range
+            # of its soil.
+            vegi = np.zeros(partition.size, dtype="bool")
+            for (code, pixels), j in soils:
+                if not has_borders[i, j]:
+                    continue
+                mhw_min, mhw_max, mlw_min, mlw_max = \
+                    (b[i, j] for b in borders)
+                with np.errstate(invalid='ignore'):
+                    vegi[pixels] = (rules[i][key[pixels]]
+                                    & (mhw_min >= mhw[pixels])
+                                    & (mhw_max <= mhw[pixels])
+                                    & (mlw_min >= mlw[pixels])
+                                    & (mlw_max <= mlw[pixels]))
+            vegi &= valid
+
+            if return_all or np.any(vegi) or not np.all(valid):
+                present.append((veg_code, vegi))
 
             occurrence[veg_code] = np.asscalar(
-                (np.sum(vegi == 1) / (vegi.size - np.sum(nodata))))
+                (np.sum(vegi) / (vegi.size - np.sum(nodata))))
+
+        ordered = PackedVegetation([vi for vi, _ in present], ~valid)
+        for veg_code, vegi in present:
+            ordered.set_present(veg_code, vegi)
+        veg_bands = PackedVegetation(ordered.veg_codes, nodata)
+        veg_bands.words = partition.put(ordered.words)
+
+        if not packed:
+            veg_bands = dict((vi, veg_bands[vi]) for vi in veg_bands)
         return veg_bands, occurrence
 
-    def calculate_deviation(self, soil_code, mhw, mlw):
+    def calculate_deviation(self, soil_code, mhw, mlw, out=None,
+                            dtype="float64", lazy=False):
         """ Calculates the deviation between the mhw/mlw and the reference
 
         This function calculates the difference between the mhw and mlw and
@@ -192,6 +353,24 @@ class Vegetation(object):
         Values of zero indicate that the vegetation type can occur based on
         soil type and the value under consideration (mhw or mlw)
 
+        Parameters
+        ----------
+        out: numpy.array
+            Optional array with shape (2, number of vegetation types)
+            + shape of soil_code and data type dtype, in which the deviation
+            is calculated. The first index is 0 for mhw and 1 for mlw, the
+            second the position of the vegetation type in the sorted
+            vegetation codes. By default a new array is allocated.
+        dtype: "float64", "float32" or "int16"
+            Data type of the deviation. Nodata is NaN for float types. For
+            int16 the deviation is rounded to whole centimetres and nodata is
+            nodata_deviation (-32768).
+        lazy: bool
+            Rather than calculating all deviation grids, return a mapping
+            which calculates the deviation of a vegetation type when it is
+            used. Only the mhw and mlw deviation of the last used vegetation
+            type are kept in memory.
+
         Returns
         -------
         difference: dict
@@ -199,56 +378,242 @@ class Vegetation(object):
             value an the actual value.
             Keys are eg mhw_01 for mhw and vegetation type 01
         """
+        if dtype not in self.deviation_dtypes:
+            raise NicheException(
+                "Invalid deviation data type {}, possible: {}".format(
+                    dtype, ", ".join(self.deviation_dtypes)))
+
         nodata = ((soil_code == -99) | np.isnan(mhw) | np.isnan(mlw))
+        soil_index = code_index(soil_code, self._codes[0])
+        # the borders of the last soil index are nan, so nodata pixels get a
+        # nan deviation
+        soil_index[nodata] = self._codes[0].size
+
+        if lazy:
+            if out is not None:
+                raise NicheException(
+                    "A lazy deviation can not be calculated in an array")
+            return _LazyDeviation(self, soil_index, mhw, mlw, dtype)
+
+        shape = (2, self._veg_codes.size) + np.shape(soil_code)
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif out.shape != shape or out.dtype != dtype:
+            raise NicheException(
+                "Deviation array must have shape {} and type {}".format(
+                    shape, dtype))
 
         difference = dict()
 
-        veg = self._ct_vegetation[["veg_code", "soil_code", "mhw_min",
-                                   "mhw_max", "mlw_min", "mlw_max"]]
+        for i, veg_code in enumerate(self._veg_codes.tolist()):
+            self._deviation_bands(i, soil_index, mhw, mlw, out[:, i])
+            difference["mhw_%02d" % veg_code] = out[0, i]
+            difference["mlw_%02d" % veg_code] = out[1, i]
 
-        veg = veg.drop_duplicates()
+        return difference
+
+    def _deviation_bands(self, i, soil_index, mhw, mlw, out):
+        """Calculates the mhw (out[0]) and mlw (out[1]) deviation of the
+        vegetation type at position i"""
+        for j, (key, value) in enumerate((("mhw", mhw), ("mlw", mlw))):
+            if out.dtype.kind == 'f':
+                self._deviation(key, i, soil_index, value, out[j])
+            else:
+                band = np.empty(out.shape[1:])
+                self._deviation(key, i, soil_index, value, band)
+                nodata = np.isnan(band)
+                with np.errstate(invalid='ignore'):
+                    np.clip(np.rint(band), -32767, 32767, out=band)
+                band[nodata] = self.nodata_deviation
+                out[j] = band
+
+    def _deviation(self, key, i, soil_index, value, out):
+        """Calculates the deviation of mhw or mlw for one vegetation type
+
+        Parameters
+        ----------
+        key: "mhw" or "mlw"
+        i: position of the vegetation type in the vegetation codes
+        soil_index: position of the soil codes in the soil codes of the table
+        value: mhw or mlw
+        out: array in which the result is stored
+        """
+        # borders are compared in the data type of the input
+        dtype = value.dtype if value.dtype.kind == 'f' else 'float64'
+        # note that the maximum is the lowest value (mhw/mlw are positive
+        # below ground level)
+        lower = self._borders[key + "_max"][i].astype(dtype)
+        upper = self._borders[key + "_min"][i].astype(dtype)
+
+        with np.errstate(invalid='ignore'):
+            if not np.any(lower > upper):
+                # values outside the range of the soil are clipped to the
+                # range, the deviation is the clipped distance.
+                np.subtract(value, np.clip(value, lower.take(soil_index),
+                                           upper.take(soil_index)), out=out)
+            else:
+                # for overlapping borders the upper border has precedence
+                lower = lower.take(soil_index)
+                upper = upper.take(soil_index)
+                out[...] = np.where(
+                    upper < value, value - upper,
+                    np.where(lower > value, value - lower,
+                             np.where((upper >= value) & (lower <= value),
+                                      0, np.nan)))
+
+
+class _LazyDeviation(Mapping):
+    """Deviation grids which are calculated when they are used
+
+    The mhw and mlw deviation of a vegetation type are calculated together,
+    the deviation of the previous vegetation type is then released. The keys
+    are ordered per vegetation type, so iterating over the grids calculates
+    every vegetation type once.
+    """
 
-        warnings.simplefilter(action='ignore', category=RuntimeWarning)
+    def __init__(self, vegetation, soil_index, mhw, mlw, dtype):
+        self._vegetation = vegetation
+        self._arguments = (soil_index, mhw, mlw)
+        self._dtype = dtype
+        self._keys = []
+        self._position = dict()
+        for i, veg_code in enumerate(vegetation._veg_codes.tolist()):
+            for j, key in enumerate(("mhw", "mlw")):
+                name = "%s_%02d" % (key, veg_code)
+                self._keys.append(name)
+                self._position[name] = (i, j)
+        self._current = (None, None)
+
+    def __getitem__(self, key):
+        i, j = self._position[key]
+        if self._current[0] != i:
+            soil_index = self._arguments[0]
+            out = np.empty((2, ) + soil_index.shape, dtype=self._dtype)
+            self._vegetation._deviation_bands(i, *self._arguments, out=out)
+            self._current = (i, out)
+        return self._current[1][j]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class PackedVegetation(Mapping):
+    """Presence of a number of vegetation types, packed as bits
+
+    The presence of every vegetation type is stored as one bit of a uint32
+    word per pixel (using more words if there are more than 32 types) and a
+    single nodata mask is shared by all vegetation types. This takes a
+    fraction of the memory of one uint8 grid per vegetation type.
+
+    It can be used as a dict of vegetation grids (0: not present, 1: present,
+    255: nodata): a grid is unpacked when a vegetation type is accessed.
 
-        for veg_code, subtable in veg.groupby(["veg_code"]):
-            subtable = subtable.reset_index()
+    Parameters
+    ----------
+    veg_codes: list
+        The vegetation codes
+    nodata: numpy.array
+        Boolean grid containing the pixels without a prediction
+    """
 
-            mhw_diff = np.full(soil_code.shape, np.nan)
-            mlw_diff = np.full(soil_code.shape, np.nan)
+    _bits = 32
 
-            for row in subtable.itertuples():
+    def __init__(self, veg_codes, nodata):
+        self.veg_codes = list(veg_codes)
+        self.nodata = nodata
+        self._position = dict((vi, i) for i, vi in enumerate(self.veg_codes))
+        words = -(-len(self.veg_codes) // self._bits)
+        self.words = np.zeros((words, ) + nodata.shape, dtype="uint32")
 
-                # mhw smaller than maximum
-                sel = (row.soil_code == soil_code) & (row.mhw_max > mhw)
-                mhw_diff[sel] = (mhw - row.mhw_max)[sel]
+    def _bit(self, vi):
+        """The word and bit mask used for vegetation type vi"""
+        i = self._position[vi]
+        return self.words[i // self._bits], np.uint32(1 << (i % self._bits))
 
-                # mhw larger than minimum
-                sel = (row.soil_code == soil_code) & (row.mhw_min < mhw)
-                mhw_diff[sel] = (mhw - row.mhw_min)[sel]
+    def set_present(self, vi, present):
+        """Sets the pixels where vegetation type vi is present
 
-                # mhw in range
-                sel = ((row.soil_code == soil_code) & (row.mhw_min >= mhw)
-                       & (row.mhw_max <= mhw))
-                mhw_diff[sel] = (np.zeros(soil_code.shape))[sel]
+        Parameters
+        ----------
+        present: numpy.array
+            Boolean grid, must be False for nodata pixels
+        """
+        word, bit = self._bit(vi)
+        word &= ~bit
+        word |= present * bit
 
-                # mlw smaller than maximum
-                sel = (row.soil_code == soil_code) & (row.mlw_max > mlw)
-                mlw_diff[sel] = (mlw - row.mlw_max)[sel]
+    def present(self, vi, out=None):
+        """Boolean grid of the pixels where vegetation type vi is present
 
-                # mlw larger than minimum
-                sel = (row.soil_code == soil_code) & (row.mlw_min < mlw)
-                mlw_diff[sel] = (mlw - row.mlw_min)[sel]
+        If out is given, the result is written to this (boolean) grid.
+        """
+        word, bit = self._bit(vi)
+        return np.not_equal(word & bit, 0, out=out)
 
-                # mlw in range
-                sel = ((row.soil_code == soil_code) & (row.mlw_min >= mlw)
-                       & (row.mlw_max <= mlw))
-                mlw_diff[sel] = (np.zeros(soil_code.shape))[sel]
+    def take(self, pixels):
+        """Values of a number of pixels for all vegetation types
 
-            mhw_diff[nodata] = np.NaN
-            mlw_diff[nodata] = np.NaN
+        Parameters
+        ----------
+        pixels: numpy.array
+            Indices of the pixels in the flattened grid
 
-            difference["mhw_%02d" % veg_code] = mhw_diff
-            difference["mlw_%02d" % veg_code] = mlw_diff
+        Returns
+        -------
+        values: numpy.array
+            uint8 array (vegetation types, pixels) with the presence of
+            every vegetation type for the pixels (0: not present,
+            1: present, 255: nodata)
+        """
+        words = self.words.reshape(self.words.shape[0], -1).take(pixels,
+                                                                 axis=1)
+        values = np.empty((len(self.veg_codes), ) + words.shape[1:],
+                          dtype="uint8")
+        for i in range(len(self.veg_codes)):
+            values[i] = (words[i // self._bits] >> (i % self._bits)) & 1
+        values[:, self.nodata.ravel().take(pixels)] = Vegetation.nodata_veg
+        return values
+
+    def counts(self):
+        """Number of pixels per vegetation type and presence
 
-        warnings.simplefilter("default")
-        return difference
+        Returns
+        -------
+        counts: dict
+            For every vegetation type, a pandas.Series with the number of
+            pixels which are not present (0), present (1) and nodata (255).
+        """
+        import pandas as pd
+        nodata = np.count_nonzero(self.nodata)
+        counts = dict()
+        for vi in self.veg_codes:
+            present = np.count_nonzero(self.present(vi))
+            counts[vi] = pd.Series(
+                [self.nodata.size - present - nodata, present, nodata],
+                index=[0, 1, 255])
+        return counts
+
+    def set_window(self, window, other):
+        """Copies a PackedVegetation with the same vegetation types to a
+        window (tuple of slices) of this one"""
+        if other.veg_codes != self.veg_codes:
+            raise NicheException("Vegetation types are not equal")
+        self.words[(slice(None), ) + window] = other.words
+        self.nodata[window] = other.nodata
+
+    def __getitem__(self, vi):
+        band = self.present(vi).view("uint8")
+        band[self.nodata] = Vegetation.nodata_veg
+        return band
+
+    def __contains__(self, vi):
+        return vi in self._position
+
+    def __iter__(self):
+        return iter(self.veg_codes)
+
+    def __len__(self):
+        return len(self.veg_codes)
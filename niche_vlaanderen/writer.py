@@ -0,0 +1,162 @@
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from .exception import NicheException
+
+
+class GridWriter(object):
+    """Writes grids to (compressed) GeoTIFF files
+
+    The grids are compressed and written by a pool of threads, so a number
+    of files are written at the same time. GDAL can also use more threads to
+    compress a single file. The default settings give the same files as a
+    write without a GridWriter: DEFLATE compressed GeoTIFFs, written by a
+    single thread.
+
+    Parameters
+    ----------
+    compress: "DEFLATE", "ZSTD", "LZW" or None
+        Compression of the files. ZSTD requires GDAL to be built with ZSTD
+        support.
+    level: int
+        Compression level: 1-9 for DEFLATE, 1-22 for ZSTD. By default the
+        GDAL default is used.
+    predictor: int
+        1 (none), 2 (horizontal differencing) or 3 (floating point
+        prediction). As GDAL supports horizontal differencing only for
+        integer grids and floating point prediction only for float grids,
+        2 and 3 both select the predictor which fits the data type of a
+        grid. By default no predictor is used.
+    tiled: bool
+        Write tiled files rather than files in strips.
+    blocksize: int
+        Width and height of a tile of a tiled file.
+    threads: int
+        Number of files which are written at the same time.
+    gdal_threads: int or "ALL_CPUS"
+        Number of threads GDAL uses to compress a single file.
+    """
+
+    compressions = ("DEFLATE", "ZSTD", "LZW")
+
+    def __init__(self, compress="DEFLATE", level=None, predictor=None,
+                 tiled=False, blocksize=256, threads=1, gdal_threads=None):
+        if compress is not None and compress not in self.compressions:
+            raise NicheException(
+                "Invalid compression {}, possible: {}".format(
+                    compress, ", ".join(self.compressions)))
+        if level is not None and compress not in ("DEFLATE", "ZSTD"):
+            raise NicheException(
+                "A compression level can only be used with DEFLATE or ZSTD")
+        if predictor not in (None, 1, 2, 3):
+            raise NicheException("Invalid predictor {}".format(predictor))
+        if blocksize < 16 or blocksize % 16 != 0:
+            raise NicheException("Block size must be a multiple of 16")
+        if threads < 1:
+            raise NicheException("The number of threads must be positive")
+
+        self.compress = compress
+        self.level = level
+        self.predictor = predictor
+        self.tiled = tiled
+        self.blocksize = blocksize
+        self.threads = threads
+        self.gdal_threads = gdal_threads
+
+    @property
+    def options(self):
+        """The settings of the writer, which differ from the defaults"""
+        default = GridWriter()
+        return dict((key, value) for key, value in self.__dict__.items()
+                    if value != getattr(default, key))
+
+    def creation_options(self, dtype=None):
+        """GDAL creation options of the files with grids of type dtype"""
+        options = dict()
+        if self.compress is not None:
+            options["compress"] = self.compress
+        if self.level is not None:
+            key = "zlevel" if self.compress == "DEFLATE" else "zstd_level"
+            options[key] = self.level
+        if self.predictor is not None:
+            options["predictor"] = self.predictor
+            if self.predictor > 1 and dtype is not None:
+                options["predictor"] = \
+                    3 if np.dtype(dtype).kind == 'f' else 2
+        if self.tiled:
+            options.update(tiled=True, blockxsize=self.blocksize,
+                           blockysize=self.blocksize)
+        if self.gdal_threads is not None:
+            options["num_threads"] = self.gdal_threads
+        return options
+
+    def profile(self, context, dtype, nodata, **kwargs):
+        """Parameters to open a file for writing
+
+        Parameters
+        ----------
+        context: SpatialContext
+            extent of the grids
+        dtype, nodata:
+            data type and nodata value of the grids
+        kwargs:
+            other parameters, these overrule the settings of the writer
+        """
+        params = dict(
+            driver='GTiff',
+            height=context.height,
+            width=context.width,
+            crs=context.crs,
+            transform=context.transform,
+            count=1,
+            dtype=dtype,
+            nodata=nodata
+        )
+        params.update(self.creation_options(dtype))
+        params.update(kwargs)
+        return params
+
+    def write(self, grids):
+        """Writes a number of grids
+
+        Parameters
+        ----------
+        grids: iterable
+            (path, profile, band) tuples. The bands are taken from grids in
+            the calling thread, while the previous bands are being written,
+            so grids can be a generator which creates the bands one by one.
+            At most two bands per thread are waiting to be written.
+        """
+        if self.threads == 1:
+            for path, profile, band in grids:
+                _write_grid(path, profile, band)
+            return
+
+        slots = threading.BoundedSemaphore(2 * self.threads)
+
+        def write_grid(path, profile, band):
+            try:
+                _write_grid(path, profile, band)
+            finally:
+                slots.release()
+
+        pool = ThreadPool(self.threads)
+        try:
+            results = []
+            for grid in grids:
+                slots.acquire()
+                results.append(pool.apply_async(write_grid, grid))
+            # raises the first error of a thread, if any
+            for result in results:
+                result.get()
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _write_grid(path, profile, band):
+    import rasterio
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(band, 1)
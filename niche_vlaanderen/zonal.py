@@ -0,0 +1,188 @@
+import math
+
+import numpy as np
+
+from .codetables import code_index
+
+
+class Zones(object):
+    """The pixels of a grid which are within a number of shapes (zones)
+
+    Every shape is rasterized once (using the pixel centres, like
+    rasterstats), so the pixels of the zones can be used for any number of
+    grids with the same spatial context. A pixel can be part of more than
+    one zone, when the shapes overlap.
+
+    Parameters
+    ----------
+    vectors: path to a vector source or geo-like python objects
+        Anything which can be read by rasterstats.io.read_features.
+    context: SpatialContext
+        The grid of the zones.
+
+    Attributes
+    ----------
+    features: list
+        The (GeoJSON-like) features of the shapes, one per zone
+    pixels: numpy.array
+        Indices of the pixels (in the flattened grid) of all zones
+    zone: numpy.array
+        The zone of every pixel in pixels
+    """
+
+    def __init__(self, vectors, context):
+        from rasterstats.io import read_features
+        from rasterio.features import rasterize
+        from shapely.geometry import shape
+        from affine import Affine
+
+        self.features = list(read_features(vectors))
+
+        transform = context.transform
+        height, width = int(context.height), int(context.width)
+
+        def row(y, op=math.floor):
+            return int(op((y - transform.f) / transform.e))
+
+        def col(x, op=math.floor):
+            return int(op((x - transform.c) / transform.a))
+
+        pixels = []
+        for feature in self.features:
+            geometry = shape(feature["geometry"])
+
+            if "Point" in geometry.geom_type:
+                # the pixels which contain the points
+                points = getattr(geometry, "geoms", [geometry])
+                cells = set((row(p.y), col(p.x)) for p in points)
+                pixels.append(np.array(
+                    sorted(r * width + c for r, c in cells
+                           if 0 <= r < height and 0 <= c < width),
+                    dtype="int64"))
+                continue
+
+            # the window (of whole pixels) covering the shape
+            west, south, east, north = geometry.bounds
+            row_start, row_stop = max(0, row(north)), \
+                min(height, row(south, math.ceil))
+            col_start, col_stop = max(0, col(west)), \
+                min(width, col(east, math.ceil))
+            if row_stop <= row_start or col_stop <= col_start:
+                pixels.append(np.zeros(0, dtype="int64"))
+                continue
+
+            mask = rasterize(
+                [(geometry, 1)],
+                out_shape=(row_stop - row_start, col_stop - col_start),
+                transform=transform * Affine.translation(col_start,
+                                                         row_start),
+                fill=0, dtype="uint8")
+            rows, cols = np.nonzero(mask)
+            pixels.append((rows + row_start).astype("int64") * width
+                          + cols + col_start)
+
+        self.pixels = np.concatenate(pixels) if len(pixels) > 0 \
+            else np.zeros(0, dtype="int64")
+        self.zone = np.repeat(np.arange(len(pixels)),
+                              [p.size for p in pixels])
+
+    @property
+    def count(self):
+        """Number of zones"""
+        return len(self.features)
+
+    def take(self, grid):
+        """Values of the pixels of the zones, for a grid or a stack of
+        grids (bands, rows, columns)"""
+        grid = np.asarray(grid)
+        return grid.reshape(grid.shape[:-2] + (-1, )).take(self.pixels,
+                                                           axis=-1)
+
+    def counts(self, values, codes):
+        """Number of pixels per band, zone and code
+
+        Parameters
+        ----------
+        values: numpy.array
+            The values of the pixels of the zones (see take) for a number of
+            bands (bands, pixels).
+        codes: list
+            The sorted codes which are counted.
+
+        Returns
+        -------
+        counts: numpy.array
+            Number of pixels (bands, zones, codes)
+        """
+        values = np.asarray(values)
+        bands = values.shape[0]
+        # the last position is used for values which are not in codes
+        size = len(codes) + 1
+        key = (np.arange(bands)[:, np.newaxis] * self.count + self.zone) \
+            * size + code_index(values, codes)
+        counts = np.bincount(key.ravel(),
+                             minlength=bands * self.count * size)
+        return counts.reshape(bands, self.count, size)[:, :, :-1]
+
+    def table(self, counts, veg_codes, presence, cell_area, attribute=None,
+              table=None):
+        """Table with the area per vegetation type, zone and presence
+
+        Parameters
+        ----------
+        counts: numpy.array
+            Number of pixels per vegetation type, zone and presence (see
+            counts).
+        veg_codes: list
+            The vegetation types of the bands of counts
+        presence: list
+            The description of the codes of counts
+        cell_area: float
+            Area of a pixel (m2)
+        attribute: str
+            Attribute of the shapes which is added to the table
+        table: pandas.DataFrame
+            The area per vegetation type and presence of the whole grid. If
+            it is given, the area which is not covered by any shape is added
+            with shape_id -1.
+
+        Returns
+        -------
+        table: pandas.DataFrame
+        """
+        import pandas as pd
+
+        ti = []
+        attribute_list = []
+
+        for i, vi in enumerate(veg_codes):
+            for shape_i in range(self.count):
+                if attribute is not None:
+                    value = self.features[shape_i]["properties"][attribute]
+                for j, label in enumerate(presence):
+                    ti.append((vi, shape_i, label,
+                               counts[i, shape_i, j] * cell_area / 10000))
+                    if attribute is not None:
+                        attribute_list.append(value)
+
+        df = pd.DataFrame(ti, columns=['vegetation', 'shape_id', 'presence',
+                                       'area_ha'])
+
+        if table is not None:
+            # calculate area outside polygons
+            a = pd.concat([table.groupby(by=["vegetation", "presence"])[
+                               "area_ha"].sum(),
+                           df.groupby(by=["vegetation", "presence"])[
+                               "area_ha"].sum()], axis=1)
+            a = a.reset_index().fillna(0)
+            a.columns = ["vegetation", "presence", "all", "inshape"]
+            a["area_ha"] = a["all"] - a["inshape"]
+            a["shape_id"] = -1
+            a = a[["vegetation", "shape_id", "presence", "area_ha"]]
+            df = pd.concat([df, a])
+            attribute_list.extend(a["shape_id"])
+
+        if attribute is not None:
+            df[attribute] = attribute_list
+
+        return df
@@ -58,6 +58,20 @@ class testAcidity(TestCase):
 
         np.testing.assert_equal(np.array([3]), result)
 
+    def test_acidity_partial_nodata(self):
+        # combinations which are not in lnk_acidity give nodata
+        rainwater = np.array([[0, 0], [0, 0]])
+        minerality = np.array([[1, 1], [1, 1]])
+        inundation = np.array([[1, -99], [1, 1]])
+        seepage = np.array([[1, 1], [np.nan, 1]])
+        soil_mlw = np.array([[1, 1], [1, -99]])
+
+        a = niche_vlaanderen.Acidity()
+        result = a._get_acidity(rainwater, minerality, inundation,
+                                seepage, soil_mlw)
+
+        np.testing.assert_equal(np.array([[3, 255], [255, 255]]), result)
+
     def test_seepage_code(self):
         seepage = np.array([5, 0.3, 0.05, -0.04, -0.2, -5])
         a = niche_vlaanderen.Acidity()
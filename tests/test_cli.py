@@ -27,6 +27,18 @@ def test_cli_floodplain():
         numpy.testing.assert_equal([-99, -1, 2, 3], np.unique(band))
 
 
+def test_cli_workers():
+    runner = CliRunner()
+    result = runner.invoke(nv_cli.cli, ['--workers', '2',
+                                        'tests/small_nostrict.yml'])
+    assert result.exit_code == 0
+    assert "files_written:" in result.output
+
+    result = runner.invoke(nv_cli.cli, ['--workers', '0',
+                                        'tests/small_nostrict.yml'])
+    assert result.exit_code != 0
+
+
 def test_example_yml():
     runner = CliRunner()
     # the following returns the example yaml file, which we will test in the
@@ -1,9 +1,16 @@
 from unittest import TestCase
 import pandas as pd
 from niche_vlaanderen.codetables import check_join, check_unique,\
-    check_lower_upper_boundaries, CodeTableException, validate_tables_acidity
+    check_lower_upper_boundaries, CodeTableException, validate_tables_acidity,\
+    code_index
+import numpy as np
+import os
 import pytest
+import shutil
+import tempfile
+import yaml
 import niche_vlaanderen
+from niche_vlaanderen.exception import NicheException
 
 
 class TestCodeTables(TestCase):
@@ -79,3 +86,94 @@ class TestCodeTables(TestCase):
         badveg = "tests/data/bad_ct/differentmlw.csv"
         with pytest.raises(CodeTableException):
             niche_vlaanderen.Vegetation(ct_vegetation=badveg)
+
+    def test_code_index(self):
+        codes = np.array([1, 3, 5])
+        used = np.array([[5, 1], [-99, 4]])
+        expected = np.array([[2, 0], [3, 3]])
+        np.testing.assert_equal(expected, code_index(used, codes))
+
+    def test_registry(self):
+        # the compiled code tables are shared by all models
+        v1 = niche_vlaanderen.Vegetation()
+        v2 = niche_vlaanderen.Vegetation()
+        self.assertTrue(v1._rules is v2._rules)
+        self.assertFalse(v1._rules.flags.writeable)
+        self.assertTrue(niche_vlaanderen.Acidity()._lookup is
+                        niche_vlaanderen.Acidity()._lookup)
+
+        # changing the tables of a model does not change other models
+        nl = niche_vlaanderen.NutrientLevel()
+        nl.ct_lnk_soil_nutrient_level["nutrient_level"] = 0
+        nl = niche_vlaanderen.NutrientLevel()
+        self.assertTrue((nl.ct_lnk_soil_nutrient_level["nutrient_level"]
+                         > 0).all())
+        v1._ct_vegetation.drop(v1._ct_vegetation.index, inplace=True)
+        self.assertTrue(len(niche_vlaanderen.Vegetation()._ct_vegetation) > 0)
+        flooding = niche_vlaanderen.Flooding()
+        del flooding._ct["potential"]
+        self.assertTrue("potential" in niche_vlaanderen.Flooding()._ct)
+
+        # a changed file is loaded again
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ct = os.path.join(tmpdir, "niche_vegetation.csv")
+            shutil.copy("tests/data/bad_ct/one_vegetation.csv", ct)
+            v3 = niche_vlaanderen.Vegetation(ct_vegetation=ct)
+            self.assertTrue(
+                v3._rules is
+                niche_vlaanderen.Vegetation(ct_vegetation=ct)._rules)
+
+            shutil.copy("niche_vlaanderen/system_tables/niche_vegetation.csv",
+                        ct)
+            v4 = niche_vlaanderen.Vegetation(ct_vegetation=ct)
+            self.assertFalse(v3._rules is v4._rules)
+            np.testing.assert_equal(v1._veg_codes, v4._veg_codes)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_bundle(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            bundle = os.path.join(tmpdir, "code_tables.npz")
+            niche_vlaanderen.Niche().compile_code_tables(bundle)
+
+            expected = niche_vlaanderen.Vegetation()
+            v = niche_vlaanderen.Vegetation(ct_bundle=bundle)
+            np.testing.assert_equal(expected._rules, v._rules)
+            pd.testing.assert_frame_equal(expected._ct_vegetation,
+                                          v._ct_vegetation)
+            flooding = niche_vlaanderen.Flooding()
+            flooding_bundle = niche_vlaanderen.Flooding(ct_bundle=bundle)
+            self.assertEqual(flooding._ct.keys(), flooding_bundle._ct.keys())
+            np.testing.assert_equal(flooding._lookup, flooding_bundle._lookup)
+            self.assertEqual(flooding._scenarios, flooding_bundle._scenarios)
+
+            with pytest.raises(NicheException):
+                niche_vlaanderen.Vegetation(
+                    ct_bundle=bundle,
+                    ct_vegetation="tests/data/bad_ct/one_vegetation.csv")
+
+            # the bundle can be given in the code_tables of a config file
+            with open("tests/small.yaml") as f:
+                config = yaml.safe_load(f)
+            for key, value in config["input_layers"].items():
+                if not isinstance(value, int):
+                    config["input_layers"][key] = \
+                        os.path.abspath(os.path.join("tests", value))
+            config["code_tables"] = {"ct_bundle": "code_tables.npz"}
+            config["model_options"]["output_dir"] = tmpdir
+            with open(os.path.join(tmpdir, "config.yaml"), "w") as f:
+                yaml.safe_dump(config, f)
+
+            myniche = niche_vlaanderen.Niche()
+            myniche.run_config_file(os.path.join(tmpdir, "config.yaml"),
+                                    overwrite_ct=True)
+            self.assertEqual(bundle, myniche._code_tables["ct_bundle"])
+
+            default = niche_vlaanderen.Niche()
+            default.read_config_file("tests/small.yaml")
+            default.run()
+            self.assertEqual(default.occurrence, myniche.occurrence)
+        finally:
+            shutil.rmtree(tmpdir)
@@ -8,6 +8,7 @@ import os
 import tempfile
 import shutil
 import sys
+from collections import OrderedDict
 
 
 class TestFlooding(TestCase):
@@ -17,6 +18,26 @@ class TestFlooding(TestCase):
                       period="winter", duration=1)
         np.testing.assert_equal(np.array([3, 3, 3]), fp._veg[1])
 
+    def test__calculate_bands(self):
+        fp = nv.Flooding()
+        depth = np.array([[1, 2], [-99, 0]])
+        fp._calculate(depth=depth, frequency="T25", period="winter",
+                      duration=1)
+        # all vegetation types are bands of a single grid
+        self.assertEqual((len(fp._veg), 2, 2), fp._bands.shape)
+        self.assertEqual("int16", fp._bands.dtype)
+        for i, veg_code in enumerate(sorted(fp._veg)):
+            self.assertTrue(fp._veg[veg_code].base is fp._bands)
+            np.testing.assert_equal(fp._bands[i], fp._veg[veg_code])
+        np.testing.assert_equal(-99, fp._bands[:, 1, 0])
+
+        # scenarios which are not in lnk_potential have no information (4)
+        fp._lookup = fp._lookup[-1:]
+        fp._scenarios = []
+        fp._calculate(depth=depth, frequency="T25", period="winter",
+                      duration=1)
+        np.testing.assert_equal([[4, 4], [-99, 4]], fp._veg[1])
+
     def test_calculate(self):
         fp = nv.Flooding()
         fp.calculate("testcase/flooding/ff_bt_t10_h.asc", "T10",
@@ -26,6 +47,101 @@ class TestFlooding(TestCase):
             expected = dst.read(1)
         np.testing.assert_equal(expected, fp._veg[25])
 
+    def test_calculate_many(self):
+        depth = "testcase/flooding/ff_bt_t10_h.asc"
+        scenarios = [
+            dict(name="T10-winter", depth=depth, frequency="T10",
+                 period="winter", duration=1),
+            dict(name="T25-summer", frequency="T25", period="summer",
+                 depth="testcase/flooding/ff_bt_t25_h.asc", duration=2),
+            dict(name="T2-winter", depth=depth, frequency="T2",
+                 period="winter", duration=1)]
+        expected = []
+        for scenario in scenarios:
+            fp = nv.Flooding()
+            fp.calculate(scenario["depth"], scenario["frequency"],
+                         period=scenario["period"],
+                         duration=scenario["duration"])
+            expected.append(fp)
+
+        fp = nv.Flooding()
+        # every depth file is read once
+        read = []
+
+        def read_depth(depth_file):
+            read.append(depth_file)
+            return nv.Flooding._read_depth(depth_file)
+
+        fp._read_depth = read_depth
+        for workers in (1, 2):
+            del read[:]
+            result = fp.calculate_many(scenarios, workers=workers)
+            self.assertEqual(2, len(read))
+            self.assertEqual(set(s["depth"] for s in scenarios), set(read))
+            self.assertEqual(["T10-winter", "T25-summer", "T2-winter"],
+                             [r.name for r in result])
+            for e, r in zip(expected, result):
+                self.assertEqual(e.options, r.options)
+                self.assertEqual(e._context, r._context)
+                for vi in e._veg:
+                    np.testing.assert_equal(e._veg[vi], r._veg[vi])
+        self.assertFalse(fp.vegetation_calculated)
+
+        bands = np.array([e._bands for e in expected])
+        # no information (4) is only used if there is no other information
+        informed = np.where(bands == 4, -1, bands)
+        best = np.where(np.all(bands == 4, axis=0), 4, informed.max(axis=0))
+        best[np.any(bands == -99, axis=0)] = -99
+        for workers in (1, 2):
+            worst = fp.calculate_many(scenarios, reduce="worst",
+                                      workers=workers)
+            np.testing.assert_equal(bands.min(axis=0), worst._bands)
+            reduced = fp.calculate_many(scenarios, reduce="best",
+                                        workers=workers, name="best")
+            np.testing.assert_equal(best, reduced._bands)
+        self.assertEqual("best", reduced.name)
+        self.assertEqual(dict(frequency="T10+T25+T2", duration="1+2",
+                              period="winter+summer"), reduced.options)
+
+        with pytest.raises(FloodingException):
+            fp.calculate_many(scenarios, reduce="mean")
+        with pytest.raises(FloodingException):
+            fp.calculate_many(scenarios, workers=0)
+        with pytest.raises(FloodingException):
+            fp.calculate_many([])
+
+        # the depth files of reduced scenarios must have the same extent
+        different = scenarios + [
+            dict(depth="tests/data/small/T25.asc", frequency="T25",
+                 period="winter", duration=1)]
+        for workers in (1, 2):
+            with pytest.raises(FloodingException):
+                fp.calculate_many(different, reduce="worst", workers=workers)
+
+    def test_unknown_potential(self):
+        # potential codes which can not be ranked are not accepted
+        tmpdir = tempfile.mkdtemp()
+        try:
+            folder = "niche_vlaanderen/system_tables/flooding/"
+            potential = os.path.join(tmpdir, "potential.csv")
+            with open(folder + "potential.csv") as f:
+                table = f.read()
+            with open(potential, "w") as f:
+                f.write(table + "5,other,ander\n")
+            lnk_potential = os.path.join(tmpdir, "lnk_potential.csv")
+            with open(folder + "lnk_potential.csv") as f:
+                table = f.read().splitlines()
+            table[1] = table[1][:-1] + "5"
+            with open(lnk_potential, "w") as f:
+                f.write("\n".join(table) + "\n")
+
+            with pytest.raises(FloodingException):
+                nv.Flooding(potential=potential)
+            with pytest.raises(FloodingException):
+                nv.Flooding(lnk_potential=lnk_potential)
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_calculate_arcgis(self):
         # note this tests uses an arcgis raster with only 8bit unsigned values
         fp = nv.Flooding()
@@ -59,6 +175,40 @@ class TestFlooding(TestCase):
                   & (df.presence == "goed combineerbaar"))]
         assert np.all(178.64 == np.round(sel["area_ha"], 2))
 
+    def test_zonal_stats(self):
+        import rasterstats
+        fp = nv.Flooding()
+        with pytest.raises(FloodingException):
+            fp.zonal_stats("testcase/zwarte_beek/input/study_area_l72.geojson")
+
+        fp.calculate("testcase/flooding/ff_bt_t10_h.asc", "T10",
+                     period="winter", duration=1)
+        context = fp._context
+        left, top = context.transform.c, context.transform.f
+        right = left + context.width * context.transform.a / 2
+        bottom = top + context.height * context.transform.e / 2
+        vectors = [dict(type="Polygon", coordinates=[[
+            (left, top), (right, top), (right, bottom), (left, bottom),
+            (left, top)]])]
+
+        stats = fp.zonal_stats(vectors, outside=False)
+        labels = fp._labels()
+        expected = rasterstats.zonal_stats(
+            vectors, fp._veg[25], affine=context.transform, categorical=True,
+            nodata=-999)[0]
+        for code in labels:
+            selection = ((stats.vegetation == 25)
+                         & (stats.presence == labels[code]))
+            self.assertAlmostEqual(
+                expected.get(code, 0) * context.cell_area / 10000,
+                stats[selection].area_ha.item())
+
+        stats = fp.zonal_stats(vectors)
+        total = stats.groupby(["vegetation", "presence"]).area_ha.sum()
+        table = fp.table.groupby(["vegetation", "presence"]).area_ha.sum()
+        np.testing.assert_allclose(table.sort_index(),
+                                   total[total > 0].sort_index())
+
     def test_plot(self):
         import matplotlib as mpl
         mpl.use('agg')
@@ -110,6 +260,11 @@ class TestFlooding(TestCase):
         else:
             self.assertCountEqual(expected_files, dir)
 
+        # the files written per vegetation type
+        self.assertEqual(sorted(fp._veg), sorted(fp._files_written))
+        self.assertEqual(os.path.join(tempdir, "F01-T10-P1-winter.tif"),
+                         fp._files_written[1])
+
         # try writing again, should raise as files already exist
         with pytest.raises(FloodingException):
             fp.write(tempdir)
@@ -118,9 +273,64 @@ class TestFlooding(TestCase):
 
         shutil.rmtree(tempdir)
 
-    def test_combine(self):
-        fp = nv.Flooding()
-
+    def test_run_config_workers(self):
+        import yaml
+        with open("tests/flooding-codetables.yml") as f:
+            config = yaml.safe_load(f)
+        for section in ("input_layers", "code_tables"):
+            for key, value in config[section].items():
+                if not isinstance(value, int):
+                    config[section][key] = \
+                        os.path.abspath(os.path.join("tests", value))
+        for scen in config["flooding"]:
+            scen["depth"] = os.path.abspath(os.path.join("tests",
+                                                         scen["depth"]))
+        config["model_options"]["deviation"] = False
+
+        # a run in blocks combines the scenarios with the written grids
+        runs = OrderedDict([(1, dict(workers=1)), (2, dict(workers=2)),
+                            ("blocks", dict(block_size=[50, 50]))])
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            files = dict()
+            for run in runs:
+                output_dir = os.path.join(tmpdir, str(run))
+                config["model_options"]["output_dir"] = output_dir
+                config["model_options"].pop("workers", None)
+                config["model_options"].update(runs[run])
+                filename = os.path.join(tmpdir, "config.yml")
+                with open(filename, "w") as f:
+                    yaml.safe_dump(config, f)
+
+                myniche = nv.Niche()
+                myniche.run_config_file(filename)
+                # the last scenario is kept
+                self.assertEqual("tweede", myniche.fp.name)
+                # the files of both scenarios are listed, the files of the
+                # niche model are kept
+                self.assertEqual(os.path.join(output_dir, "V01.tif"),
+                                 myniche._files_written[1])
+                self.assertEqual(myniche.fp._files_written[1],
+                                 myniche._files_written["tweede-F01"])
+                self.assertTrue("eerste-F01" in myniche._files_written)
+                files[run] = dict(
+                    (f, open(os.path.join(output_dir, f), "rb").read())
+                    for f in os.listdir(output_dir)
+                    if f.startswith(("eerste", "tweede")))
+
+            # the scenarios give the same files when run in parallel or in
+            # blocks
+            self.assertEqual(50, len(files[1]))
+            for run in (2, "blocks"):
+                self.assertEqual(sorted(files[1]), sorted(files[run]))
+                for f in files[1]:
+                    self.assertEqual(files[1][f], files[run][f], f)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @staticmethod
+    def create_dijle_niche():
         myniche = nv.Niche()
         input = "testcase/dijle/"
         myniche.set_input("soil_code", input + "bodemv.asc")
@@ -143,6 +353,12 @@ class TestFlooding(TestCase):
         myniche.set_input("minerality", input + "minerality.asc")
 
         myniche.set_input("rainwater", input + "nulgrid.asc")
+        return myniche
+
+    def test_combine(self):
+        fp = nv.Flooding()
+
+        myniche = self.create_dijle_niche()
 
         with pytest.raises(FloodingException):
             # niche model not yet run
@@ -172,3 +388,64 @@ class TestFlooding(TestCase):
         unique = np.unique(np.hstack(unique))
         expected = np.array([-99, -1, 1, 2, 3])
         np.testing.assert_equal(expected, unique)
+
+    def test_combine_out(self):
+        myniche = self.create_dijle_niche()
+        myniche.run()
+        fp = nv.Flooding()
+        fp.calculate("testcase/flooding/ff_bt_t10_h.asc", "T10",
+                     period="winter", duration=1)
+        expected = fp.combine(myniche)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # the result is written to a memory mapped array
+            out = np.lib.format.open_memmap(
+                os.path.join(tmpdir, "combined.npy"), mode="w+",
+                dtype="int16", shape=fp._bands.shape)
+            result = fp.combine(myniche, out=out)
+            self.assertTrue(result._bands is out)
+            for vi in expected._veg:
+                np.testing.assert_equal(expected._veg[vi], result._veg[vi])
+            del result, out
+
+            with pytest.raises(FloodingException):
+                fp.combine(myniche, out=np.empty((1, 2), dtype="int16"))
+
+            # the Niche and Flooding grid files are combined block by block
+            myniche.write(os.path.join(tmpdir, "niche"))
+            fp.write(os.path.join(tmpdir, "flooding"))
+            flooding_files = dict(
+                (vi, os.path.join(tmpdir, "flooding",
+                                  "F{:02d}-T10-P1-winter.tif".format(vi)))
+                for vi in fp._veg)
+            files = nv.Flooding.combine_files(
+                myniche._files_written, flooding_files,
+                os.path.join(tmpdir, "combined"), block_size=(50, 60))
+            self.assertEqual(set(fp._veg), set(files))
+            for vi in files:
+                with rasterio.open(files[vi]) as dst:
+                    np.testing.assert_equal(expected._veg[vi], dst.read(1))
+
+            with pytest.raises(FloodingException):
+                # the files exist
+                nv.Flooding.combine_files(
+                    myniche._files_written, flooding_files,
+                    os.path.join(tmpdir, "combined"))
+
+            with pytest.raises(FloodingException):
+                # the flooding files can not be overwritten
+                nv.Flooding.combine_files(
+                    myniche._files_written, flooding_files,
+                    os.path.join(tmpdir, "flooding"), overwrite_files=True)
+
+            # the flooding model itself is combined
+            bands = fp._bands
+            result = fp.combine(myniche, inplace=True)
+            self.assertTrue(result is fp)
+            self.assertTrue(fp._bands is bands)
+            self.assertTrue(fp._combined)
+            for vi in expected._veg:
+                np.testing.assert_equal(expected._veg[vi], fp._veg[vi])
+        finally:
+            shutil.rmtree(tmpdir)
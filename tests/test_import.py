@@ -0,0 +1,48 @@
+from unittest import TestCase
+import json
+import subprocess
+import sys
+
+# budget for the time to import niche_vlaanderen: a multiple of the time to
+# import numpy (which is always needed), but at least an absolute time (s).
+# Both are generous, so loaded machines and coverage measurement do not make
+# the test fail.
+import_budget = 4
+import_budget_minimum = 0.5
+
+script = """
+import json, sys, time
+start = time.time()
+import numpy
+numpy_duration = time.time() - start
+start = time.time()
+import niche_vlaanderen
+duration = time.time() - start
+heavy = ["pandas", "rasterio", "rasterstats", "matplotlib", "pkg_resources",
+         "yaml"]
+print(json.dumps(dict(duration=duration, numpy_duration=numpy_duration,
+                      imported=[m for m in heavy if m in sys.modules])))
+"""
+
+
+def measure_import():
+    # a new interpreter, as the modules are already imported by the tests
+    output = subprocess.check_output([sys.executable, "-c", script])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+class TestImport(TestCase):
+    def test_import_dependencies(self):
+        result = measure_import()
+        # the heavy dependencies are only imported when they are used
+        self.assertEqual([], result["imported"])
+
+    def test_import_time(self):
+        # the fastest of a few imports, which is the least affected by
+        # other processes
+        results = [measure_import() for _ in range(3)]
+        excess = min(r["duration"] - max(import_budget_minimum,
+                                         import_budget * r["numpy_duration"])
+                     for r in results)
+        self.assertTrue(excess < 0, "import takes {:.3f} s too long".format(
+            excess))
@@ -4,14 +4,18 @@ import pytest
 
 import niche_vlaanderen
 from niche_vlaanderen.exception import NicheException
+from niche_vlaanderen.spatial_context import SpatialContextError
 from rasterio.errors import RasterioIOError
 import numpy as np
 import pandas as pd
+import rasterio
+import yaml
 
 import tempfile
 import shutil
 import os
 import sys
+import logging
 
 import distutils.spawn
 import subprocess
@@ -195,12 +199,339 @@ class TestNiche(TestCase):
         self.assertEqual(37, myniche._context.width)
         self.assertEqual(37, myniche._context.height)
 
+    def test_run_blocks(self):
+        # running in blocks writes the same grids as a run in memory
+        myniche = self.create_zwarte_beek_niche()
+        myniche.set_input("mlw", "tests/data/part_zwarte_beek_mlw.asc")
+        myniche.run(deviation=True)
+        tmpdir = tempfile.mkdtemp()
+        myniche.write(tmpdir + "/full")
+
+        blocks = self.create_zwarte_beek_niche()
+        blocks.set_input("mlw", "tests/data/part_zwarte_beek_mlw.asc")
+        blocks.run(deviation=True, block_size=(10, 16),
+                   output_dir=tmpdir + "/blocks")
+
+        self.assertEqual(myniche.occurrence, blocks.occurrence)
+        pd.testing.assert_frame_equal(myniche.table, blocks.table)
+        files = os.listdir(tmpdir + "/full")
+        if sys.version_info < (3, 2):
+            self.assertItemsEqual(files, os.listdir(tmpdir + "/blocks"))
+        else:
+            self.assertCountEqual(files, os.listdir(tmpdir + "/blocks"))
+
+        for key in myniche._files_written:
+            with rasterio.open(myniche._files_written[key]) as full, \
+                    rasterio.open(blocks._files_written[key]) as block:
+                np.testing.assert_array_equal(full.read(1), block.read(1))
+
+        # results are not kept in memory
+        self.assertFalse(blocks.vegetation_calculated)
+        with pytest.raises(NicheException):
+            blocks.write(tmpdir + "/blocks", overwrite_files=True)
+
+        # the output directory is required
+        with pytest.raises(NicheException):
+            blocks.run(block_size=(10, 10))
+
+        # an invalid block size is rejected before any file is created
+        with pytest.raises(SpatialContextError):
+            blocks.run(block_size=(0, 10), output_dir=tmpdir + "/invalid")
+        self.assertFalse(os.path.exists(tmpdir + "/invalid"))
+        shutil.rmtree(tmpdir)
+
+    def test_run_blocks_old_soil_codes(self):
+        # the conversion of old soil codes is decided for the whole grid,
+        # also when a block only contains old soil codes
+        tmpdir = tempfile.mkdtemp()
+        with open("tests/data/small/soil_code.asc") as f:
+            lines = f.read().splitlines()
+        lines[-1] = "15 15 15 15 15 15 12"
+        soil_code = os.path.join(tmpdir, "soil_code.asc")
+        with open(soil_code, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+        results = []
+        for options in (dict(), dict(workers=2),
+                        dict(block_size=(3, 7), output_dir=tmpdir + "/b")):
+            myniche = niche_vlaanderen.Niche()
+            myniche.set_input("soil_code", soil_code)
+            myniche.set_input("mhw", "tests/data/small/mhw.asc")
+            myniche.set_input("mlw", "tests/data/small/mlw.asc")
+            myniche.run(full_model=False, **options)
+            results.append(myniche.occurrence)
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+        shutil.rmtree(tmpdir)
+
+    def test_run_workers(self):
+        # a parallel run gives the same result as a serial run
+        myniche = self.create_zwarte_beek_niche()
+        myniche.run(deviation=True)
+
+        parallel = self.create_zwarte_beek_niche()
+        parallel.run(deviation=True, workers=2)
+
+        self.assertEqual(myniche.occurrence, parallel.occurrence)
+        pd.testing.assert_frame_equal(myniche.table, parallel.table)
+        for results in ("_vegetation", "_abiotic", "_deviation"):
+            expected = getattr(myniche, results)
+            result = getattr(parallel, results)
+            self.assertEqual(sorted(expected), sorted(result))
+            for key in expected:
+                self.assertEqual(expected[key].dtype, result[key].dtype)
+                np.testing.assert_array_equal(expected[key], result[key])
+
+        # also when running in blocks
+        tmpdir = tempfile.mkdtemp()
+        parallel.run(block_size=(50, 50), output_dir=tmpdir, workers=3)
+        self.assertEqual(myniche.occurrence, parallel.occurrence)
+        with rasterio.open(parallel._files_written[7]) as dst:
+            np.testing.assert_array_equal(myniche._vegetation[7], dst.read(1))
+        shutil.rmtree(tmpdir)
+
+        with pytest.raises(NicheException):
+            parallel.run(workers=0)
+
+    def test_cache_dir(self):
+        tmpdir = tempfile.mkdtemp()
+        myniche = self.create_zwarte_beek_niche()
+        myniche.run()
+
+        cached = niche_vlaanderen.Niche(cache_dir=tmpdir + "/cache")
+        cached._inputfiles = myniche._inputfiles
+        cached._inputvalues = myniche._inputvalues
+        cached._context = myniche._context
+        cached.run()
+        n_files = len(os.listdir(tmpdir + "/cache"))
+        self.assertEqual(len(myniche._inputfiles), n_files)
+        self.assertEqual(myniche.occurrence, cached.occurrence)
+
+        # a second model uses the cached grids
+        cached = niche_vlaanderen.Niche(cache_dir=tmpdir + "/cache")
+        cached._inputfiles = myniche._inputfiles
+        cached._inputvalues = myniche._inputvalues
+        cached._context = myniche._context
+        cached.run()
+        self.assertTrue(isinstance(cached._inputarray["mhw"], np.memmap))
+        self.assertEqual(n_files, len(os.listdir(tmpdir + "/cache")))
+        self.assertEqual(myniche.occurrence, cached.occurrence)
+        for key in myniche._inputarray:
+            np.testing.assert_array_equal(myniche._inputarray[key],
+                                          cached._inputarray[key])
+
+        # a different window is cached separately
+        cached.run(block_size=(50, 60), output_dir=tmpdir + "/blocks")
+        self.assertEqual(myniche.occurrence, cached.occurrence)
+        self.assertTrue(n_files < len(os.listdir(tmpdir + "/cache")))
+
+        # a changed file within an ArcGIS grid folder is read again, also
+        # when the modification time of the folder does not change
+        grid = tmpdir + "/grid"
+        shutil.copytree("tests/data/ff_bt_t10_h", grid)
+        with rasterio.open(grid) as dst:
+            window = ((0, dst.height), (0, dst.width))
+            cached._read_cached_band("mhw", dst, window)
+            n_files = len(os.listdir(tmpdir + "/cache"))
+            cached._read_cached_band("mhw", dst, window)
+            self.assertEqual(n_files, len(os.listdir(tmpdir + "/cache")))
+
+            folder_time = os.path.getmtime(grid)
+            data_file = os.path.join(grid, "w001001.adf")
+            os.utime(data_file, (folder_time + 10, folder_time + 10))
+            self.assertEqual(folder_time, os.path.getmtime(grid))
+            cached._read_cached_band("mhw", dst, window)
+            self.assertEqual(n_files + 1,
+                             len(os.listdir(tmpdir + "/cache")))
+        shutil.rmtree(tmpdir)
+
+    def test_incremental_run(self):
+        input_dir = "testcase/zwarte_beek/input/"
+        myniche = self.create_zwarte_beek_niche()
+        myniche.run(deviation=True)
+        nutrient_level = myniche._abiotic["nutrient_level"]
+        acidity = myniche._abiotic["acidity"]
+        deviation = myniche._deviation
+
+        # vegetation management only affects the vegetation
+        myniche.set_input("management_vegetation",
+                          input_dir + "management.asc")
+        self.assertFalse(myniche.vegetation_calculated)
+        self.assertEqual({"soil_partition", "mineralisation",
+                          "nutrient_level", "soil_mlw", "seepage_class",
+                          "acidity", "deviation"},
+                         set(myniche._stages))
+        myniche.run(deviation=True)
+        self.assertTrue(nutrient_level is myniche._abiotic["nutrient_level"])
+        self.assertTrue(acidity is myniche._abiotic["acidity"])
+        self.assertTrue(deviation is myniche._deviation)
+
+        # rainwater does not affect the nutrient level, the warning names
+        # the stages which are calculated again
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        myniche._log.addHandler(handler)
+        try:
+            myniche.set_input("rainwater", 1)
+        finally:
+            myniche._log.removeHandler(handler)
+        self.assertEqual(["Setting new input rainwater after model run, the "
+                          "results of acidity, vegetation are recalculated "
+                          "on the next run"], messages)
+        self.assertTrue("nutrient_level" in myniche._stages)
+        self.assertFalse("acidity" in myniche._stages)
+        self.assertTrue("input_nodata" in myniche._stages)
+        myniche.run(deviation=True)
+        self.assertTrue(nutrient_level is myniche._abiotic["nutrient_level"])
+
+        # the result is the same as for a new model
+        expected = self.create_zwarte_beek_niche()
+        expected.set_input("management_vegetation",
+                           input_dir + "management.asc")
+        expected.set_input("rainwater", 1)
+        expected.run(deviation=True)
+        self.assertEqual(expected.occurrence, myniche.occurrence)
+        for key in expected._abiotic:
+            np.testing.assert_array_equal(expected._abiotic[key],
+                                          myniche._abiotic[key])
+
+        # a different model calculates all stages again
+        myniche.run(full_model=False)
+        self.assertEqual({"soil_partition", "input_nodata", "vegetation"},
+                         set(myniche._stages))
+
+    def test_run_scenarios(self):
+        myniche = self.create_zwarte_beek_niche()
+        scenarios = dict(("N{}".format(n), {"nitrogen_atmospheric": n})
+                         for n in (10, 40))
+        scenarios["management"] = {
+            "management": "testcase/zwarte_beek/input/management.asc",
+            "management_vegetation":
+                "testcase/zwarte_beek/input/management.asc"}
+
+        tmpdir = tempfile.mkdtemp()
+        mineralisation = None
+        for name, scenario in myniche.run_scenarios(scenarios,
+                                                    output_dir=tmpdir):
+            self.assertEqual(name, scenario.name)
+            expected = self.create_zwarte_beek_niche()
+            for key in scenarios[name]:
+                expected.set_input(key, scenarios[name][key])
+            expected.run()
+            self.assertEqual(expected.occurrence, scenario.occurrence)
+            for key in expected._abiotic:
+                np.testing.assert_array_equal(expected._abiotic[key],
+                                              scenario._abiotic[key])
+
+            # the mineralisation is only calculated once
+            if mineralisation is None:
+                mineralisation = scenario._stages["mineralisation"]
+            self.assertTrue(
+                mineralisation is scenario._stages["mineralisation"])
+
+            self.assertTrue(os.path.exists(
+                os.path.join(tmpdir, name + "_V01.tif")))
+
+        # the base model is not changed
+        self.assertEqual({}, myniche._vegetation)
+        self.assertEqual(0, myniche._inputvalues["nitrogen_fertilizer"])
+        # only the grids read from its own input files are shared with it
+        self.assertEqual(set(myniche._inputfiles), set(myniche._inputarray))
+        for key in myniche._inputarray:
+            self.assertTrue(myniche._inputarray[key] is not None)
+        shutil.rmtree(tmpdir)
+
+    def test_input_normalisation(self):
+        myniche = self.create_zwarte_beek_niche()
+        myniche.run()
+        soil_code = myniche._inputarray["soil_code"]
+        mhw = myniche._inputarray["mhw"]
+        self.assertEqual("float32", mhw.dtype)
+        self.assertEqual(-99, soil_code.min())
+
+        # the shared nodata mask of the input layers
+        vegetation = myniche._create_model(niche_vlaanderen.Vegetation)
+        expected = vegetation._input_nodata(soil_code, mhw,
+                                            myniche._inputarray["mlw"])
+        np.testing.assert_equal(expected, myniche._stages["input_nodata"])
+
+        # constant values are not copied for every pixel
+        constant = myniche._read_input({})["nitrogen_fertilizer"]
+        self.assertEqual(soil_code.shape, constant.shape)
+        self.assertFalse(constant.flags.writeable)
+
+    def test_timings(self):
+        myniche = self.create_zwarte_beek_niche()
+        measured = []
+        myniche.timing_hook = lambda stage, record: measured.append(stage)
+        myniche.run(deviation=True)
+        stages = ["read", "check", "nutrient_level", "acidity", "vegetation",
+                  "deviation"]
+        self.assertEqual(stages, measured)
+        self.assertEqual(set(stages), set(myniche.timings))
+        pixels = myniche._context.width * myniche._context.height
+        record = myniche.timings["vegetation"]
+        self.assertEqual(pixels, record["pixels"])
+        self.assertTrue(record["wall_time"] >= 0)
+        self.assertTrue(record["cpu_time"] >= 0)
+        if "peak_rss_growth_mb" in record:
+            self.assertTrue(record["peak_rss_growth_mb"] >= 0)
+
+        tmpdir = tempfile.mkdtemp()
+        myniche.write(tmpdir)
+        self.assertTrue("write" in myniche.timings)
+        with open(os.path.join(tmpdir, "log.txt")) as f:
+            log = yaml.safe_load(f)
+        self.assertEqual(set(stages + ["write"]), set(log["timings"]))
+        shutil.rmtree(tmpdir)
+
+        # blocks calculated by worker processes are measured as well
+        myniche.run(workers=2)
+        self.assertEqual(pixels, myniche.timings["vegetation"]["pixels"])
+
     def test_deviation(self):
         n = self.create_zwarte_beek_niche()
         n.run(deviation=True)
         # check dict exists and contains enough nan values
         self.assertEqual(14400, np.isnan(n._deviation["mhw_04"]).sum())
 
+    def test_deviation_dtype(self):
+        n = self.create_small()
+        n.run(deviation=True, full_model=False)
+        expected = dict(n._deviation)
+
+        n.run(deviation=True, full_model=False, deviation_dtype="int16",
+              lazy_deviation=True)
+        self.assertEqual(len(expected), len(n._deviation))
+        tmpdir = tempfile.mkdtemp()
+        n.write(tmpdir)
+        with rasterio.open(os.path.join(tmpdir, "mhw_04.tif")) as dst:
+            self.assertEqual("int16", dst.dtypes[0])
+            self.assertEqual(-32768, dst.nodata)
+            band = dst.read(1)
+        np.testing.assert_equal(np.isnan(expected["mhw_04"]), band == -32768)
+        valid = band != -32768
+        np.testing.assert_equal(np.rint(expected["mhw_04"][valid]),
+                                band[valid])
+        shutil.rmtree(tmpdir)
+
+        n.run(deviation=True, full_model=False, deviation_dtype="float32")
+        self.assertEqual(np.float32, n._deviation["mlw_04"].dtype)
+
+        # lazy deviation grids are also used when running with workers
+        n.run(deviation=True, full_model=False, lazy_deviation=True,
+              workers=2)
+        self.assertFalse(isinstance(n._deviation, dict))
+        self.assertEqual(sorted(expected), sorted(n._deviation))
+        for key in expected:
+            np.testing.assert_equal(expected[key], n._deviation[key])
+        self.assertTrue(n._options["deviation"])
+
+        with pytest.raises(NicheException):
+            n.run(deviation=True, deviation_dtype="int8")
+
     @pytest.mark.skipif(
         distutils.spawn.find_executable("gdalinfo") is None,
         reason="gdalinfo not available in the environment.")
@@ -223,6 +554,41 @@ class TestNiche(TestCase):
         self.assertTrue("STATISTICS_MINIMUM=0" in info)
         shutil.rmtree(tmpdir)
 
+    def test_write_cog(self):
+        n = self.create_zwarte_beek_niche()
+        n.run()
+
+        tmpdir = tempfile.mkdtemp()
+        n.write(tmpdir, output_format="COG", abiotic_bands=True)
+        self.assertEqual(["log.txt", "summary.csv", "vegetation.tif"],
+                         sorted(os.listdir(tmpdir)))
+        keys = list(n._vegetation) + ["acidity", "nutrient_level"]
+        with rasterio.open(os.path.join(tmpdir, "vegetation.tif")) as dst:
+            self.assertEqual(len(keys), dst.count)
+            self.assertEqual("V01 Sphagno-Betuletum", dst.descriptions[0])
+            self.assertEqual("nutrient_level", dst.descriptions[-1])
+            self.assertTrue(dst.profile["tiled"])
+            for i, key in enumerate(keys, 1):
+                if key in n._vegetation:
+                    expected = n._vegetation[key]
+                else:
+                    expected = n._abiotic[key]
+                np.testing.assert_equal(expected, dst.read(i))
+
+        with open(os.path.join(tmpdir, "log.txt")) as f:
+            log = yaml.safe_load(f)
+        self.assertEqual("COG", log["model_options"]["output_format"])
+        self.assertEqual(os.path.normpath(tmpdir + "/vegetation.tif"),
+                         log["files_written"]["vegetation"])
+
+        # the abiotic grids can also be written separately
+        n.write(tmpdir, overwrite_files=True, output_format="COG")
+        self.assertTrue(os.path.exists(os.path.join(tmpdir, "acidity.tif")))
+
+        with pytest.raises(NicheException):
+            n.write(tmpdir, overwrite_files=True, output_format="PNG")
+        shutil.rmtree(tmpdir)
+
     def test_read_configuration(self):
         config = 'tests/small_simple.yaml'
         myniche = niche_vlaanderen.Niche()
@@ -445,6 +811,30 @@ class TestNiche(TestCase):
         print(stats.OID.unique())
         np.testing.assert_equal([0, -1],  stats.OID.unique())
 
+    def test_zonal_overlap(self):
+        import rasterstats
+        myniche = self.create_zwarte_beek_niche()
+        myniche.run(full_model=False)
+        vectors = boxes(myniche._context)
+
+        # overlapping shapes are counted for every shape, like rasterstats
+        stats = myniche.zonal_stats(vectors, outside=False)
+        self.assertEqual(len(vectors["features"]) * 28 * 3, len(stats))
+        for vi in (1, 7):
+            expected = rasterstats.zonal_stats(
+                vectors, myniche._vegetation[vi],
+                affine=myniche._context.transform, categorical=True,
+                nodata=-99)
+            for shape_id, rec in enumerate(expected):
+                for code, presence in ((0, "not present"), (1, "present"),
+                                       (255, "no data")):
+                    selection = ((stats.vegetation == vi)
+                                 & (stats.shape_id == shape_id)
+                                 & (stats.presence == presence))
+                    self.assertAlmostEqual(
+                        rec.get(code, 0) * myniche._context.cell_area / 10000,
+                        stats[selection].area_ha.item())
+
     def test_uint(self):
         myniche = niche_vlaanderen.Niche()
 
@@ -491,6 +881,26 @@ class TestNiche(TestCase):
             myniche.run()
 
 
+def boxes(context):
+    """Two overlapping boxes in the grid, and a box partly outside it"""
+    left, top = context.transform.c, context.transform.f
+    width = context.width * context.transform.a
+    height = -context.height * context.transform.e
+
+    def box(x0, y0, x1, y1):
+        return dict(type="Feature", properties=dict(), geometry=dict(
+            type="Polygon", coordinates=[[
+                (left + x0 * width, top - y0 * height),
+                (left + x1 * width, top - y0 * height),
+                (left + x1 * width, top - y1 * height),
+                (left + x0 * width, top - y1 * height),
+                (left + x0 * width, top - y0 * height)]]))
+
+    return dict(type="FeatureCollection",
+                features=[box(0.1, 0.1, 0.6, 0.7), box(0.4, 0.3, 0.9, 0.9),
+                          box(-0.2, 0.5, 0.3, 1.2)])
+
+
 class TestNicheDelta(TestCase):
     def test_simplevsfull_plot(self):
         config = 'tests/small_simple.yaml'
@@ -518,6 +928,26 @@ class TestNicheDelta(TestCase):
         delta.name = "vergelijking"
         delta.plot(5)
 
+    def test_zonal_stats(self):
+        simple = niche_vlaanderen.Niche()
+        simple.run_config_file('tests/small_simple.yaml')
+        full = niche_vlaanderen.Niche()
+        full.run_config_file("tests/small.yaml")
+        delta = niche_vlaanderen.NicheDelta(simple, full)
+
+        vectors = boxes(delta._context)
+        vectors["features"] = vectors["features"][:1]
+        stats = delta.zonal_stats(vectors)
+        self.assertEqual({0, -1}, set(stats.shape_id))
+        self.assertTrue(set(stats.presence) <= set(delta._labels))
+
+        # the area in and outside the shape is the area of the table
+        total = stats.groupby(["vegetation", "presence"]).area_ha.sum()
+        table = delta.table.groupby(["vegetation", "presence"]).area_ha.sum()
+        total = total[total > 0]
+        pd.testing.assert_series_equal(table.sort_index(), total.sort_index(),
+                                       check_names=False)
+
     def test_simplevsfull_write(self):
         config = 'tests/small_simple.yaml'
         simple = niche_vlaanderen.Niche()
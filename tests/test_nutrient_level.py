@@ -69,6 +69,21 @@ class TestNutrientLevel(TestCase):
         result = nl._calculate(management, soil_code, nitrogen, inundation)
         np.testing.assert_equal(np.array(5), result)
 
+    def test__get_nodata(self):
+        management = np.array([[2, -99], [2, 3]])
+        soil_code = np.array([[14, 14], [-99, 14]])
+        nitrogen = np.array([[445, 445], [445, np.nan]])
+        inundation = np.array([[0, 0], [0, 0]])
+
+        nl = niche_vlaanderen.NutrientLevel()
+        result = nl._calculate(management, soil_code, nitrogen, inundation)
+        np.testing.assert_equal(np.array([[5, 255], [255, 255]]), result)
+
+        # nitrogen above the highest border is not classified
+        result = nl._calculate(np.array([2]), np.array([14]),
+                               np.array([20000]), np.array([1]))
+        np.testing.assert_equal(np.array([255]), result)
+
     def test_calculate(self):
         nl = niche_vlaanderen.NutrientLevel()
         management = np.array([2])
@@ -0,0 +1,68 @@
+from unittest import TestCase
+
+import numpy as np
+
+import niche_vlaanderen
+from niche_vlaanderen.partition import SoilPartition
+
+
+class TestSoilPartition(TestCase):
+    def test_partition(self):
+        soil_code = np.array([[140000, -99, 10000],
+                              [10000, 140000, 10000]])
+        partition = SoilPartition(soil_code)
+        np.testing.assert_equal([-99, 10000, 140000], partition.codes)
+        np.testing.assert_equal([0, 1, 4, 6], partition.offsets)
+        self.assertEqual(6, partition.size)
+
+        ordered = partition.take(soil_code)
+        for code, pixels in partition.slices():
+            self.assertTrue(np.all(ordered[pixels] == code))
+
+        # put restores the grid order, also for stacked grids
+        np.testing.assert_equal(soil_code, partition.put(ordered))
+        stacked = partition.put(np.vstack([ordered, ordered + 1]))
+        np.testing.assert_equal(soil_code + 1, stacked[1])
+
+    def test_partition_nan(self):
+        # the nan pixels of a float grid are a single soil code
+        soil_code = np.array([[np.nan, 2.0, np.nan],
+                              [1.0, np.nan, 2.0]])
+        partition = SoilPartition(soil_code)
+        np.testing.assert_equal([1.0, 2.0, np.nan], partition.codes)
+        np.testing.assert_equal([0, 1, 3, 6], partition.offsets)
+
+        ordered = partition.take(soil_code)
+        np.testing.assert_equal(soil_code, partition.put(ordered))
+
+    def test_shared_partition(self):
+        # the engines give the same result with a shared partition
+        v = niche_vlaanderen.Vegetation()
+        nl = niche_vlaanderen.NutrientLevel()
+        a = niche_vlaanderen.Acidity()
+
+        soil_code = np.array([[140000, -99, 20000],
+                              [20000, 140000, 80000]])
+        mhw = np.array([[-10, -99, 5], [-20, 10, 3]])
+        mlw = np.array([[-60, -99, -40], [-50, -30, -80]])
+        msw = np.array([[-30, -99, -10], [-35, -5, -40]])
+
+        # the abiotic models use the soil codes without the last digits
+        soil_abiotic = np.where(soil_code == -99, -99, soil_code // 10000)
+        partition = SoilPartition(soil_abiotic)
+        np.testing.assert_equal(
+            nl._calculate_mineralisation(soil_abiotic, msw),
+            nl._calculate_mineralisation(soil_abiotic, msw, partition))
+        np.testing.assert_equal(
+            a._calculate_soil_mlw(soil_abiotic, mlw),
+            a._calculate_soil_mlw(soil_abiotic, mlw, partition))
+
+        partition = SoilPartition(soil_code)
+
+        veg, occurrence = v.calculate(soil_code, mhw, mlw, full_model=False)
+        veg_p, occurrence_p = v.calculate(soil_code, mhw, mlw,
+                                          full_model=False,
+                                          partition=partition)
+        self.assertEqual(occurrence, occurrence_p)
+        for vi in veg:
+            np.testing.assert_equal(veg[vi], veg_p[vi])
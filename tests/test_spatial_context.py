@@ -175,3 +175,14 @@ class testSpatialContext(TestCase):
         nocrs = rasterio.open("tests/data/small_nocrs.asc")
         sc = niche_vlaanderen.niche.SpatialContext(nocrs)
         assert sc.crs == ""
+
+    def test_blocks(self):
+        small = rasterio.open("tests/data/small/msw.asc")
+        sc = niche_vlaanderen.niche.SpatialContext(small)
+        blocks = list(sc.blocks((4, 5)))
+        expected = [((0, 4), (0, 5)), ((0, 4), (5, 7)),
+                    ((4, 6), (0, 5)), ((4, 6), (5, 7))]
+        self.assertEqual(expected, blocks)
+
+        with pytest.raises(SpatialContextError):
+            sc.blocks((0, 5))
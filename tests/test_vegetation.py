@@ -105,6 +105,26 @@ class testVegetation(TestCase):
             else:
                 np.testing.assert_equal(np.array([0]), veg_predict[vi])
 
+    def test_codes_not_in_table(self):
+        # acidity 3 is a valid code, but it is not used in this vegetation
+        # table. Nutrient level 3 only occurs combined with management 1.
+        v = niche_vlaanderen.Vegetation(
+            ct_vegetation="tests/data/bad_ct/one_vegetation_limited.csv")
+        soil_code = np.array([13, 13, 13, 13])
+        mhw = np.array([10, 10, 10, 10])
+        mlw = np.array([50, 50, 50, 50])
+        nutrient_level = np.array([2, 2, 3, 3])
+        acidity = np.array([2, 3, 2, 2])
+        management = np.array([0, 0, 1, 0])
+
+        veg_predict, _ = v.calculate(soil_code, mhw, mlw, nutrient_level,
+                                     acidity)
+        np.testing.assert_equal(np.array([1, 0, 1, 1]), veg_predict[1])
+
+        veg_predict, _ = v.calculate(soil_code, mhw, mlw, nutrient_level,
+                                     acidity, management=management)
+        np.testing.assert_equal(np.array([1, 0, 1, 0]), veg_predict[1])
+
     def test_occurrence(self):
         nutrient_level = np.array([[4, 4], [4, 5]])
         acidity = np.array([[3, 3], [3, 255]])
@@ -200,3 +220,77 @@ class testVegetation(TestCase):
         d = v.calculate_deviation(soil_code, mhw, mlw)
         expected = np.array([28, 12, 0, 0, -15, np.nan, np.nan])
         np.testing.assert_equal(expected, d["mlw_01"])
+
+    def test_deviation_out(self):
+        v = niche_vlaanderen.Vegetation()
+
+        soil_code = np.array([3, 3, 3, 3, -99, 2])
+        mhw = np.array([66, 16, 5, -5, 5, 5])
+        mlw = np.array([35, 35, 35, 35, 35, 35])
+        expected = v.calculate_deviation(soil_code, mhw, mlw)
+
+        out = np.empty((2, 28, 6))
+        d = v.calculate_deviation(soil_code, mhw, mlw, out=out)
+        self.assertEqual(sorted(expected.keys()), sorted(d.keys()))
+        for key in expected:
+            np.testing.assert_equal(expected[key], d[key])
+        np.testing.assert_equal(expected["mhw_01"], out[0, 0])
+        np.testing.assert_equal(expected["mlw_28"], out[1, 27])
+
+        with pytest.raises(NicheException):
+            v.calculate_deviation(soil_code, mhw, mlw, out=np.empty((2, 6)))
+
+    def test_deviation_dtype(self):
+        v = niche_vlaanderen.Vegetation()
+
+        soil_code = np.array([3, 3, 3, 3, -99, 2])
+        mhw = np.array([66.4, 16, 5, -5.6, 5, 5])
+        mlw = np.array([35, 35, 35, 35, 35, 35])
+        expected = v.calculate_deviation(soil_code, mhw, mlw)
+
+        d = v.calculate_deviation(soil_code, mhw, mlw, dtype="int16")
+        self.assertEqual(np.int16, d["mhw_01"].dtype)
+        np.testing.assert_equal([46, 0, 0, -7, -32768, -32768], d["mhw_01"])
+
+        d = v.calculate_deviation(soil_code, mhw, mlw, dtype="float32")
+        np.testing.assert_allclose(expected["mhw_01"], d["mhw_01"])
+
+        lazy = v.calculate_deviation(soil_code, mhw, mlw, lazy=True)
+        self.assertEqual(sorted(expected.keys()), sorted(lazy.keys()))
+        for key in lazy:
+            np.testing.assert_equal(expected[key], lazy[key])
+
+        with pytest.raises(NicheException):
+            v.calculate_deviation(soil_code, mhw, mlw, dtype="int8")
+
+    def test_packed(self):
+        v = niche_vlaanderen.Vegetation()
+
+        soil_code = np.array([[3, 3, 3], [3, -99, 2]])
+        mhw = np.array([[66, 16, 5], [-5, 5, 5]])
+        mlw = np.array([[35, 35, 35], [35, 35, 35]])
+        expected, occurrence = v.calculate(soil_code, mhw, mlw,
+                                           full_model=False)
+        packed, packed_occurrence = v.calculate(soil_code, mhw, mlw,
+                                                full_model=False, packed=True)
+        self.assertIsInstance(packed, niche_vlaanderen.vegetation.
+                              PackedVegetation)
+        self.assertEqual(occurrence, packed_occurrence)
+        self.assertEqual(sorted(expected.keys()), list(packed.keys()))
+        self.assertEqual((1, 2, 3), packed.words.shape)
+        self.assertTrue(99 not in packed)
+        for vi in expected:
+            self.assertEqual(np.uint8, packed[vi].dtype)
+            np.testing.assert_equal(expected[vi], packed[vi])
+            np.testing.assert_equal(expected[vi] == 1, packed.present(vi))
+            counts = packed.counts()[vi]
+            self.assertEqual(list(counts.index), [0, 1, 255])
+            self.assertEqual(counts[1], np.sum(expected[vi] == 1))
+            self.assertEqual(counts[255], 1)
+
+        # copy a part of the result to a larger grid
+        full = niche_vlaanderen.vegetation.PackedVegetation(
+            packed.veg_codes, np.ones((4, 3), dtype=bool))
+        full.set_window((slice(2, 4), slice(None)), packed)
+        np.testing.assert_equal(255, full[1][:2])
+        np.testing.assert_equal(expected[1], full[1][2:])
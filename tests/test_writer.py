@@ -0,0 +1,98 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pytest
+import rasterio
+import yaml
+
+import niche_vlaanderen
+from niche_vlaanderen.exception import NicheException
+from niche_vlaanderen.writer import GridWriter
+
+
+class TestGridWriter(TestCase):
+    def setUp(self):
+        with rasterio.open("tests/data/small/msw.asc") as dst:
+            self.context = niche_vlaanderen.niche.SpatialContext(dst)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_profile(self):
+        profile = GridWriter().profile(self.context, "uint8", 255)
+        self.assertEqual("DEFLATE", profile["compress"])
+        self.assertTrue("tiled" not in profile)
+        self.assertEqual({}, GridWriter().options)
+
+        writer = GridWriter(compress="ZSTD", level=9, predictor=2,
+                            tiled=True, blocksize=128, gdal_threads=2)
+        profile = writer.profile(self.context, "int16", -99, count=2)
+        self.assertEqual(9, profile["zstd_level"])
+        self.assertEqual(2, profile["predictor"])
+        self.assertEqual(128, profile["blockxsize"])
+        self.assertEqual(2, profile["num_threads"])
+        self.assertEqual(2, profile["count"])
+        self.assertEqual("ZSTD", writer.options["compress"])
+        # the predictor depends on the data type
+        self.assertEqual(3, writer.profile(self.context, "float64", -99999)
+                         ["predictor"])
+
+        self.assertEqual(
+            4, GridWriter(level=4).profile(self.context, "uint8", 255)
+            ["zlevel"])
+
+    def test_invalid(self):
+        with pytest.raises(NicheException):
+            GridWriter(compress="JPEG")
+        with pytest.raises(NicheException):
+            GridWriter(compress="LZW", level=3)
+        with pytest.raises(NicheException):
+            GridWriter(predictor=4)
+        with pytest.raises(NicheException):
+            GridWriter(blocksize=100)
+        with pytest.raises(NicheException):
+            GridWriter(threads=0)
+
+    def test_write_threads(self):
+        writer = GridWriter(compress="LZW", threads=3)
+        profile = writer.profile(self.context, "int16", -99)
+        bands = dict((i, np.full((6, 7), i, dtype="int16"))
+                     for i in range(10))
+        paths = dict((i, os.path.join(self.tmpdir, "{}.tif".format(i)))
+                     for i in bands)
+        writer.write((paths[i], profile, bands[i]) for i in bands)
+
+        for i in bands:
+            with rasterio.open(paths[i]) as dst:
+                self.assertEqual("lzw", dst.profile["compress"])
+                np.testing.assert_equal(bands[i], dst.read(1))
+
+        # errors of a thread are raised
+        with pytest.raises(rasterio.errors.RasterioIOError):
+            writer.write((os.path.join(self.tmpdir, "missing", "{}.tif"
+                                       .format(i)), profile, bands[i])
+                         for i in bands)
+
+    def test_niche_write(self):
+        myniche = niche_vlaanderen.Niche()
+        myniche.read_config_file("tests/small_simple.yaml")
+        myniche.run(full_model=False, deviation=True)
+
+        writer = GridWriter(compress="LZW", predictor=2, tiled=True,
+                            blocksize=16, threads=2)
+        myniche.write(self.tmpdir, writer=writer)
+        with rasterio.open(os.path.join(self.tmpdir, "V01.tif")) as dst:
+            self.assertTrue(dst.profile["tiled"])
+            self.assertEqual("lzw", dst.profile["compress"])
+            np.testing.assert_equal(myniche._vegetation[1], dst.read(1))
+        with rasterio.open(os.path.join(self.tmpdir, "mhw_01.tif")) as dst:
+            np.testing.assert_equal(myniche._deviation["mhw_01"],
+                                    dst.read(1))
+
+        with open(os.path.join(self.tmpdir, "log.txt")) as f:
+            log = yaml.safe_load(f)
+        self.assertEqual(writer.options, log["model_options"]["writer"])